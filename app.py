@@ -1,9 +1,13 @@
 import streamlit as st
 import os
 import json
+import threading
+import statistics
 from datetime import datetime
 from google.cloud import firestore
 from google.oauth2 import service_account # <-- Import ที่สำคัญ
+from scene_store import read_scenes
+from bulk_ingest import MAX_PRIORITY, ingest_orders, make_batch_tag, order_key, parse_orders, validate_orders
 
 # --- 1. การตั้งค่าหน้าเว็บและ GCP (สำหรับ Cloud เท่านั้น) ---
 st.set_page_config(page_title="AI Story Factory", page_icon="🏭", layout="wide")
@@ -45,6 +49,7 @@ def create_story_project(topic: str, style: str):
         projects_ref = db.collection('projects')
         project_data = {
             'topic': topic,
+            'topic_key': order_key(topic, style)[0], # ให้ Bulk Upload ตรวจโปรเจกต์ซ้ำได้โดยไม่สนตัวพิมพ์
             'style': style,
             'status': 'script_pending',
             'created_at': firestore.SERVER_TIMESTAMP,
@@ -55,24 +60,249 @@ def create_story_project(topic: str, style: str):
         st.error(f"เกิดข้อผิดพลาดในการสร้างโปรเจกต์: {e}")
         return None
 
+# --- ค่าที่ใช้กับ Dashboard ---
+PAGE_SIZE = 20
+# ดึงเฉพาะ field ที่หน้า list ใช้ (ไม่ดึง scenes ซึ่งใหญ่ที่สุดในเอกสาร)
+LIST_FIELDS = [
+    'topic', 'style', 'status', 'created_at', 'final_video_url', 'error_message',
+    'scene_count', 'scenes_ready', 'scenes_failed', 'hls_playlist_url', 'batch_tag', 'priority',
+]
+PIPELINE_STATUSES = [
+    'script_pending', 'script_processing', 'script_failed',
+    'assets_pending', 'assets_processing', 'assets_failed',
+    'compile_pending', 'compiling', 'compile_failed',
+    'completed',
+]
+# แต่ละแผนก: (ชื่อ, pending, processing, failed, field เวลาที่เข้าคิว, field เวลาที่เสร็จ)
+PIPELINE_STAGES = [
+    ('Script', 'script_pending', 'script_processing', 'script_failed', 'created_at', 'script_completed_at'),
+    ('Assets', 'assets_pending', 'assets_processing', 'assets_failed', 'script_completed_at', 'assets_completed_at'),
+    ('Compile', 'compile_pending', 'compiling', 'compile_failed', 'assets_completed_at', 'completed_at'),
+]
+LATENCY_SAMPLE_SIZE = 50 # จำนวนโปรเจกต์ที่เสร็จล่าสุดที่ใช้คำนวณเวลาของแต่ละแผนก
+
 @st.cache_data(ttl=60)
-def fetch_projects():
-    """ดึงข้อมูลโปรเจกต์ทั้งหมดจาก Firestore"""
+def fetch_projects_page(status_filter: str, cursor_id: str | None):
+    """
+    ดึงโปรเจกต์ทีละหน้า (เรียงจากใหม่ไปเก่า) เฉพาะ field ที่ต้องแสดง
+    คืนค่า (project_list, next_cursor_id) โดย next_cursor_id เป็น None ถ้าเป็นหน้าสุดท้าย
+    หมายเหตุ: การกรอง status + เรียง created_at ต้องมี composite index (status, created_at desc)
+    """
     if not db:
-        return []
+        return [], None
     try:
         projects_ref = db.collection('projects')
-        docs = projects_ref.order_by("created_at", direction=firestore.Query.DESCENDING).stream()
-        
+        query = projects_ref
+        if status_filter != "all":
+            query = query.where('status', '==', status_filter)
+        query = query.order_by("created_at", direction=firestore.Query.DESCENDING).select(LIST_FIELDS)
+        if cursor_id:
+            query = query.start_after(projects_ref.document(cursor_id).get())
+        docs = list(query.limit(PAGE_SIZE + 1).stream())
+
         project_list = []
-        for doc in docs:
+        for doc in docs[:PAGE_SIZE]:
             project_data = doc.to_dict()
             project_data['id'] = doc.id
             project_list.append(project_data)
-        return project_list
+        next_cursor_id = docs[PAGE_SIZE - 1].id if len(docs) > PAGE_SIZE else None
+        return project_list, next_cursor_id
     except Exception as e:
         st.error(f"ไม่สามารถดึงข้อมูลโปรเจกต์ได้: {e}")
+        return [], None
+
+@st.cache_data(ttl=60)
+def fetch_status_counts():
+    """นับจำนวนโปรเจกต์แต่ละสถานะด้วย count query (ไม่ต้องอ่านเอกสารทั้งหมด)"""
+    if not db:
+        return {}
+    try:
+        projects_ref = db.collection('projects')
+        counts = {}
+        for status in PIPELINE_STATUSES:
+            result = projects_ref.where('status', '==', status).count(alias="total").get()
+            counts[status] = int(result[0][0].value)
+        return counts
+    except Exception as e:
+        st.error(f"ไม่สามารถนับจำนวนโปรเจกต์ได้: {e}")
+        return {}
+
+@st.cache_data(ttl=300)
+def fetch_stage_latencies():
+    """
+    ค่ามัธยฐานของเวลาที่แต่ละแผนกใช้ (รวมเวลารอคิว) จากโปรเจกต์ที่เสร็จล่าสุด LATENCY_SAMPLE_SIZE รายการ
+    คืนค่า dict ชื่อแผนก -> วินาที (ไม่มี key ถ้ายังไม่มีข้อมูล)
+    """
+    if not db:
+        return {}
+    try:
+        timestamp_fields = sorted({field for stage in PIPELINE_STAGES for field in stage[4:]})
+        query = (db.collection('projects')
+                 .order_by("completed_at", direction=firestore.Query.DESCENDING)
+                 .select(timestamp_fields)
+                 .limit(LATENCY_SAMPLE_SIZE))
+        durations = {name: [] for name, *_ in PIPELINE_STAGES}
+        for doc in query.stream():
+            doc_data = doc.to_dict()
+            for name, _, _, _, start_field, end_field in PIPELINE_STAGES:
+                if doc_data.get(start_field) and doc_data.get(end_field):
+                    durations[name].append((doc_data[end_field] - doc_data[start_field]).total_seconds())
+        return {name: statistics.median(values) for name, values in durations.items() if values}
+    except Exception as e:
+        st.error(f"ไม่สามารถคำนวณเวลาของแต่ละแผนกได้: {e}")
+        return {}
+
+def render_stage_funnel(status_counts):
+    """แสดงจำนวนงานที่ค้างในแต่ละแผนก และชี้แผนกที่เป็นคอขวด (งานค้างมากที่สุด / ใช้เวลานานที่สุด)"""
+    latencies = fetch_stage_latencies()
+    backlogs = {name: status_counts.get(pending, 0) + status_counts.get(processing, 0)
+                for name, pending, processing, *_ in PIPELINE_STAGES}
+
+    for name, pending, processing, failed, *_ in PIPELINE_STAGES:
+        stage_columns = st.columns([1, 1, 1, 1, 1])
+        stage_columns[0].markdown(f"**{name}**")
+        stage_columns[1].metric("Waiting", status_counts.get(pending, 0))
+        stage_columns[2].metric("In progress", status_counts.get(processing, 0))
+        stage_columns[3].metric("Failed", status_counts.get(failed, 0))
+        median_seconds = latencies.get(name)
+        stage_columns[4].metric("Median time", f"{median_seconds / 60:.1f} min" if median_seconds is not None else "-")
+    st.caption(f"Completed: {status_counts.get('completed', 0)} — median time counts queue wait and uses the "
+               f"latest {LATENCY_SAMPLE_SIZE} completed projects. Workers export live metrics at /metrics "
+               f"(ports 9101 script, 9102 assets, 9103 compile).")
+
+    if any(backlogs.values()):
+        slowest_backlog = max(backlogs, key=backlogs.get)
+        st.warning(f"🚧 Bottleneck: **{slowest_backlog}** has the most queued work ({backlogs[slowest_backlog]} projects).")
+    if latencies:
+        slowest_stage = max(latencies, key=latencies.get)
+        st.info(f"🐢 Slowest stage: **{slowest_stage}** (median {latencies[slowest_stage] / 60:.1f} min per project).")
+
+@st.cache_data(ttl=300)
+def fetch_project_scenes(project_id: str):
+    """ดึง scenes ของโปรเจกต์เดียว (โหลดเมื่อผู้ใช้กดดูเท่านั้น) รองรับทั้งแบบ array และแบบ subcollection"""
+    if not db:
         return []
+    try:
+        doc_ref = db.collection('projects').document(project_id)
+        doc = doc_ref.get(field_paths=['scenes', 'scene_storage'])
+        return read_scenes(doc_ref, doc.to_dict() or {})
+    except Exception as e:
+        st.error(f"ไม่สามารถดึงข้อมูลฉากได้: {e}")
+        return []
+
+def invalidate_project_list():
+    """ล้าง cache เฉพาะรายการโปรเจกต์และตัวนับ (scenes ที่โหลดไว้แล้วยังใช้ต่อได้)"""
+    fetch_projects_page.clear()
+    fetch_status_counts.clear()
+    fetch_stage_latencies.clear()
+
+# --- Live mode: listener ตัวเดียวต่อ server process ใช้ร่วมกันทุก session ---
+LIVE_WINDOW = 100 # จำนวนโปรเจกต์ล่าสุดที่ติดตามแบบ live
+LIVE_REFRESH_SECONDS = 2
+
+class LiveProjectIndex:
+    """index ของโปรเจกต์ล่าสุดในหน่วยความจำ อัปเดตจาก on_snapshot (อ่านเฉพาะเอกสารที่เปลี่ยน)"""
+
+    def __init__(self, db):
+        self._lock = threading.Lock()
+        self._projects = {}
+        query = db.collection('projects').order_by("created_at", direction=firestore.Query.DESCENDING).limit(LIVE_WINDOW)
+        self._watch = query.on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                if change.type.name == 'REMOVED':
+                    self._projects.pop(doc.id, None)
+                    continue
+                # เก็บเฉพาะ field ที่การ์ดใช้ (ไม่เก็บ scenes ไว้ในหน่วยความจำ)
+                doc_data = doc.to_dict()
+                project_data = {field: doc_data.get(field) for field in LIST_FIELDS}
+                project_data['id'] = doc.id
+                self._projects[doc.id] = project_data
+
+    def projects(self):
+        """คืนรายการโปรเจกต์เรียงจากใหม่ไปเก่า (โปรเจกต์ที่ยังไม่มี created_at จะอยู่บนสุด)"""
+        with self._lock:
+            project_list = list(self._projects.values())
+        return sorted(
+            project_list,
+            key=lambda p: p['created_at'].timestamp() if p.get('created_at') else float('inf'),
+            reverse=True,
+        )
+
+@st.cache_resource
+def get_live_index():
+    """สร้าง LiveProjectIndex ครั้งเดียวต่อ process (ทุกผู้ใช้ที่เปิดหน้า live ใช้ listener ตัวเดียวกัน)"""
+    return LiveProjectIndex(db)
+
+def render_project_card(project):
+    """แสดงการ์ดของโปรเจกต์ 1 รายการ"""
+    with st.container(border=True):
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.subheader(f'🎬 {project.get("topic", "N/A")}')
+            st.caption(f'Style: {project.get("style", "N/A")} | Project ID: {project.get("id")}'
+                       + (f' | Batch: {project["batch_tag"]}' if project.get("batch_tag") else '')
+                       + (f' | Priority: {project["priority"]}' if project.get("priority") else ''))
+        with col2:
+            status = project.get("status") or "unknown"
+            if status == "completed":
+                st.success(f"✅ COMPLETED")
+            elif "failed" in status:
+                st.error(f"❌ FAILED")
+            else:
+                st.info(f"⏳ {status.upper()}")
+            if project.get("scene_count"):
+                st.caption(f'Scenes: {project.get("scenes_ready") or 0}/{project["scene_count"]} ready'
+                           + (f', {project["scenes_failed"]} failed' if project.get("scenes_failed") else ''))
+
+        final_url = project.get("final_video_url")
+        if final_url:
+            st.info("Your video is ready! The link expires in 1 hour.")
+            st.link_button("🎬 **Watch Your Video**", final_url)
+        elif project.get("hls_playlist_url") and status == "compiling":
+            # ฉากที่ render เสร็จแล้วถูกอัปโหลดเป็น HLS ดูได้ก่อนวิดีโอเต็มจะเสร็จ
+            st.link_button("📺 Watch while rendering (HLS)", project["hls_playlist_url"])
+        
+        error_msg = project.get("error_message")
+        if error_msg:
+            with st.expander("View Error Details"):
+                st.error(error_msg)
+
+        # โหลด scenes เฉพาะเมื่อผู้ใช้เปิดดู
+        if st.toggle("Show scenes", key=f"show_scenes_{project.get('id')}"):
+            scenes = fetch_project_scenes(project.get("id"))
+            if not scenes:
+                st.caption("No scenes yet.")
+            for i, scene in enumerate(scenes):
+                st.markdown(f"**Scene {i + 1}:** {scene.get('narration', '')}")
+                if scene.get("image_url"):
+                    st.image(scene["image_url"], width=320)
+                if scene.get("error"):
+                    st.error(scene["error"])
+
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def live_production_board():
+    """
+    rerun เฉพาะส่วนนี้ทุก LIVE_REFRESH_SECONDS โดยอ่านจาก index ในหน่วยความจำ (ไม่ query Firestore)
+    ทุกรอบจะวาดการ์ดใหม่ทั้งหมดแม้ข้อมูลไม่เปลี่ยน (fragment ที่ไม่วาดอะไรเลยจะทำให้การ์ดหายไป)
+    แต่ต้นทุนอยู่ที่ฝั่ง server ในหน่วยความจำเท่านั้น ไม่มีการอ่าน Firestore เพิ่ม
+    """
+    projects = get_live_index().projects()
+    status_counts = {}
+    for project in projects:
+        status_counts[project.get("status")] = status_counts.get(project.get("status"), 0) + 1
+    st.caption(f"🔴 Live — tracking the latest {LIVE_WINDOW} projects ({len(projects)} loaded).")
+    count_columns = st.columns(5)
+    for i, status in enumerate(PIPELINE_STATUSES):
+        count_columns[i % 5].metric(status.replace("_", " ").title(), status_counts.get(status, 0))
+
+    if not projects:
+        st.info("No projects in the production line yet.")
+    for project in projects:
+        render_project_card(project)
 
 # --- 3. ส่วน UI ของ Streamlit ---
 st.title("🏭 AI Story Factory - Command Center")
@@ -96,45 +326,86 @@ else:
                         if project_id:
                             st.success(f"Order submitted! Project ID: {project_id}")
                             st.balloons()
-                            st.cache_data.clear()
+                            invalidate_project_list()
                 else:
                     st.warning("Please enter a topic.")
 
+    # --- ส่วนที่ 3.1.1: อัปโหลด order ทีละมากจากไฟล์ CSV / JSONL ---
+    with st.expander("📦 **Bulk Order Upload**"):
+        st.caption(f"CSV with a header row (topic,style[,priority]) or JSONL with one "
+                   f'{{"topic": ..., "style": ..., "priority": ...}} per line. Priority 1-{MAX_PRIORITY} jumps the queue.')
+        uploaded_file = st.file_uploader("Orders file:", type=["csv", "jsonl"])
+        tag_col, style_col, priority_col = st.columns([2, 2, 1])
+        batch_tag = tag_col.text_input("Batch tag:", st.session_state.setdefault("bulk_batch_tag", make_batch_tag()))
+        default_style = style_col.text_input("Style for rows without one:", "")
+        default_priority = priority_col.number_input("Default priority:", min_value=0, max_value=MAX_PRIORITY, value=0)
+
+        if uploaded_file:
+            rows, errors = parse_orders(uploaded_file.getvalue().decode("utf-8-sig"), uploaded_file.name)
+            orders, row_errors, duplicates = validate_orders(rows, default_style, int(default_priority))
+            errors += row_errors
+            st.info(f"{len(orders)} valid orders, {duplicates} duplicate rows, {len(errors)} invalid rows.")
+            if errors:
+                with st.expander("View invalid rows"):
+                    st.code("\n".join(errors))
+            if st.button(f"🚀 QUEUE {len(orders)} ORDERS", disabled=not orders or not batch_tag):
+                with st.spinner("Submitting orders..."):
+                    try:
+                        created, skipped = ingest_orders(db, orders, batch_tag)
+                        st.success(f"Queued {created} projects with tag '{batch_tag}' ({skipped} already existed).")
+                        st.session_state.pop("bulk_batch_tag")
+                        invalidate_project_list()
+                    except Exception as e:
+                        st.error(f"เกิดข้อผิดพลาดในการสร้างโปรเจกต์: {e}")
+
     st.divider()
 
     # --- ส่วนที่ 3.2: Dashboard สำหรับติดตามโปรเจกต์ ---
     st.header("📊 Production Line Monitoring")
 
-    if st.button("🔄 Refresh Project List"):
-        st.cache_data.clear()
-        st.rerun()
+    live_mode = st.toggle("🔴 Live mode", help="อัปเดตอัตโนมัติจาก listener ที่ใช้ร่วมกัน โดยไม่ต้องกด Refresh")
 
-    projects = fetch_projects()
-    
-    if not projects:
-        st.info("No projects in the production line yet.")
+    if live_mode:
+        live_production_board()
     else:
+        if st.button("🔄 Refresh Project List"):
+            invalidate_project_list()
+            st.rerun()
+
+        # --- ตัวนับจำนวนโปรเจกต์แต่ละสถานะ ---
+        status_counts = fetch_status_counts()
+        if status_counts:
+            count_columns = st.columns(5)
+            for i, status in enumerate(PIPELINE_STATUSES):
+                count_columns[i % 5].metric(status.replace("_", " ").title(), status_counts.get(status, 0))
+
+            # --- funnel ของแต่ละแผนกและคอขวด (ใช้ตัดสินใจว่าจะเพิ่ม replica ของแผนกไหน) ---
+            with st.expander("🔎 Stage funnel & bottleneck"):
+                render_stage_funnel(status_counts)
+
+        # --- ตัวกรองและการแบ่งหน้า (cursor ของแต่ละหน้าเก็บไว้ใน session_state) ---
+        status_filter = st.selectbox("Filter by status:", ["all"] + PIPELINE_STATUSES)
+        if st.session_state.get("status_filter") != status_filter:
+            st.session_state.status_filter = status_filter
+            st.session_state.page_cursors = [None]
+        page_cursors = st.session_state.setdefault("page_cursors", [None])
+
+        projects, next_cursor_id = fetch_projects_page(status_filter, page_cursors[-1])
+
+        if not projects:
+            st.info("No projects in the production line yet.")
         for project in projects:
-            with st.container(border=True):
-                col1, col2 = st.columns([3, 1])
-                with col1:
-                    st.subheader(f'🎬 {project.get("topic", "N/A")}')
-                    st.caption(f'Style: {project.get("style", "N/A")} | Project ID: {project.get("id")}')
-                with col2:
-                    status = project.get("status", "unknown")
-                    if status == "completed":
-                        st.success(f"✅ COMPLETED")
-                    elif "failed" in status:
-                        st.error(f"❌ FAILED")
-                    else:
-                        st.info(f"⏳ {status.upper()}")
-
-                final_url = project.get("final_video_url")
-                if final_url:
-                    st.info("Your video is ready! The link expires in 1 hour.")
-                    st.link_button("🎬 **Watch Your Video**", final_url)
-                
-                error_msg = project.get("error_message")
-                if error_msg:
-                    with st.expander("View Error Details"):
-                        st.error(error_msg)
+            render_project_card(project)
+
+        # --- ปุ่มเปลี่ยนหน้า ---
+        prev_col, page_col, next_col = st.columns([1, 2, 1])
+        with prev_col:
+            if st.button("⬅️ Previous", disabled=len(page_cursors) == 1):
+                page_cursors.pop()
+                st.rerun()
+        with page_col:
+            st.caption(f"Page {len(page_cursors)}")
+        with next_col:
+            if st.button("Next ➡️", disabled=next_cursor_id is None):
+                page_cursors.append(next_cursor_id)
+                st.rerun()
@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import hashlib
+import datetime
+import threading
+from google.cloud import firestore
+from metrics import span
+
+# --- 1. การตั้งค่า ---
+# Asset ที่สร้างแล้วจะถูกเก็บไว้ที่ cache/<hash>.<ext> ใน Bucket เดียวกับ Worker
+# และมี index อยู่ใน Firestore collection 'asset_cache' (document id = hash)
+CACHE_ENABLED = os.environ.get("ASSET_CACHE_ENABLED", "1") == "1"
+CACHE_PREFIX = "cache"
+CACHE_COLLECTION = "asset_cache"
+CACHE_STATS_DOC = "_stats"
+CACHE_MAX_AGE_DAYS = int(os.environ.get("ASSET_CACHE_MAX_AGE_DAYS", "30"))  # ลบรายการที่ไม่ได้ใช้นานกว่านี้
+CACHE_MAX_BYTES = int(os.environ.get("ASSET_CACHE_MAX_BYTES", str(50 * 1024 ** 3)))  # ขนาดรวมสูงสุดของ cache
+
+
+def cache_key(kind, content, **params):
+    """สร้าง key จาก hash ของเนื้อหา (prompt/narration) รวมกับพารามิเตอร์ของโมเดล"""
+    payload = json.dumps({'kind': kind, 'content': content, 'params': params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AssetCache:
+    """
+    Cache แบบ content-addressed สำหรับภาพและเสียงที่สร้างแล้ว
+    ถ้าเจอ key เดิมจะคืน URL ของไฟล์เดิมโดยไม่ต้องเรียกโมเดลใหม่
+    """
+
+    def __init__(self, db, bucket, enabled=CACHE_ENABLED):
+        self.db = db
+        self.bucket = bucket
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._unflushed = {'hits': 0, 'misses': 0}
+
+    def _index(self):
+        return self.db.collection(CACHE_COLLECTION)
+
+    def record(self, hit):
+        """นับ hit/miss ของ process นี้ (ใช้เมื่อเรียก lookup/store เองโดยไม่ผ่าน get_or_create)"""
+        field = 'hits' if hit else 'misses'
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+            self._unflushed[field] += 1
+
+    def lookup(self, key):
+        """คืนค่า (url, blob_name) ถ้ามีใน cache และไฟล์ยังอยู่ใน GCS ไม่เช่นนั้นคืน None"""
+        entry_ref = self._index().document(key)
+        entry = entry_ref.get()
+        if not entry.exists:
+            return None
+        entry_data = entry.to_dict()
+        if not self.bucket.blob(entry_data['blob_name']).exists():
+            # ไฟล์ถูกลบไปแล้ว (เช่นจากการ evict) ให้ลบ index ทิ้งด้วย
+            entry_ref.delete()
+            return None
+        entry_ref.update({'last_used_at': firestore.SERVER_TIMESTAMP, 'hits': firestore.Increment(1)})
+        return entry_data['url'], entry_data['blob_name']
+
+    def store(self, key, data, extension, content_type, meta=None):
+        """อัปโหลดไฟล์ไปไว้ใต้ hash ของมัน แล้วบันทึก index คืนค่า (url, blob_name)"""
+        blob_name = f"{CACHE_PREFIX}/{key}.{extension}"
+        blob = self.bucket.blob(blob_name)
+        with span('gcs_upload'):
+            blob.upload_from_string(data, content_type=content_type)
+        self._index().document(key).set({
+            'blob_name': blob_name,
+            'url': blob.public_url,
+            'size_bytes': len(data),
+            'content_type': content_type,
+            'meta': meta or {},
+            'hits': 0,
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'last_used_at': firestore.SERVER_TIMESTAMP,
+        })
+        return blob.public_url, blob_name
+
+    def get_or_create(self, key, extension, content_type, generate_fn, meta=None):
+        """
+        คืน URL จาก cache ถ้ามี ไม่เช่นนั้นเรียก generate_fn() เพื่อสร้าง bytes ใหม่แล้วเก็บเข้า cache
+        คืนค่า (url, blob_name, hit)
+        """
+        cached = self.lookup(key)
+        if cached:
+            self.record(True)
+            return cached[0], cached[1], True
+        data = generate_fn()
+        self.record(False)
+        url, blob_name = self.store(key, data, extension, content_type, meta)
+        return url, blob_name, False
+
+    def stats(self):
+        """สถิติของ process นี้ (hits, misses, hit_rate)"""
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': (self._hits / total) if total else 0.0,
+            }
+
+    def flush_stats(self):
+        """รวมสถิติที่ยังไม่ได้บันทึกเข้า document กลาง เพื่อดู hit rate ของทั้งระบบ"""
+        with self._lock:
+            delta = dict(self._unflushed)
+            self._unflushed = {'hits': 0, 'misses': 0}
+        if not delta['hits'] and not delta['misses']:
+            return
+        self._index().document(CACHE_STATS_DOC).set({
+            'hits': firestore.Increment(delta['hits']),
+            'misses': firestore.Increment(delta['misses']),
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+    def evict(self, max_age_days=CACHE_MAX_AGE_DAYS, max_bytes=CACHE_MAX_BYTES):
+        """
+        ลบรายการที่ไม่ได้ใช้นานเกิน max_age_days และลบรายการที่ใช้ล่าสุดนานที่สุด
+        จนกว่าขนาดรวมจะไม่เกิน max_bytes คืนค่าจำนวนรายการที่ลบ
+        """
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=max_age_days)
+        entries = [
+            entry for entry in self._index().order_by('last_used_at').stream()
+            if entry.id != CACHE_STATS_DOC
+        ]
+        total_bytes = sum(entry.to_dict().get('size_bytes', 0) for entry in entries)
+
+        evicted = 0
+        for entry in entries:
+            entry_data = entry.to_dict()
+            too_old = entry_data.get('last_used_at') and entry_data['last_used_at'] < cutoff
+            if not too_old and total_bytes <= max_bytes:
+                break
+            blob = self.bucket.blob(entry_data['blob_name'])
+            if blob.exists():
+                blob.delete()
+            entry.reference.delete()
+            total_bytes -= entry_data.get('size_bytes', 0)
+            evicted += 1
+        return evicted
+
+
+# --- 2. รันเพื่อ evict cache ด้วยมือ หรือจาก scheduler ---
+# วิธีใช้: python asset_cache.py evict
+if __name__ == "__main__":
+    from runtime import firestore_client, storage_bucket
+
+    if len(sys.argv) < 2 or sys.argv[1] != "evict":
+        print("Usage: python asset_cache.py evict")
+        sys.exit(1)
+
+    # ตั้งค่าการเชื่อมต่อและชื่อ Bucket ผ่าน Environment Variable (ดู runtime.py)
+    evicted = AssetCache(firestore_client.get(), storage_bucket.get()).evict()
+    print(f"✅ Evicted {evicted} cached assets.")
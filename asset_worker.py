@@ -1,134 +1,438 @@
 import os
-import time
 import io
-from PIL import Image
-from google.cloud import firestore, storage
-import vertexai
-from vertexai.preview.vision_models import ImageGenerationModel
-from google.cloud import texttospeech
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from google.cloud import firestore
+from job_queue import check_lease, fenced_update, job_fence, make_worker_id, return_to_upstream, run_worker
+from backends import PIPELINE_BACKEND, make_image_model, make_tts_client
+from runtime import GCP_LOCATION, GCP_PROJECT_ID, Lazy, firestore_client, preload, report_startup, storage_bucket
+from asset_cache import AssetCache, cache_key
+from rate_limiter import BackendLimiter
+from pipeline_stream import PIPELINE_STREAMING, DocumentWatcher, missing_assets
+from video_render import RENDER_WIDTH, RENDER_HEIGHT
+from tts_batch import build_ssml, plan_batches, scene_mark, split_wav, wav_to_mp3
+from scene_store import clear_scene_fields, read_scenes, summarize, update_scene, uses_subcollection, write_scenes
+from metrics import span
 
 # --- 1. การตั้งค่า ---
 print("🚀 Starting Asset Production Worker (v2.0 - Organized)...")
 
-# --- แก้ไขตรงนี้ ---
-GCP_KEY_FILE_PATH = "E:\\streamlit-story-app\\youtubeubload.json"
-GCP_PROJECT_ID = "youtubeubload"
-GCP_LOCATION = "asia-southeast1"
-BUCKET_NAME = "ai-story-factory-assets-nattapobiz" # <--- ชื่อ Bucket ของคุณ
-# ------------------
-
-# --- เพิ่มเข้ามา: จัดการโฟลเดอร์ไฟล์ชั่วคราว ---
-TEMP_FOLDER = "temp_files"
-if not os.path.exists(TEMP_FOLDER):
-    os.makedirs(TEMP_FOLDER)
-    print(f"Created temporary folder at: {TEMP_FOLDER}")
-# ----------------------------------------------
-
-try:
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GCP_KEY_FILE_PATH
-    db = firestore.Client(project=GCP_PROJECT_ID)
-    storage_client = storage.Client(project=GCP_PROJECT_ID)
-    bucket = storage_client.bucket(BUCKET_NAME)
-    vertexai.init(project=GCP_PROJECT_ID, location=GCP_LOCATION)
-    
-    image_model = ImageGenerationModel.from_pretrained("imagegeneration@006")
-    tts_client = texttospeech.TextToSpeechClient()
-    print("✅ Successfully connected to GCP services (Firestore, Storage, Vertex AI).")
-except Exception as e:
-    print(f"❌ Worker failed to initialize: {e}")
-    exit()
+# การเชื่อมต่อ GCP, region และชื่อ Bucket ตั้งผ่าน Environment Variable ดู runtime.py
+
+# --- พารามิเตอร์ของโมเดล (เป็นส่วนหนึ่งของ cache key ด้วย) ---
+IMAGE_MODEL_NAME = "imagegeneration@006"
+IMAGE_ASPECT_RATIO = "16:9"
+TTS_LANGUAGE_CODE = "en-US"
+TTS_VOICE_NAME = "en-US-Neural2-J"
+# รวมบทบรรยายหลายฉากเป็น SSML เดียว (ใส่ <mark> คั่น) แล้วเรียก TTS ครั้งเดียวต่อกลุ่ม
+TTS_BATCHING = os.environ.get("TTS_BATCHING", "0") == "1"
+
+# --- ปรับภาพให้ตรงกับความละเอียดของวิดีโอก่อนอัปโหลด (Video Worker ไม่ต้องย่อภาพเองทุกเฟรม) ---
+# IMAGE_FORMAT: 'JPEG', 'WEBP' หรือ 'PNG' (ไม่บีบอัด) ตั้ง IMAGE_NORMALIZE=0 เพื่ออัปโหลดไฟล์ต้นฉบับจาก Imagen
+IMAGE_NORMALIZE = os.environ.get("IMAGE_NORMALIZE", "1") == "1"
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+IMAGE_FILE_TYPES = {'JPEG': ("jpg", "image/jpeg"), 'WEBP': ("webp", "image/webp"), 'PNG': ("png", "image/png")}
+
+# --- จำนวนงานที่ยิงไปแต่ละ backend พร้อมกันได้ (ใช้ร่วมกันทุกโปรเจกต์ใน process นี้) ---
+IMAGE_CONCURRENCY = int(os.environ.get("IMAGE_CONCURRENCY", "4"))
+TTS_CONCURRENCY = int(os.environ.get("TTS_CONCURRENCY", "8"))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_CONCURRENCY, thread_name_prefix="imagen")
+tts_executor = ThreadPoolExecutor(max_workers=TTS_CONCURRENCY, thread_name_prefix="tts")
+
+# --- quota ต่อนาทีของแต่ละ backend (แบ่งกันทุก replica ผ่าน Firestore) ---
+IMAGEN_QUOTA_PER_MINUTE = int(os.environ.get("IMAGEN_QUOTA_PER_MINUTE", "60"))
+TTS_QUOTA_PER_MINUTE = int(os.environ.get("TTS_QUOTA_PER_MINUTE", "900"))
+
+WORKER_ID = make_worker_id("assets")
+
+
+def make_tts_params():
+    """voice และ audio config ของ TTS สร้างครั้งเดียวแล้วใช้ซ้ำทุกฉาก"""
+    from google.cloud import texttospeech
+    return (
+        texttospeech.VoiceSelectionParams(language_code=TTS_LANGUAGE_CODE, name=TTS_VOICE_NAME),
+        texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3),
+    )
+
+
+def make_tts_batch_params():
+    """timepoint ของ <mark> มีเฉพาะใน v1beta1 และขอเสียงแบบ LINEAR16 เพื่อตัดได้ตรง sample"""
+    from google.cloud import texttospeech_v1beta1
+    return (
+        texttospeech_v1beta1.VoiceSelectionParams(language_code=TTS_LANGUAGE_CODE, name=TTS_VOICE_NAME),
+        texttospeech_v1beta1.AudioConfig(audio_encoding=texttospeech_v1beta1.AudioEncoding.LINEAR16),
+    )
+
+
+# client ทุกตัวสร้างผ่าน backends (PIPELINE_BACKEND=local ใช้ตัวจำลองในเครื่องแทน GCP)
+# และสร้างตอนงานแรกต้องใช้ (Vertex AI import และโหลดโมเดลนานหลายวินาที ไม่ควรถ่วงการเริ่ม process)
+bucket = storage_bucket
+image_model = Lazy("Imagen", lambda: make_image_model(GCP_PROJECT_ID, GCP_LOCATION, IMAGE_MODEL_NAME))
+tts_client = Lazy("Text-to-Speech", make_tts_client)
+tts_params = Lazy("Text-to-Speech voice", make_tts_params)
+tts_batch_client = Lazy("Text-to-Speech (v1beta1)", lambda: make_tts_client(beta=True))
+tts_batch_params = Lazy("Text-to-Speech batch voice", make_tts_batch_params)
+db = None
+asset_cache = None
+imagen_limiter = None
+tts_limiter = None
+
+
+def init():
+    """เชื่อมต่อ Firestore และสร้าง limiter ตอนเริ่ม main_loop ส่วน client อื่นโหลดเมื่อใช้ครั้งแรก"""
+    global db, asset_cache, imagen_limiter, tts_limiter
+    db = firestore_client.get()
+    asset_cache = AssetCache(db, bucket)
+    imagen_limiter = BackendLimiter("imagen", IMAGEN_QUOTA_PER_MINUTE, IMAGE_CONCURRENCY, db=db, worker_id=WORKER_ID)
+    tts_limiter = BackendLimiter("tts", TTS_QUOTA_PER_MINUTE, TTS_CONCURRENCY, db=db, worker_id=WORKER_ID)
+    print(f"✅ Successfully connected to backend services ({PIPELINE_BACKEND}: Firestore; Storage, Imagen and TTS load on first job).")
 
 # --- 2. ฟังก์ชันการทำงานของ Worker ---
 
-def upload_to_gcs(file_path, destination_blob_name):
-    """อัปโหลดไฟล์ไปยัง Google Cloud Storage"""
+def upload_to_gcs(data, destination_blob_name, content_type):
+    """อัปโหลดข้อมูลจากหน่วยความจำไปยัง Google Cloud Storage โดยไม่ผ่านดิสก์ คืนค่า (url, blob_name)"""
     blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(file_path)
-    return blob.public_url
+    with span('gcs_upload'):
+        blob.upload_from_string(data, content_type=content_type)
+    return blob.public_url, destination_blob_name
+
+def normalize_image(image_bytes):
+    """
+    ย่อ/ขยายภาพให้พอดี RENDER_WIDTH x RENDER_HEIGHT (เติมขอบดำแบบเดียวกับ ffmpeg ถ้าสัดส่วนไม่ตรง)
+    แล้วบีบอัดเป็น IMAGE_FORMAT ที่คุณภาพ IMAGE_QUALITY
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = ImageOps.pad(image.convert("RGB"), (RENDER_WIDTH, RENDER_HEIGHT), method=Image.LANCZOS, color=(0, 0, 0))
+    output = io.BytesIO()
+    if IMAGE_FORMAT == "PNG":
+        image.save(output, format="PNG", optimize=True)
+    else:
+        image.save(output, format=IMAGE_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+    return output.getvalue()
+
+def create_scene_image(doc_id, scene_num, image_prompt):
+    """สร้างภาพของฉากด้วย Imagen (หรือดึงจาก cache) คืนค่า (url, blob_name) ของภาพ"""
+    def call_imagen():
+        # span จับเวลาเฉพาะการเรียก Imagen จริง ไม่รวมเวลาที่รอ limiter
+        with span('imagen'):
+            return image_model.generate_images(prompt=image_prompt, number_of_images=1, aspect_ratio=IMAGE_ASPECT_RATIO)
+
+    def generate():
+        # ผ่าน limiter เพื่อไม่ให้เกิน quota ถ้าโดน 429 จะรอแล้วลองใหม่แทนที่จะทิ้งฉากนี้
+        response_img = imagen_limiter.call(call_imagen)
+        image_bytes = response_img.images[0]._image_bytes
+        return normalize_image(image_bytes) if IMAGE_NORMALIZE else image_bytes
+
+    extension, content_type = IMAGE_FILE_TYPES[IMAGE_FORMAT] if IMAGE_NORMALIZE else ("png", "image/png")
+    print(f"    - Image creation for scene {scene_num}...")
+    if asset_cache.enabled:
+        # ภาพที่ปรับแล้วขึ้นกับความละเอียดและการบีบอัด จึงต้องอยู่ใน key ด้วย
+        render_params = {'size': f"{RENDER_WIDTH}x{RENDER_HEIGHT}", 'format': IMAGE_FORMAT, 'quality': IMAGE_QUALITY} if IMAGE_NORMALIZE else {}
+        key = cache_key('image', image_prompt, model=IMAGE_MODEL_NAME, aspect_ratio=IMAGE_ASPECT_RATIO, **render_params)
+        image_url, image_blob, hit = asset_cache.get_or_create(key, extension, content_type, generate, meta={'prompt': image_prompt})
+        if hit:
+            print(f"    - Image for scene {scene_num} served from cache.")
+            return image_url, image_blob
+    else:
+        image_url, image_blob = upload_to_gcs(generate(), f"{doc_id}/scene_{scene_num}.{extension}", content_type)
+    print(f"    - Image for scene {scene_num} created and uploaded.")
+    return image_url, image_blob
+
+def create_scene_audio(doc_id, scene_num, narration):
+    """สร้างเสียงบรรยายของฉากด้วย TTS (หรือดึงจาก cache) คืนค่า (url, blob_name) ของเสียง"""
+    def call_tts():
+        from google.cloud import texttospeech
+
+        voice, audio_config = tts_params.get()
+        with span('tts'):
+            s_input = texttospeech.SynthesisInput(text=narration)
+            return tts_client.synthesize_speech(input=s_input, voice=voice, audio_config=audio_config)
+
+    def generate():
+        response_tts = tts_limiter.call(call_tts)
+        return response_tts.audio_content
+
+    print(f"    - Audio creation for scene {scene_num}...")
+    if asset_cache.enabled:
+        key = audio_cache_key(narration)
+        audio_url, audio_blob, hit = asset_cache.get_or_create(key, "mp3", "audio/mpeg", generate)
+        if hit:
+            print(f"    - Audio for scene {scene_num} served from cache.")
+            return audio_url, audio_blob
+    else:
+        audio_url, audio_blob = upload_to_gcs(generate(), f"{doc_id}/scene_{scene_num}.mp3", "audio/mpeg")
+    print(f"    - Audio for scene {scene_num} created and uploaded.")
+    return audio_url, audio_blob
+
+def audio_cache_key(narration):
+    return cache_key('audio', narration, language=TTS_LANGUAGE_CODE, voice=TTS_VOICE_NAME, encoding="MP3")
+
+def synthesize_batch(items):
+    """สังเคราะห์เสียงของหลายฉากใน request เดียว แล้วตัดตาม timepoint ของ <mark> คืน dict scene_num -> MP3 bytes"""
+    from google.cloud import texttospeech_v1beta1
+
+    voice, audio_config = tts_batch_params.get()
+    request = texttospeech_v1beta1.SynthesizeSpeechRequest(
+        input=texttospeech_v1beta1.SynthesisInput(ssml=build_ssml(items)),
+        voice=voice,
+        audio_config=audio_config,
+        enable_time_pointing=[texttospeech_v1beta1.SynthesizeSpeechRequest.TimepointType.SSML_MARK],
+    )
+    def call_tts():
+        with span('tts_batch'):
+            return tts_batch_client.synthesize_speech(request=request)
+
+    response = tts_limiter.call(call_tts)
+    mark_times = {timepoint.mark_name: timepoint.time_seconds for timepoint in response.timepoints}
+    missing_marks = [scene_num for scene_num, _ in items[1:] if scene_mark(scene_num) not in mark_times]
+    if missing_marks:
+        raise ValueError(f"TTS batch response is missing timepoints for scenes {missing_marks}.")
+    # ฉากแรกเริ่มที่ 0 และฉากสุดท้ายเก็บเสียงจนจบไฟล์ (รวมช่วงเงียบท้ายประโยค)
+    cut_seconds = [0.0] + [mark_times[scene_mark(scene_num)] for scene_num, _ in items[1:]] + [None]
+    clips = split_wav(response.audio_content, cut_seconds)
+    return {scene_num: wav_to_mp3(clip) for (scene_num, _), clip in zip(items, clips)}
+
+def create_audio_batch(doc_id, items):
+    """
+    สร้างเสียงของหลายฉาก (items = [(scene_num, narration)]) คืน dict scene_num -> (url, blob_name)
+    ฉากที่มีใน cache แล้วจะไม่ถูกส่งไปสังเคราะห์ซ้ำ
+    """
+    results = {}
+    pending = []
+    for scene_num, narration in items:
+        cached = asset_cache.lookup(audio_cache_key(narration)) if asset_cache.enabled else None
+        if cached:
+            asset_cache.record(True)
+            results[scene_num] = cached
+            print(f"    - Audio for scene {scene_num} served from cache.")
+        else:
+            pending.append((scene_num, narration))
+    if not pending:
+        return results
+
+    print(f"    - Audio creation for scenes {[scene_num for scene_num, _ in pending]} in one batched request...")
+    clips = synthesize_batch(pending)
+    for scene_num, narration in pending:
+        if asset_cache.enabled:
+            asset_cache.record(False)
+            results[scene_num] = asset_cache.store(audio_cache_key(narration), clips[scene_num], "mp3", "audio/mpeg")
+        else:
+            results[scene_num] = upload_to_gcs(clips[scene_num], f"{doc_id}/scene_{scene_num}.mp3", "audio/mpeg")
+    print(f"    - Audio for {len(pending)} scenes created and uploaded.")
+    return results
+
+def resolve_audio_batch(doc_id, items, scene_futures):
+    """รันใน tts pool: สร้างเสียงทั้งกลุ่มแล้วส่งผลให้ Future ของแต่ละฉาก"""
+    try:
+        results = create_audio_batch(doc_id, items)
+    except Exception as e:
+        results = {scene_num: e for scene_num in scene_futures}
+    for scene_num, future in scene_futures.items():
+        if future.done(): # ถูกยกเลิกไปแล้ว
+            continue
+        if isinstance(results[scene_num], Exception):
+            future.set_exception(results[scene_num])
+        else:
+            future.set_result(results[scene_num])
+
+def submit_audio(doc_id, items):
+    """
+    ส่งงานสร้างเสียงของหลายฉากเข้า tts pool คืน list ของ (scene_num, Future) ต่อฉาก
+    โหมด TTS_BATCHING จะรวมฉากที่ติดกันเป็นกลุ่ม แต่ผลที่ได้ยังเป็นไฟล์ MP3 แยกรายฉากเหมือนเดิม
+    """
+    if not TTS_BATCHING:
+        return [(scene_num, tts_executor.submit(create_scene_audio, doc_id, scene_num, narration)) for scene_num, narration in items]
+
+    submitted = []
+    for batch in plan_batches(items):
+        if len(batch) == 1:
+            scene_num, narration = batch[0]
+            submitted.append((scene_num, tts_executor.submit(create_scene_audio, doc_id, scene_num, narration)))
+            continue
+        scene_futures = {scene_num: Future() for scene_num, _ in batch}
+        tts_executor.submit(resolve_audio_batch, doc_id, batch, scene_futures)
+        submitted.extend(scene_futures.items())
+    return submitted
+
+CHECKPOINT_FIELDS = ('image_url', 'image_blob', 'render_resolution', 'audio_url', 'audio_blob', 'error')
+
+def checkpoint_scene(doc_id, scene_num, scene, subcollection=False):
+    """บันทึกผลของฉากที่เสร็จแล้วทันที (อัปเดตเฉพาะ field ของฉากนั้น) เพื่อให้ทำต่อได้ถ้า Worker ล่ม"""
+    doc_ref = db.collection('projects').document(doc_id)
+    if subcollection:
+        # โปรเจกต์แบบ subcollection เขียนลงเอกสารของฉากนั้นโดยตรง (error เดิมจะถูกลบถ้ารอบนี้สำเร็จ)
+        update_scene(db, doc_ref, scene_num - 1, {key: scene.get(key) for key in CHECKPOINT_FIELDS})
+        return
+    checkpoint = {
+        key: scene.get(key)
+        for key in CHECKPOINT_FIELDS
+        if key in scene
+    }
+    doc_ref.update({f'scene_assets.scene_{scene_num}': checkpoint})
 
 def process_asset_request(doc_id, doc_data):
-    scenes = doc_data.get('scenes', [])
-    updated_scenes = []
-    
-    for i, scene in enumerate(scenes):
-        scene_num = i + 1
-        print(f"  - Processing assets for scene {scene_num}/{len(scenes)}...")
-        narration = scene.get("narration")
-        image_prompt = scene.get("image_prompt")
-        
-        # --- แก้ไข Path ตรงนี้ ---
-        image_path = os.path.join(TEMP_FOLDER, f"temp_image_{doc_id}_{scene_num}.png")
-        audio_path = os.path.join(TEMP_FOLDER, f"temp_audio_{doc_id}_{scene_num}.mp3")
-        # -------------------------
-        
-        try:
-            # สร้างภาพ
-            if image_prompt:
-                print(f"    - Image creation for scene {scene_num}...")
-                response_img = image_model.generate_images(prompt=image_prompt, number_of_images=1, aspect_ratio="16:9")
-                response_img.images[0].save(location=image_path)
-                image_url = upload_to_gcs(image_path, f"{doc_id}/scene_{scene_num}.png")
-                os.remove(image_path)
-                scene['image_url'] = image_url
-                print(f"    - Image for scene {scene_num} created and uploaded.")
-            else:
+    doc_ref = db.collection('projects').document(doc_id)
+    checkpoints = doc_data.get('scene_assets', {})
+    subcollection = uses_subcollection(doc_data)
+    scenes = []
+    futures = {}
+    remaining = {}
+    errors = {}
+
+    def add_scenes(new_scenes):
+        """
+        ส่งงานสร้างภาพและเสียงของฉากที่ยังไม่เคยเห็นเข้า pool (จำกัดจำนวนตาม backend)
+        ฉากที่มี checkpoint จากรอบก่อนแล้วจะข้ามไป ทำใหม่เฉพาะ asset ที่ยังขาดหรือเคย error
+        """
+        narrations = []
+        for scene in new_scenes:
+            i = len(scenes)
+            scene_num = i + 1
+            scenes.append(scene)
+            scene.update(checkpoints.get(f'scene_{scene_num}', {}))
+            if not scene.get('image_prompt'):
                 scene['image_url'] = None
-            
-            # สร้างเสียง
-            if narration:
-                print(f"    - Audio creation for scene {scene_num}...")
-                s_input = texttospeech.SynthesisInput(text=narration)
-                voice = texttospeech.VoiceSelectionParams(language_code="en-US", name="en-US-Neural2-J")
-                a_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
-                response_tts = tts_client.synthesize_speech(input=s_input, voice=voice, audio_config=a_config)
-                with open(audio_path, "wb") as out:
-                    out.write(response_tts.audio_content)
-                audio_url = upload_to_gcs(audio_path, f"{doc_id}/scene_{scene_num}.mp3")
-                os.remove(audio_path)
-                scene['audio_url'] = audio_url
-                print(f"    - Audio for scene {scene_num} created and uploaded.")
-            else:
+            if not scene.get('narration'):
                 scene['audio_url'] = None
-                
+
+            missing = missing_assets(scene)
+            if not missing:
+                continue
+            scene.pop('error', None)
+            errors[i] = []
+            remaining[i] = len(missing)
+            if 'image' in missing:
+                futures[image_executor.submit(create_scene_image, doc_id, scene_num, scene['image_prompt'])] = (i, 'image')
+            if 'audio' in missing:
+                narrations.append((scene_num, scene['narration']))
+        for scene_num, future in submit_audio(doc_id, narrations):
+            futures[future] = (scene_num - 1, 'audio')
+
+    def collect(future):
+        """เก็บผลของ asset ที่เสร็จแล้ว และ checkpoint ฉากที่ครบทั้งภาพและเสียงแล้ว"""
+        i, kind = futures.pop(future)
+        scene_num = i + 1
+        scene = scenes[i]
+        try:
+            # เก็บทั้ง URL (สำหรับแสดงผล) และชื่อ blob (ให้ Video Worker ดาวน์โหลดโดยไม่ต้องแกะจาก URL)
+            scene[f'{kind}_url'], scene[f'{kind}_blob'] = future.result()
+            if kind == 'image':
+                # บันทึกความละเอียดที่ภาพถูกปรับไว้ (None = ภาพต้นฉบับจาก Imagen)
+                scene['render_resolution'] = f"{RENDER_WIDTH}x{RENDER_HEIGHT}" if IMAGE_NORMALIZE else None
         except Exception as e:
             print(f"    - ❌ An error occurred during asset creation for scene {scene_num}: {e}")
-            scene['error'] = str(e)
-            
-        updated_scenes.append(scene)
+            errors[i].append(str(e))
+
+        remaining[i] -= 1
+        if remaining[i] == 0:
+            if errors[i]:
+                scene['error'] = "; ".join(errors[i])
+            try:
+                checkpoint_scene(doc_id, scene_num, scene, subcollection)
+            except Exception as e:
+                print(f"    - ⚠️ Could not checkpoint scene {scene_num}: {e}")
+
+    add_scenes(read_scenes(doc_ref, doc_data))
+    print(f"  - Submitting assets for {len(remaining)} scenes ({len(scenes) - len(remaining)} already done)...")
+
+    # โหมด streaming: บทยังเขียนไม่จบ ให้ติดตามเอกสารและเริ่มทำฉากใหม่ทันทีที่เข้ามา
+    streaming = PIPELINE_STREAMING and bool(doc_data.get('script_streaming'))
+    watcher = DocumentWatcher(doc_ref) if streaming else None
+    handed_off = False
+    try:
+        while futures or streaming:
+            check_lease() # หยุดทันทีถ้า heartbeat พบว่างานถูกคืนไปให้ Worker อื่นแล้ว
+            if streaming:
+                latest = watcher.latest()
+                if latest.get('status') == 'script_failed':
+                    print(f"  - ❌ Script stream failed for project {doc_id}. Stopping asset production.")
+                    for future in futures:
+                        future.cancel()
+                    return
+                known_scenes = len(scenes)
+                if not subcollection or latest.get('scene_count', 0) > known_scenes:
+                    add_scenes(read_scenes(doc_ref, latest, start=known_scenes))
+                if len(scenes) > known_scenes:
+                    print(f"  - Received scenes {known_scenes + 1}-{len(scenes)} from the script stream.")
+                streaming = bool(latest.get('script_streaming'))
+
+            if futures:
+                done, _ = wait(list(futures), timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            elif streaming and not watcher.wait_for_change():
+                # Script Worker หายไปหลังส่งต่องาน: คืนให้เขียนบทใหม่ (asset ที่ checkpoint ไว้อาจไม่ตรงกับบทใหม่จึงล้างทิ้ง)
+                new_status = return_to_upstream(
+                    doc_ref, 'assets', doc_data, "Script stream stalled: no new scenes were received.",
+                    {'scene_assets': firestore.DELETE_FIELD}
+                )
+                print(f"  - ❌ Script stream stalled for project {doc_id}; moved to '{new_status}'.")
+                for future in futures:
+                    future.cancel()
+                return
+
+            # บทครบแล้วและมีฉากที่พร้อม: ส่งงานให้ Compiler เริ่ม encode ระหว่างที่ฉากที่เหลือยังทำอยู่
+            if PIPELINE_STREAMING and not streaming and not handed_off and futures \
+                    and any(remaining.get(i, 0) == 0 for i in range(len(scenes))):
+                handoff_update = {'status': 'compile_pending', 'assets_streaming': True}
+                in_progress = [i for i, count in remaining.items() if count > 0]
+                # ลบผลเก่าของฉากที่กำลังทำใหม่ เพื่อไม่ให้ Compiler หยิบไปใช้
+                if subcollection:
+                    clear_scene_fields(db, doc_ref, in_progress, ['error'])
+                else:
+                    for i in in_progress:
+                        handoff_update[f'scene_assets.scene_{i + 1}'] = firestore.DELETE_FIELD
+                fenced_update(doc_ref, handoff_update)
+                handed_off = True
+                print(f"  - ⏩ Handed project {doc_id} to the compiler while {len(futures)} assets finish.")
+    finally:
+        if watcher:
+            watcher.close()
 
     # อัปเดต Firestore ด้วยข้อมูลใหม่ทั้งหมด
     print(f"  - Updating Firestore for project {doc_id}...")
-    db.collection('projects').document(doc_id).update({
-        'scenes': updated_scenes,
-        'status': 'compile_pending',
+    final_update = {
+        'scene_assets': firestore.DELETE_FIELD, # checkpoint ไม่จำเป็นแล้วเมื่อบันทึก scenes ครบ
         'assets_completed_at': firestore.SERVER_TIMESTAMP
-    })
+    }
+    # หลังส่งต่องานแล้วสถานะไม่ใช่ assets_processing จึงเขียนตรงๆ ไม่เช่นนั้นเขียนเฉพาะเมื่อยังถือ lease อยู่
+    fence = None
+    if handed_off:
+        final_update['assets_streaming'] = False # Compiler รับงานไปแล้ว ไม่เปลี่ยนสถานะทับ
+    else:
+        final_update['status'] = 'compile_pending'
+        fence = job_fence()
+    if subcollection:
+        # ทุกฉากถูกบันทึกลงเอกสารของตัวเองแล้วตอน checkpoint เหลือแค่อัปเดตสรุปที่เอกสารโปรเจกต์
+        write = {**final_update, **summarize(scenes)}
+        if fence:
+            fence(lambda transaction: transaction.update(doc_ref, write))
+        else:
+            doc_ref.update(write)
+    else:
+        write_scenes(db, doc_ref, scenes, final_update, storage='embedded', fence=fence)
     print(f"  - ✅ Project {doc_id} asset production completed.")
 
+    if asset_cache.enabled:
+        stats = asset_cache.stats()
+        print(f"  - Asset cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {stats['hit_rate']:.0%}).")
+        asset_cache.flush_stats()
+
 
 # --- 3. Main Loop ---
 def main_loop():
+    try:
+        init()
+    except Exception as e:
+        print(f"❌ Worker failed to initialize: {e}")
+        exit()
+    report_startup('assets')
+    preload(bucket, image_model, tts_batch_client if TTS_BATCHING else tts_client)
     print("\n👂 Asset Worker is listening for projects with status 'assets_pending'...")
-    while True:
-        try:
-            query = db.collection('projects').where('status', '==', 'assets_pending').limit(1)
-            docs = query.stream()
-            
-            found_job = False
-            for doc in docs:
-                found_job = True
-                doc_id = doc.id
-                print(f"\n✨ Found an asset job! Project ID: {doc_id}")
-                
-                db.collection('projects').document(doc_id).update({'status': 'assets_processing'})
-                process_asset_request(doc_id, doc.to_dict())
-            
-            if not found_job:
-                print(".", end="", flush=True)
-                time.sleep(10)
-        except Exception as e:
-            print(f"\n\n🚨 An critical error in asset worker main loop: {e}\n\n")
-            time.sleep(30)
+    run_worker(db, 'assets', process_asset_request, WORKER_ID,
+               found_message="✨ Found an asset job!")
 
 if __name__ == "__main__":
     main_loop()
\ No newline at end of file
@@ -0,0 +1,230 @@
+import io
+import os
+import re
+import math
+import time
+import wave
+import array
+import shutil
+import hashlib
+import pathlib
+from types import SimpleNamespace
+
+# --- 1. การตั้งค่า ---
+# PIPELINE_BACKEND: 'gcp' (ค่าเริ่มต้น) หรือ 'local' สำหรับรันทั้ง pipeline บนเครื่องโดยไม่ต่อ GCP
+#   local = Firestore Emulator (ต้องตั้ง FIRESTORE_EMULATOR_HOST), GCS เป็นโฟลเดอร์ในเครื่อง,
+#           Imagen และ TTS เป็นตัวจำลองที่ให้ผลเหมือนเดิมทุกครั้งและหน่วงเวลาได้
+PIPELINE_BACKEND = os.environ.get("PIPELINE_BACKEND", "gcp")
+LOCAL_GCS_ROOT = os.environ.get("LOCAL_GCS_ROOT", "local_gcs")
+FAKE_IMAGE_LATENCY_SECONDS = float(os.environ.get("FAKE_IMAGE_LATENCY_SECONDS", "2.0"))
+FAKE_TTS_LATENCY_SECONDS = float(os.environ.get("FAKE_TTS_LATENCY_SECONDS", "0.5"))
+FAKE_DOWNLOAD_LATENCY_SECONDS = float(os.environ.get("FAKE_DOWNLOAD_LATENCY_SECONDS", "0"))  # จำลองเวลาดาวน์โหลดจาก GCS
+FAKE_IMAGE_SIZE = (1408, 768)  # ขนาดภาพ 16:9 ที่ Imagen สร้างให้
+FAKE_TTS_SECONDS_PER_WORD = 0.35
+FAKE_TTS_SAMPLE_RATE = 24000
+
+
+def is_local():
+    return PIPELINE_BACKEND == "local"
+
+
+# --- 2. GCS แบบโฟลเดอร์ในเครื่อง (รองรับเฉพาะ method ที่ Worker ใช้) ---
+
+class _LocalUpload(io.RawIOBase):
+    """เขียนลงไฟล์ชั่วคราวแล้วค่อยย้ายเข้าที่ตอน close เหมือน resumable upload ที่ยืนยันไฟล์ตอนจบ"""
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(f"{path}.uploading", "wb")
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            os.replace(f"{self._path}.uploading", self._path)
+        super().close()
+
+    def abort(self):
+        """ทิ้งไฟล์ที่เขียนไม่ครบโดยไม่ย้ายเข้าที่ (เทียบกับการยกเลิก resumable upload)"""
+        if not self.closed:
+            self._file.close()
+            os.remove(f"{self._path}.uploading")
+        super().close()
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.cache_control = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def public_url(self):
+        return pathlib.Path(self.path).resolve().as_uri()
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if self.exists() else None
+
+    def _prepare(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def upload_from_string(self, data, content_type=None):
+        self._prepare()
+        with open(self.path, "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+
+    def upload_from_filename(self, filename, content_type=None):
+        self._prepare()
+        shutil.copyfile(filename, self.path)
+
+    def download_to_filename(self, filename):
+        time.sleep(FAKE_DOWNLOAD_LATENCY_SECONDS)
+        shutil.copyfile(self.path, filename)
+
+    def download_as_text(self):
+        with open(self.path, encoding="utf-8") as f:
+            return f.read()
+
+    def open(self, mode="rb", **kwargs):
+        if "w" not in mode:
+            return open(self.path, mode)
+        self._prepare()
+        return _LocalUpload(self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def delete(self):
+        os.remove(self.path)
+
+    def reload(self):
+        pass
+
+    def generate_signed_url(self, **kwargs):
+        return self.public_url
+
+
+class LocalBucket:
+    def __init__(self, root, name):
+        self.name = name
+        self.root = os.path.join(root, name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def list_blobs(self, prefix=""):
+        for directory, _, files in os.walk(self.root):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(directory, file_name), self.root).replace(os.sep, "/")
+                if name.startswith(prefix) and not name.endswith(".uploading"):
+                    yield LocalBlob(self, name)
+
+
+# --- 3. Imagen และ TTS จำลอง (ผลขึ้นกับ input เท่านั้น) ---
+
+class FakeImageModel:
+    """ให้ผลแบบเดียวกับ ImageGenerationModel.generate_images: ภาพสีเรียบที่สีมาจาก hash ของ prompt"""
+
+    def generate_images(self, prompt, number_of_images=1, aspect_ratio=None):
+        from PIL import Image, ImageDraw
+
+        time.sleep(FAKE_IMAGE_LATENCY_SECONDS)
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        image = Image.new("RGB", FAKE_IMAGE_SIZE, color=tuple(digest[:3]))
+        ImageDraw.Draw(image).text((40, 40), prompt[:80], fill=(255, 255, 255))
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+        images = [SimpleNamespace(_image_bytes=output.getvalue()) for _ in range(number_of_images)]
+        return SimpleNamespace(images=images)
+
+
+def _speech_seconds(text):
+    return max(1.0, len(text.split()) * FAKE_TTS_SECONDS_PER_WORD)
+
+
+def _tone_wav(seconds, seed_text):
+    """เสียง sine (WAV mono 16-bit) ความถี่มาจาก hash ของข้อความ"""
+    frequency = 200 + hashlib.sha256(seed_text.encode("utf-8")).digest()[0]
+    samples = array.array("h", (
+        int(6000 * math.sin(2 * math.pi * frequency * i / FAKE_TTS_SAMPLE_RATE))
+        for i in range(int(seconds * FAKE_TTS_SAMPLE_RATE))
+    ))
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(FAKE_TTS_SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return output.getvalue()
+
+
+class FakeTTSClient:
+    """
+    ให้ผลแบบเดียวกับ TextToSpeechClient.synthesize_speech ความยาวเสียงตามจำนวนคำ
+    คืนเป็น WAV เสมอ (ffmpeg ดูจาก header ของไฟล์จึงอ่านได้แม้ชื่อไฟล์เป็น .mp3)
+    ถ้าส่งเป็น request แบบ SSML จะคืน timepoint ของ <mark> ด้วย (ใช้กับ TTS_BATCHING)
+    """
+
+    def synthesize_speech(self, input=None, voice=None, audio_config=None, request=None):
+        time.sleep(FAKE_TTS_LATENCY_SECONDS)
+        if request is None:
+            text = input.text or input.ssml
+            return SimpleNamespace(audio_content=_tone_wav(_speech_seconds(text), text), timepoints=[])
+
+        ssml = request.input.ssml
+        timepoints = []
+        elapsed = 0.0
+        for part in re.split(r'(<mark name="[^"]+"/>)', ssml):
+            mark = re.fullmatch(r'<mark name="([^"]+)"/>', part)
+            if mark:
+                timepoints.append(SimpleNamespace(mark_name=mark.group(1), time_seconds=elapsed))
+                continue
+            text = re.sub(r"<[^>]+>", " ", part).strip()
+            if text:
+                elapsed += _speech_seconds(text)
+        return SimpleNamespace(audio_content=_tone_wav(elapsed, ssml), timepoints=timepoints)
+
+
+# --- 4. ตัวสร้าง client ที่ Worker เรียกใช้ ---
+
+def make_firestore(project_id, key_file_path):
+    if is_local() and not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        raise RuntimeError("PIPELINE_BACKEND=local needs FIRESTORE_EMULATOR_HOST (Firestore Emulator).")
+    from job_queue import connect_firestore
+    return connect_firestore(project_id, key_file_path)
+
+
+def make_bucket(project_id, bucket_name, key_file_path=""):
+    """เปิด Bucket ด้วยไฟล์ key โดยตรงถ้ามี ไม่เช่นนั้นใช้ ADC (ไม่พึ่ง GOOGLE_APPLICATION_CREDENTIALS ที่ connect_firestore ตั้งไว้)"""
+    if is_local():
+        return LocalBucket(LOCAL_GCS_ROOT, bucket_name)
+    from google.cloud import storage
+    if key_file_path:
+        return storage.Client.from_service_account_json(key_file_path, project=project_id).bucket(bucket_name)
+    return storage.Client(project=project_id).bucket(bucket_name)
+
+
+def make_image_model(project_id, location, model_name):
+    if is_local():
+        return FakeImageModel()
+    import vertexai
+    from vertexai.preview.vision_models import ImageGenerationModel
+    vertexai.init(project=project_id, location=location)
+    return ImageGenerationModel.from_pretrained(model_name)
+
+
+def make_tts_client(beta=False):
+    if is_local():
+        return FakeTTSClient()
+    from google.cloud import texttospeech, texttospeech_v1beta1
+    return (texttospeech_v1beta1 if beta else texttospeech).TextToSpeechClient()
@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import requests
+from google.cloud import firestore
+from runtime import GCP_PROJECT_ID
+
+# วัด throughput ของทั้ง pipeline (Script -> Asset -> Compile) บนเครื่องเดียวโดยไม่ต่อ GCP
+# ใช้ Firestore Emulator, GCS แบบโฟลเดอร์, stub script server และ Imagen/TTS จำลอง (ดู backends.py)
+# วิธีใช้:
+#   gcloud emulators firestore start --host-port=localhost:8080
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmark_pipeline.py [จำนวนโปรเจกต์] [จำนวนฉากต่อโปรเจกต์]
+# ปรับความหน่วงของ backend จำลองได้ด้วย STUB_LATENCY_SECONDS, FAKE_IMAGE_LATENCY_SECONDS, FAKE_TTS_LATENCY_SECONDS,
+# FAKE_DOWNLOAD_LATENCY_SECONDS
+# ตรวจว่า Video Worker ดาวน์โหลดหลายฉากพร้อมกันบน engine MoviePy (download_overlap > 1 = ดาวน์โหลดซ้อนกัน):
+#   RENDER_ENGINE=moviepy FAKE_DOWNLOAD_LATENCY_SECONDS=1 FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmark_pipeline.py 3 8
+# ผลลัพธ์บรรทัดสุดท้าย (BENCHMARK_RESULT=...) เป็น JSON ไว้เทียบกันระหว่างรอบ
+
+NUM_PROJECTS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+SCENES_PER_PROJECT = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+STUB_PORT = 8765
+COMPILE_METRICS_URL = "http://localhost:9103/metrics"  # /metrics ของ Video Worker (ดู metrics.METRICS_PORTS)
+TIMEOUT_SECONDS = int(os.environ.get("BENCHMARK_TIMEOUT_SECONDS", "3600"))
+POLL_SECONDS = 1.0
+WORKER_SCRIPTS = ("script_worker.py", "asset_worker.py", "video_worker.py")
+# เวลาที่แต่ละแผนกบันทึกไว้ในเอกสาร (นับจากเวลาที่แผนกก่อนหน้าส่งงานมา รวมเวลารอคิว)
+STAGE_TIMESTAMPS = (
+    ('script', 'created_at', 'script_completed_at'),
+    ('assets', 'script_completed_at', 'assets_completed_at'),
+    ('compile', 'assets_completed_at', 'completed_at'),
+)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def process_tree_rss_kb(pid):
+    """RSS รวม (KB) ของ process และ process ลูกทั้งหมด (เช่น ffmpeg) อ่านจาก /proc (Linux)"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            children.setdefault(parent, []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+def scrape_sum(metrics_text, sample):
+    """อ่านค่าของ sample (เช่น 'pipeline_job_seconds_sum{stage="compile"}') จากข้อความ /metrics"""
+    for line in metrics_text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def download_overlap():
+    """
+    เวลาดาวน์โหลดรวมของทุกฉาก หารด้วยเวลาทำงานรวมของแผนก compile
+    ถ้าดาวน์โหลดทีละฉากสลับกับการ encode ค่าจะน้อยกว่า 1 ถ้าดาวน์โหลดขนานกันค่าจะมากกว่า 1 ได้
+    """
+    try:
+        metrics_text = requests.get(COMPILE_METRICS_URL, timeout=5).text
+    except requests.RequestException as e:
+        print(f"⚠️ Could not read compile metrics: {e}")
+        return None
+    job_seconds = scrape_sum(metrics_text, 'pipeline_job_seconds_sum{stage="compile"}')
+    download_seconds = scrape_sum(metrics_text, 'pipeline_call_seconds_sum{call="gcs_download"}')
+    return round(download_seconds / job_seconds, 2) if job_seconds else None
+
+
+def reset_emulator(emulator_host):
+    """ล้างข้อมูลทั้งหมดใน Firestore Emulator ก่อนเริ่ม (ไม่ให้งานเก่าปนกับรอบนี้)"""
+    url = f"http://{emulator_host}/emulator/v1/projects/{GCP_PROJECT_ID}/databases/(default)/documents"
+    requests.delete(url, timeout=10).raise_for_status()
+
+
+def main():
+    emulator_host = os.environ.get("FIRESTORE_EMULATOR_HOST")
+    if not emulator_host:
+        print("❌ Please set FIRESTORE_EMULATOR_HOST before running this benchmark.")
+        sys.exit(1)
+
+    work_dir = tempfile.mkdtemp(prefix="pipeline_bench_")
+    env = dict(
+        os.environ,
+        PIPELINE_BACKEND="local",
+        LOCAL_GCS_ROOT=os.path.join(work_dir, "gcs"),
+        SCRIPT_API_URL=f"http://localhost:{STUB_PORT}/generate",
+        STUB_PORT=str(STUB_PORT),
+        STUB_SCENES=str(SCENES_PER_PROJECT),
+        PYTHONUNBUFFERED="1",
+    )
+    env.setdefault("ASSET_CACHE_ENABLED", "0")  # ภาพและเสียงจำลองซ้ำกันทุกโปรเจกต์ ถ้าเปิด cache จะวัดได้เร็วเกินจริง
+
+    reset_emulator(emulator_host)
+    db = firestore.Client(project=GCP_PROJECT_ID)
+    processes = {}
+    peak_rss_kb = {}
+    try:
+        for name in ("stub_script_server.py",) + WORKER_SCRIPTS:
+            log = open(os.path.join(work_dir, f"{name}.log"), "w")
+            processes[name] = subprocess.Popen(
+                [sys.executable, name], env=env, stdout=log, stderr=subprocess.STDOUT,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            )
+            peak_rss_kb[name] = 0
+        time.sleep(3)  # รอให้ Worker เชื่อมต่อและ stub server เปิด port
+
+        print(f"🏭 Submitting {NUM_PROJECTS} projects with {SCENES_PER_PROJECT} scenes each (logs in {work_dir})...")
+        project_ids = []
+        for i in range(NUM_PROJECTS):
+            _, doc_ref = db.collection('projects').add({
+                'topic': f"benchmark topic {i}",
+                'style': "benchmark",
+                'status': 'script_pending',
+                'created_at': firestore.SERVER_TIMESTAMP,
+            })
+            project_ids.append(doc_ref.id)
+
+        started = time.monotonic()
+        finished = {}
+        while len(finished) < NUM_PROJECTS and time.monotonic() - started < TIMEOUT_SECONDS:
+            for name, process in processes.items():
+                if process.poll() is not None:
+                    raise RuntimeError(f"{name} exited with code {process.returncode}; see {work_dir}/{name}.log")
+                peak_rss_kb[name] = max(peak_rss_kb[name], process_tree_rss_kb(process.pid))
+            for project_id in project_ids:
+                if project_id in finished:
+                    continue
+                doc_data = db.collection('projects').document(project_id).get().to_dict() or {}
+                if doc_data.get('status') == 'completed' or str(doc_data.get('status', '')).endswith('_failed'):
+                    finished[project_id] = doc_data
+            time.sleep(POLL_SECONDS)
+        elapsed = time.monotonic() - started
+        overlap = download_overlap()
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    completed = [doc for doc in finished.values() if doc.get('status') == 'completed']
+    stage_latencies = {stage: [] for stage, _, _ in STAGE_TIMESTAMPS}
+    for doc_data in completed:
+        for stage, start_field, end_field in STAGE_TIMESTAMPS:
+            if doc_data.get(start_field) and doc_data.get(end_field):
+                stage_latencies[stage].append((doc_data[end_field] - doc_data[start_field]).total_seconds())
+
+    result = {
+        'projects': NUM_PROJECTS,
+        'scenes_per_project': SCENES_PER_PROJECT,
+        'completed': len(completed),
+        'failed': len(finished) - len(completed),
+        'timed_out': NUM_PROJECTS - len(finished),
+        'elapsed_seconds': round(elapsed, 1),
+        'projects_per_hour': round(len(completed) / elapsed * 3600, 1) if elapsed else 0.0,
+        'stage_latency_seconds': {
+            stage: {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95)}
+            for stage, values in stage_latencies.items()
+        },
+        'peak_rss_mb': {name: round(kb / 1024, 1) for name, kb in peak_rss_kb.items()},
+        'render_engine': env.get("RENDER_ENGINE", "moviepy"),
+        'download_overlap': overlap,
+    }
+
+    print("\n📊 Pipeline benchmark results")
+    print(f"  completed {result['completed']}/{NUM_PROJECTS} (failed {result['failed']}, timed out {result['timed_out']}) "
+          f"in {result['elapsed_seconds']}s -> {result['projects_per_hour']} projects/hour")
+    print(f"  {'stage':<10}{'p50 s':>10}{'p95 s':>10}")
+    for stage, latency in result['stage_latency_seconds'].items():
+        p50 = f"{latency['p50']:.1f}" if latency['p50'] is not None else "-"
+        p95 = f"{latency['p95']:.1f}" if latency['p95'] is not None else "-"
+        print(f"  {stage:<10}{p50:>10}{p95:>10}")
+    if overlap is not None:
+        print(f"  download overlap on {result['render_engine']}: {overlap:.2f}x (download seconds / compile seconds)")
+    print(f"  {'process':<24}{'peak RSS MB':>12}")
+    for name, rss_mb in result['peak_rss_mb'].items():
+        print(f"  {name:<24}{rss_mb:>12.1f}")
+    print("BENCHMARK_RESULT=" + json.dumps(result))
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
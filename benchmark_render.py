@@ -0,0 +1,132 @@
+import os
+import sys
+import math
+import time
+import wave
+import struct
+import shutil
+import resource
+import tempfile
+import subprocess
+from PIL import Image, ImageDraw
+from video_render import render_video
+
+# เปรียบเทียบความเร็ว Render ระหว่าง MoviePy กับ ffmpeg ด้วยฉากจำลอง (ไม่ต้องต่อ GCP)
+# วิธีใช้: python benchmark_render.py [จำนวนฉาก] [ความยาวเสียงต่อฉาก (วินาที)]
+# ตรวจว่าหน่วยความจำของ MoviePy ไม่โตตามจำนวนฉาก (exit code 1 ถ้าโตเกิน RSS_TOLERANCE):
+#   python benchmark_render.py --memory [จำนวนฉาก] [ความยาวเสียงต่อฉาก (วินาที)]
+
+ARGS = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+NUM_SCENES = int(ARGS[0]) if len(ARGS) > 0 else 12
+SCENE_SECONDS = float(ARGS[1]) if len(ARGS) > 1 else 8.0
+RSS_SCALE = 4  # เรื่องยาวกว่ากี่เท่าที่ใช้เทียบ
+RSS_TOLERANCE = 0.25  # peak RSS ของเรื่องยาวต้องไม่เกินเรื่องสั้น 25%
+IMAGE_SIZE = (1408, 768)  # ขนาดภาพ 16:9 ที่ Imagen สร้างให้
+SAMPLE_RATE = 24000
+
+
+def make_scene_image(path, scene_num):
+    """สร้างภาพทดสอบแบบไล่สีพร้อมเลขฉาก"""
+    image = Image.new("RGB", IMAGE_SIZE)
+    draw = ImageDraw.Draw(image)
+    for x in range(0, IMAGE_SIZE[0], 8):
+        draw.rectangle([x, 0, x + 8, IMAGE_SIZE[1]], fill=((x + scene_num * 40) % 256, 80, 200 - x % 200))
+    draw.text((40, 40), f"Scene {scene_num}", fill=(255, 255, 255))
+    image.save(path)
+
+
+def make_scene_audio(path, seconds, frequency):
+    """สร้างเสียง sine wave (WAV mono) ความยาวตามที่กำหนด"""
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        frames = b"".join(
+            struct.pack("<h", int(8000 * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE)))
+            for i in range(int(seconds * SAMPLE_RATE))
+        )
+        wav.writeframes(frames)
+
+
+def make_scenes(work_dir, num_scenes, scene_seconds):
+    assets = []
+    for i in range(num_scenes):
+        image_path = os.path.join(work_dir, f"scene_{i + 1}.png")
+        audio_path = os.path.join(work_dir, f"scene_{i + 1}.wav")
+        make_scene_image(image_path, i + 1)
+        make_scene_audio(audio_path, scene_seconds, 220 + 20 * i)
+        assets.append({'image': image_path, 'audio': audio_path})
+    return assets
+
+
+def measure_peak_rss():
+    """(ทำงานใน process ลูก) render ด้วย MoviePy แล้วพิมพ์ peak RSS (KB) ของ process นี้และ ffmpeg ที่มันเรียก"""
+    work_dir = tempfile.mkdtemp(prefix="render_rss_")
+    try:
+        assets = make_scenes(work_dir, NUM_SCENES, SCENE_SECONDS)
+        clip_count = render_video(assets, os.path.join(work_dir, "output.mp4"), engine="moviepy")
+        own_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print(f"PEAK_RSS_KB={own_rss} {children_rss} {clip_count}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def check_memory():
+    """render เรื่องสั้นและเรื่องยาวกว่า RSS_SCALE เท่าใน process แยกกัน แล้วเทียบ peak RSS"""
+    results = {}
+    for num_scenes in (NUM_SCENES, NUM_SCENES * RSS_SCALE):
+        print(f"🧪 Measuring peak RSS for {num_scenes} scenes...")
+        completed = subprocess.run(
+            [sys.executable, __file__, "--peak-rss", str(num_scenes), str(SCENE_SECONDS)],
+            check=True, capture_output=True, text=True
+        )
+        line = [line for line in completed.stdout.splitlines() if line.startswith("PEAK_RSS_KB=")][-1]
+        own_rss, children_rss, clip_count = (int(value) for value in line.split("=", 1)[1].split())
+        results[num_scenes] = (own_rss, children_rss)
+        print(f"   rendered {clip_count}/{num_scenes} scenes, worker {own_rss / 1024:.0f} MB, largest ffmpeg {children_rss / 1024:.0f} MB")
+        if clip_count != num_scenes:
+            # ฉากที่ render ไม่สำเร็จทำให้ RSS ต่ำเกินจริง ผลเทียบหน่วยความจำจึงใช้ไม่ได้
+            print(f"❌ MoviePy rendered only {clip_count} of {num_scenes} scenes; peak RSS comparison is meaningless.")
+            sys.exit(1)
+
+    (small_rss, _), (large_rss, _) = results.values()
+    growth = large_rss / small_rss - 1
+    if growth > RSS_TOLERANCE:
+        print(f"❌ Peak RSS grew {growth:.0%} for {RSS_SCALE}x the scenes (limit {RSS_TOLERANCE:.0%}).")
+        sys.exit(1)
+    print(f"✅ Peak RSS grew {growth:.0%} for {RSS_SCALE}x the scenes (limit {RSS_TOLERANCE:.0%}).")
+
+
+def main():
+    work_dir = tempfile.mkdtemp(prefix="render_bench_")
+    try:
+        print(f"🎬 Preparing {NUM_SCENES} synthetic scenes ({SCENE_SECONDS:.1f}s each) in {work_dir}...")
+        assets = make_scenes(work_dir, NUM_SCENES, SCENE_SECONDS)
+
+        results = []
+        for engine in ("moviepy", "ffmpeg"):
+            output_path = os.path.join(work_dir, f"output_{engine}.mp4")
+            print(f"\n⏱️  Rendering with {engine}...")
+            started = time.perf_counter()
+            clip_count = render_video(assets, output_path, engine=engine)
+            elapsed = time.perf_counter() - started
+            size_mb = os.path.getsize(output_path) / (1024 * 1024) if os.path.exists(output_path) else 0.0
+            results.append((engine, clip_count, elapsed, size_mb))
+
+        print("\n📊 Render benchmark results")
+        print(f"{'engine':<10}{'scenes':>8}{'seconds':>10}{'x realtime':>12}{'size MB':>10}")
+        video_seconds = NUM_SCENES * SCENE_SECONDS
+        for engine, clip_count, elapsed, size_mb in results:
+            print(f"{engine:<10}{clip_count:>8}{elapsed:>10.2f}{video_seconds / elapsed:>12.1f}{size_mb:>10.2f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if "--peak-rss" in sys.argv:
+        measure_peak_rss()
+    elif "--memory" in sys.argv:
+        check_memory()
+    else:
+        main()
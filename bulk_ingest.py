@@ -0,0 +1,170 @@
+import io
+import os
+import sys
+import csv
+import json
+import datetime
+from google.cloud import firestore
+from scene_store import BATCH_LIMIT
+
+# --- 1. การตั้งค่า ---
+# รับ order ทีละมากจากไฟล์ CSV (header: topic,style[,priority]) หรือ JSONL ({"topic": ..., "style": ..., "priority": ...})
+# ทุก order ในไฟล์เดียวกันได้ batch_tag เดียวกัน และ priority ที่สูงกว่าจะถูกแผนกต่างๆ หยิบก่อน (ดู job_queue.claim_job)
+MAX_TOPIC_LENGTH = 500
+MAX_STYLE_LENGTH = 200
+MAX_PRIORITY = 10  # priority 0 = ปกติ, 1..MAX_PRIORITY = ด่วน (มากกว่า = ด่วนกว่า)
+EXISTING_QUERY_CHUNK = 30  # Firestore รับค่าใน filter 'in' ได้ไม่เกิน 30 ค่าต่อ query
+
+
+def clean_text(text):
+    """ตัดช่องว่างหัวท้ายและช่องว่างซ้อน (ค่าที่บันทึกลงโปรเจกต์)"""
+    return " ".join(text.split())
+
+
+def order_key(topic, style):
+    """key สำหรับตรวจ order ซ้ำ: topic/style ที่ตัดช่องว่างแล้วและไม่สนตัวพิมพ์เล็ก-ใหญ่"""
+    return (clean_text(topic).casefold(), clean_text(style).casefold())
+
+
+def make_batch_tag():
+    return "bulk-" + datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d-%H%M%S")
+
+
+def parse_orders(text, file_name):
+    """
+    อ่าน order จากเนื้อหาไฟล์ (.csv หรือ .jsonl) คืนค่า (rows, errors)
+    rows เป็น list ของ (เลขบรรทัด, dict) ส่วน errors เป็นข้อความของบรรทัดที่อ่านไม่ได้
+    """
+    rows, errors = [], []
+    if file_name.lower().endswith(".csv"):
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames or "topic" not in [name.strip().lower() for name in reader.fieldnames]:
+            return [], ["CSV must have a header row with a 'topic' column."]
+        for row in reader:
+            rows.append((reader.line_num, {(key or "").strip().lower(): value for key, value in row.items()}))
+        return rows, errors
+
+    for line_num, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            errors.append(f"line {line_num}: invalid JSON ({e.msg})")
+            continue
+        if not isinstance(row, dict):
+            errors.append(f"line {line_num}: expected a JSON object")
+            continue
+        rows.append((line_num, row))
+    return rows, errors
+
+
+def validate_orders(rows, default_style="", default_priority=0):
+    """
+    ตรวจแต่ละแถวและตัดแถวที่ซ้ำกันในไฟล์ คืนค่า (orders, errors, duplicates)
+    order เป็น dict {'topic', 'style', 'priority'}
+    """
+    orders, errors = [], []
+    duplicates = 0
+    seen = set()
+    for line_num, row in rows:
+        topic, style = clean_text(str(row.get("topic") or "")), clean_text(str(row.get("style") or default_style or ""))
+        if not topic:
+            errors.append(f"line {line_num}: topic is empty")
+            continue
+        if len(topic) > MAX_TOPIC_LENGTH or len(style) > MAX_STYLE_LENGTH:
+            errors.append(f"line {line_num}: topic or style is too long")
+            continue
+        priority = row.get("priority")
+        try:
+            priority = default_priority if priority in (None, "") else int(priority)
+        except (TypeError, ValueError):
+            errors.append(f"line {line_num}: priority must be a whole number")
+            continue
+        if not 0 <= priority <= MAX_PRIORITY:
+            errors.append(f"line {line_num}: priority must be between 0 and {MAX_PRIORITY}")
+            continue
+        if order_key(topic, style) in seen:
+            duplicates += 1
+            continue
+        seen.add(order_key(topic, style))
+        orders.append({'topic': topic, 'style': style, 'priority': priority})
+    return orders, errors, duplicates
+
+
+def find_existing(db, orders):
+    """
+    คืน set ของ order_key ที่มีโปรเจกต์อยู่แล้ว (อ่านเฉพาะ field topic/style)
+    Firestore เทียบค่าแบบตรงตัว จึงค้นด้วย topic_key (topic ตัวพิมพ์เล็กที่บันทึกไว้ตอนสร้างโปรเจกต์)
+    และค้นด้วย topic ตรงตัวด้วย สำหรับโปรเจกต์เก่าที่ยังไม่มี topic_key
+    """
+    projects_ref = db.collection('projects')
+    lookups = [
+        ('topic_key', sorted({order_key(order['topic'], order['style'])[0] for order in orders})),
+        ('topic', sorted({order['topic'] for order in orders})),
+    ]
+    existing = set()
+    for field, values in lookups:
+        for start in range(0, len(values), EXISTING_QUERY_CHUNK):
+            query = projects_ref.where(field, 'in', values[start:start + EXISTING_QUERY_CHUNK]).select(['topic', 'style'])
+            for doc in query.stream():
+                doc_data = doc.to_dict()
+                existing.add(order_key(doc_data.get('topic') or "", doc_data.get('style') or ""))
+    return existing
+
+
+def ingest_orders(db, orders, batch_tag, dry_run=False):
+    """
+    สร้างโปรเจกต์ของ order ที่ยังไม่มีอยู่ โดยเขียนครั้งละไม่เกิน BATCH_LIMIT เอกสารต่อ batch
+    คืนค่า (created, skipped_existing)
+    """
+    existing = find_existing(db, orders)
+    new_orders = [order for order in orders if order_key(order['topic'], order['style']) not in existing]
+    if dry_run:
+        return len(new_orders), len(orders) - len(new_orders)
+
+    projects_ref = db.collection('projects')
+    for start in range(0, len(new_orders), BATCH_LIMIT):
+        batch = db.batch()
+        for order in new_orders[start:start + BATCH_LIMIT]:
+            project_data = {
+                'topic': order['topic'],
+                'topic_key': order_key(order['topic'], order['style'])[0],
+                'style': order['style'],
+                'status': 'script_pending',
+                'batch_tag': batch_tag,
+                'created_at': firestore.SERVER_TIMESTAMP,
+            }
+            if order['priority']:
+                project_data['priority'] = order['priority']
+            batch.set(projects_ref.document(), project_data)
+        batch.commit()
+    return len(new_orders), len(orders) - len(new_orders)
+
+
+if __name__ == "__main__":
+    from runtime import firestore_client
+
+    args = [arg for arg in sys.argv[1:] if arg != "--dry-run"]
+    if not args or os.path.splitext(args[0])[1].lower() not in (".csv", ".jsonl"):
+        print("Usage: python bulk_ingest.py <orders.csv|orders.jsonl> [batch_tag] [priority] [--dry-run]")
+        sys.exit(1)
+
+    dry_run = "--dry-run" in sys.argv[1:]
+    file_path = args[0]
+    batch_tag = args[1] if len(args) > 1 else make_batch_tag()
+    default_priority = int(args[2]) if len(args) > 2 else 0
+
+    with open(file_path, encoding="utf-8-sig") as f:
+        rows, errors = parse_orders(f.read(), file_path)
+    orders, row_errors, duplicates = validate_orders(rows, default_priority=default_priority)
+    for error in errors + row_errors:
+        print(f"  - ⚠️ {error}")
+    if not orders:
+        print("❌ No valid orders to ingest.")
+        sys.exit(1)
+
+    db = firestore_client.get()  # ตั้งค่าการเชื่อมต่อผ่าน Environment Variable (ดู runtime.py)
+    created, skipped = ingest_orders(db, orders, batch_tag, dry_run=dry_run)
+    print(f"✅ {'Would create' if dry_run else 'Created'} {created} projects with tag '{batch_tag}' "
+          f"({skipped} already existed, {duplicates} duplicate rows, {len(errors) + len(row_errors)} invalid rows).")
@@ -0,0 +1,52 @@
+import os
+import sys
+import threading
+from google.cloud import firestore
+from job_queue import claim_job, make_worker_id
+
+# สคริปต์ตรวจสอบการจองงานพร้อมกันหลาย replica กับ Firestore Emulator
+# วิธีใช้:
+#   gcloud emulators firestore start --host-port=localhost:8080
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 python emulator_claim_check.py
+
+NUM_PROJECTS = 50
+NUM_REPLICAS = 8
+
+if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+    print("❌ Please set FIRESTORE_EMULATOR_HOST before running this check.")
+    sys.exit(1)
+
+db = firestore.Client(project="emulator-claim-check")
+
+# เตรียมงานจำลองในสถานะ script_pending
+for doc in db.collection('projects').stream():
+    doc.reference.delete()
+for i in range(NUM_PROJECTS):
+    db.collection('projects').add({'topic': f"topic {i}", 'style': "test", 'status': 'script_pending'})
+
+claims = {}
+claims_lock = threading.Lock()
+
+
+def replica():
+    worker_id = make_worker_id("check")
+    while True:
+        job = claim_job(db, 'script_pending', 'script_processing', worker_id)
+        if job is None:
+            return
+        with claims_lock:
+            claims.setdefault(job[0], []).append(worker_id)
+
+
+threads = [threading.Thread(target=replica) for _ in range(NUM_REPLICAS)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+duplicates = {doc_id: owners for doc_id, owners in claims.items() if len(owners) > 1}
+print(f"Claimed {len(claims)}/{NUM_PROJECTS} projects with {NUM_REPLICAS} replicas.")
+if duplicates or len(claims) != NUM_PROJECTS:
+    print(f"❌ Claim check failed. Duplicates: {duplicates}")
+    sys.exit(1)
+print("✅ Every project was claimed exactly once.")
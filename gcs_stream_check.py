@@ -0,0 +1,62 @@
+import os
+import sys
+import shutil
+import tempfile
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+from benchmark_render import make_scenes
+from video_render import render_video
+from video_output import HlsPublisher, open_upload_stream
+
+# สคริปต์ตรวจสอบการอัปโหลดวิดีโอแบบ streaming และ HLS กับ GCS Emulator (fake-gcs-server)
+# วิธีใช้:
+#   docker run -p 4443:4443 fsouza/fake-gcs-server -scheme http
+#   STORAGE_EMULATOR_HOST=http://localhost:4443 python gcs_stream_check.py
+
+NUM_SCENES = 4
+SCENE_SECONDS = 3.0
+BUCKET_NAME = "gcs-stream-check"
+PREFIX = "check-project"
+
+if not os.environ.get("STORAGE_EMULATOR_HOST"):
+    print("❌ Please set STORAGE_EMULATOR_HOST before running this check.")
+    sys.exit(1)
+
+client = storage.Client(project="gcs-stream-check", credentials=AnonymousCredentials())
+bucket = client.bucket(BUCKET_NAME)
+if not bucket.exists():
+    bucket = client.create_bucket(BUCKET_NAME)
+
+work_dir = tempfile.mkdtemp(prefix="gcs_stream_check_")
+try:
+    assets = make_scenes(work_dir, NUM_SCENES, SCENE_SECONDS)
+    blob = bucket.blob(f"{PREFIX}/final_video.mp4")
+    # emulator ไม่มี service account สำหรับเซ็น URL จึงใช้ public URL
+    hls = HlsPublisher(bucket, f"{PREFIX}/hls", work_dir, url_expiration_hours=0)
+    upload_stream = open_upload_stream(blob)
+    clip_count = render_video(
+        assets, os.path.join(work_dir, "final_video.mp4"), engine="ffmpeg",
+        on_segment_ready=hls.add, output_file=upload_stream
+    )
+    upload_stream.close()
+    published = hls.finish()
+finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+failures = []
+blob.reload()
+if clip_count != NUM_SCENES:
+    failures.append(f"rendered {clip_count} of {NUM_SCENES} scenes")
+if not blob.size:
+    failures.append("final video is empty")
+playlist = bucket.blob(f"{PREFIX}/hls/index.m3u8").download_as_text()
+if "#EXT-X-ENDLIST" not in playlist or published != NUM_SCENES:
+    failures.append(f"playlist lists {published} of {NUM_SCENES} scenes")
+for i in range(NUM_SCENES):
+    if not bucket.blob(f"{PREFIX}/hls/scene_{i + 1:04d}.ts").exists():
+        failures.append(f"HLS segment {i + 1} is missing")
+
+if failures:
+    print("❌ " + "; ".join(failures))
+    sys.exit(1)
+print(f"✅ Streamed a {blob.size / 1024:.0f} KB video and {published} HLS segments to the emulator.")
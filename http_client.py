@@ -0,0 +1,148 @@
+import time
+import random
+import threading
+import email.utils
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import wait_random_exponential
+
+# --- 1. Error ที่ใช้ร่วมกับ tenacity ---
+
+class RetryableHTTPError(Exception):
+    """Error ที่ควรลองใหม่ (เชื่อมต่อไม่ได้, timeout, 429, 5xx) พร้อมเวลารอจาก Retry-After ถ้ามี"""
+
+    def __init__(self, message, retry_after=None, status_code=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class CircuitOpenError(RetryableHTTPError):
+    """วงจรเปิดอยู่ (backend ล่มหรือรับโหลดไม่ไหว) จึงไม่ยิง request ใหม่จนกว่าจะครบเวลาพัก"""
+
+
+def retry_after_seconds(response):
+    """อ่าน header Retry-After (ได้ทั้งแบบวินาทีและแบบวันที่) คืนค่าเป็นวินาทีหรือ None"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def wait_retry_after_or_backoff(multiplier=2, max_wait=60):
+    """
+    wait strategy ของ tenacity: ใช้ Retry-After จาก server ถ้ามี
+    ไม่เช่นนั้นใช้ exponential backoff แบบ full jitter
+    """
+    backoff = wait_random_exponential(multiplier=multiplier, max=max_wait)
+
+    def wait(retry_state):
+        exception = retry_state.outcome.exception() if retry_state.outcome else None
+        retry_after = getattr(exception, "retry_after", None)
+        if retry_after is not None:
+            # เพิ่ม jitter เล็กน้อยเพื่อไม่ให้ทุก replica กลับมายิงพร้อมกัน
+            return min(retry_after, max_wait) + random.uniform(0, 1)
+        return backoff(retry_state)
+
+    return wait
+
+
+def is_retryable(exception):
+    return isinstance(exception, (RetryableHTTPError, requests.ConnectionError, requests.Timeout))
+
+
+# --- 2. Circuit Breaker ---
+
+class CircuitBreaker:
+    """
+    นับความล้มเหลวติดกัน ถ้าเกิน failure_threshold จะเปิดวงจร reset_timeout วินาที
+    หลังจากนั้นยอมให้ลอง 1 request (half-open) ถ้าสำเร็จจึงปิดวงจร
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._half_open_in_flight = False
+
+    def before_request(self):
+        """เรียกก่อนยิง request ถ้าวงจรเปิดอยู่จะโยน CircuitOpenError พร้อมเวลาที่เหลือ"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self._half_open_in_flight:
+                raise CircuitOpenError("Circuit breaker is open", retry_after=max(remaining, 1.0))
+            self._half_open_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._half_open_in_flight = False
+
+    def release_probe(self):
+        """ปล่อยสิทธิ์ half-open โดยไม่นับเป็นสำเร็จหรือล้มเหลว (request ไม่ได้ไปถึง backend)"""
+        with self._lock:
+            self._half_open_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._half_open_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+# --- 3. HTTP Session แบบ pool (keep-alive) ---
+
+def make_session(pool_size):
+    """สร้าง requests.Session ที่ใช้ connection ซ้ำได้ และรองรับ request พร้อมกัน pool_size ตัว"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def post_json(session, breaker, url, payload, timeout, stream=False):
+    """
+    POST แบบ JSON ผ่าน circuit breaker (stream=True เพื่ออ่าน response ทีละบรรทัด)
+    โยน RetryableHTTPError สำหรับ error ที่ควรลองใหม่ และ HTTPError ปกติสำหรับ 4xx อื่นๆ
+    """
+    breaker.before_request()
+    try:
+        response = session.post(url, json=payload, timeout=timeout, stream=stream)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        breaker.record_failure()
+        raise RetryableHTTPError(f"Request failed: {e}") from e
+    except requests.RequestException:
+        # เช่น ChunkedEncodingError, ContentDecodingError, TooManyRedirects: backend ตอบผิดรูปแบบ นับเป็นล้มเหลว
+        # (ทุกทางออกต้องปล่อย half-open probe ไม่เช่นนั้นวงจรจะเปิดค้างตลอดไป)
+        breaker.record_failure()
+        raise
+    except Exception:
+        breaker.release_probe()
+        raise
+
+    if response.status_code == 429 or response.status_code >= 500:
+        breaker.record_failure()
+        raise RetryableHTTPError(
+            f"HTTP {response.status_code} from {url}",
+            retry_after=retry_after_seconds(response), status_code=response.status_code
+        )
+    # ตั้งใจนับ 4xx เป็นสำเร็จ: backend ยังตอบได้ปกติ ปัญหาอยู่ที่ request ของเรา จึงไม่ควรเปิดวงจร
+    # (4xx ไม่ถูก retry เพราะ raise_for_status โยน HTTPError ซึ่ง is_retryable ไม่นับ)
+    breaker.record_success()
+    response.raise_for_status()
+    return response
@@ -0,0 +1,494 @@
+import os
+import time
+import random
+import socket
+import uuid
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions as gcp_exceptions
+from google.cloud import firestore
+from metrics import (
+    JOB_SECONDS, JOBS_IN_FLIGHT, JOBS_TOTAL, QUEUE_WAIT_SECONDS,
+    start_metrics_server, start_queue_depth_monitor,
+)
+
+# --- 1. การตั้งค่า (Configuration) ---
+# ค่าพวกนี้ใช้ร่วมกันทุก Worker และปรับได้ผ่าน Environment Variable
+LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "900"))  # อายุของ lease ต่องาน
+MAX_IN_FLIGHT = int(os.environ.get("WORKER_MAX_IN_FLIGHT", "1"))  # จำนวนงานที่ 1 replica ถือได้พร้อมกัน (K)
+CLAIM_CANDIDATES = int(os.environ.get("JOB_CLAIM_CANDIDATES", "10"))  # จำนวนงานที่ดึงมาลองจองต่อรอบ
+CLAIM_MAX_PAGES = int(os.environ.get("JOB_CLAIM_MAX_PAGES", "5"))  # จำนวนหน้าสูงสุดที่ลองก่อนสรุปว่าไม่มีงาน
+DISPATCH_MODE = os.environ.get("WORKER_DISPATCH_MODE", "listen")  # 'listen' (on_snapshot) หรือ 'poll'
+POLL_MIN_SECONDS = float(os.environ.get("WORKER_POLL_MIN_SECONDS", "1"))  # ช่วงเวลาถามซ้ำเริ่มต้นเมื่อไม่มีงาน
+POLL_MAX_SECONDS = float(os.environ.get("WORKER_POLL_MAX_SECONDS", "60"))  # เพดานของ backoff
+HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", str(LEASE_SECONDS / 3)))  # ต่ออายุ lease ทุกกี่วินาที
+MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))  # จำนวนครั้งสูงสุดที่งานจะถูกคืนกลับไป pending
+REAPER_INTERVAL_SECONDS = float(os.environ.get("JOB_REAPER_INTERVAL_SECONDS", "60"))
+ERROR_SLEEP_SECONDS = 30
+
+# สถานะของแต่ละแผนก: (pending, processing, failed)
+STAGES = {
+    'script': ('script_pending', 'script_processing', 'script_failed'),
+    'assets': ('assets_pending', 'assets_processing', 'assets_failed'),
+    'compile': ('compile_pending', 'compiling', 'compile_failed'),
+}
+# แผนกก่อนหน้าที่ส่งงานมาแบบ streaming และ flag ที่บอกว่ายังส่งไม่จบ (ดู pipeline_stream.py)
+UPSTREAM = {
+    'assets': ('script', 'script_streaming'),
+    'compile': ('assets', 'assets_streaming'),
+}
+# เวลาที่งานเข้าคิวของแต่ละแผนก (แผนกก่อนหน้าส่งต่อมา) ใช้คำนวณเวลารอคิว
+QUEUED_AT_FIELDS = {
+    'script': 'created_at',
+    'assets': 'script_completed_at',
+    'compile': 'assets_completed_at',
+}
+
+
+def make_worker_id(stage):
+    """สร้าง ID ของ Worker ที่ไม่ซ้ำกันในแต่ละ replica (เช่น 'assets-host-1234-ab12cd')"""
+    return f"{stage}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+def connect_firestore(project_id, key_file_path):
+    """
+    เชื่อมต่อ Firestore สำหรับ Worker
+    ถ้ามี FIRESTORE_EMULATOR_HOST จะต่อกับ Emulator โดยไม่ต้องใช้ไฟล์ key
+    ถ้า key_file_path ว่าง จะใช้ Application Default Credentials (เช่นบน Cloud Run)
+    """
+    if os.environ.get("FIRESTORE_EMULATOR_HOST") or not key_file_path:
+        return firestore.Client(project=project_id)
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = key_file_path
+    if not os.path.exists(key_file_path):
+        raise FileNotFoundError(f"Key file not found at: {key_file_path}")
+    return firestore.Client(project=project_id)
+
+
+# --- 2. การจองงานแบบ Atomic ---
+
+@firestore.transactional
+def _claim_in_transaction(transaction, doc_ref, pending_status, processing_status, worker_id):
+    """
+    อ่านสถานะและเปลี่ยนเป็น processing ภายใน transaction เดียวกัน
+    ถ้ามี replica อื่นจองไปก่อน transaction จะถูก retry แล้วเจอว่าสถานะไม่ใช่ pending แล้ว
+    """
+    snapshot = doc_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.get('status') != pending_status:
+        return None
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    transaction.update(doc_ref, {
+        'status': processing_status,
+        'worker_id': worker_id,
+        'claimed_at': firestore.SERVER_TIMESTAMP,
+        'lease_expires_at': now + datetime.timedelta(seconds=LEASE_SECONDS),
+        f'attempts.{processing_status}': firestore.Increment(1),
+        # ล้างเจ้าของเดิมที่ reaper บันทึกไว้ ไม่เช่นนั้น heartbeat จะเข้าใจผิดว่าเสีย lease หลังส่งต่องานตามปกติ
+        'last_lease_owner': firestore.DELETE_FIELD,
+    })
+    doc_data = snapshot.to_dict()
+    doc_data['status'] = processing_status
+    doc_data['worker_id'] = worker_id
+    return doc_data
+
+
+_priority_query_available = True  # ปิดเองเมื่อพบว่ายังไม่ได้สร้าง index ของ priority (ดู firestore.indexes.json)
+
+
+def _candidate_pages(pending_query, candidates):
+    """
+    ดึงงานที่รออยู่ทีละหน้า (หน้าละ candidates งาน) งานด่วน (priority > 0) มาก่อน แล้วตามด้วยงานทั้งหมด
+    หน้าถัดไปเริ่มต่อจากเอกสารสุดท้ายของหน้าก่อน (start_after) ใช้เมื่อ replica อื่นจองงานในหน้าแรกไปหมดแล้ว
+    ถ้ายังไม่มี composite index (status, priority desc) จะเตือนครั้งเดียวแล้วใช้เฉพาะ query ปกติ
+    (Worker ต้องจองงานได้เสมอ แม้ยังไม่ได้ deploy index)
+    """
+    global _priority_query_available
+    queries = [pending_query]
+    if _priority_query_available:
+        # งานปกติไม่มี field priority จึงไม่ติดมากับ query นี้
+        queries.insert(0, pending_query.where('priority', '>', 0).order_by('priority', direction=firestore.Query.DESCENDING))
+
+    for query in queries:
+        cursor = None
+        while True:
+            page_query = query.start_after(cursor) if cursor else query
+            try:
+                docs = list(page_query.limit(candidates).stream())
+            except gcp_exceptions.FailedPrecondition as e:
+                if query is pending_query:
+                    raise
+                _priority_query_available = False
+                print(f"  - ⚠️ Priority claims disabled until the (status, priority desc) index is deployed "
+                      f"(firebase deploy --only firestore:indexes): {e}")
+                break
+            if docs:
+                yield docs
+            if len(docs) < candidates:
+                break
+            cursor = docs[-1]
+
+
+def claim_job(db, pending_status, processing_status, worker_id, candidates=CLAIM_CANDIDATES, max_pages=CLAIM_MAX_PAGES):
+    """
+    หางานที่รออยู่แล้วจองให้ Worker นี้แบบ atomic (งานที่มี priority จะถูกลองจองก่อนงานปกติ)
+    ถ้า replica อื่นจองทุกงานในหน้าแรกไปแล้ว จะดึงหน้าถัดไปมาลองต่อ (ไม่เกิน max_pages หน้า)
+    คืนค่า (doc_id, doc_data) ถ้าจองได้ หรือ None ถ้าไม่มีงานเหลือ
+    """
+    projects_ref = db.collection('projects')
+    pages = _candidate_pages(projects_ref.where('status', '==', pending_status), candidates)
+    for page_num, page in enumerate(pages):
+        if page_num >= max_pages:
+            break
+        # สลับลำดับเพื่อไม่ให้ทุก replica แย่งเอกสารแรกตัวเดียวกัน แต่ยังเรียงจาก priority สูงไปต่ำ
+        docs = list(page)
+        random.shuffle(docs)
+        docs.sort(key=lambda doc: doc.to_dict().get('priority') or 0, reverse=True)
+
+        for doc in docs:
+            doc_data = _claim_in_transaction(
+                db.transaction(), projects_ref.document(doc.id),
+                pending_status, processing_status, worker_id
+            )
+            if doc_data is not None:
+                return doc.id, doc_data
+    return None
+
+
+# --- 3. Lease: heartbeat ระหว่างทำงาน และคืนงานที่ lease หมดอายุ ---
+
+class LeaseLostError(Exception):
+    """Worker เสีย lease ของงานไปแล้ว (reaper คืนงานและ replica อื่นอาจจองไปแล้ว) ต้องหยุดโดยไม่เขียนผลทับ"""
+
+
+_current = threading.local()  # lease ของงานที่ thread นี้กำลังทำ (ตั้งโดย LeaseHeartbeat)
+
+
+@firestore.transactional
+def _extend_lease_in_transaction(transaction, doc_ref, processing_status, worker_id):
+    """
+    ต่ออายุ lease เฉพาะเมื่องานยังเป็นของ Worker นี้อยู่
+    คืนค่า False ถ้าเสียงานไปแล้ว (reaper คืนงานจาก Worker นี้ หรือ Worker อื่นได้งานไป)
+    และ None ถ้างานถูกส่งต่อไปแผนกถัดไปแล้ว (เช่นในโหมด streaming)
+    """
+    snapshot = doc_ref.get(transaction=transaction)
+    doc_data = snapshot.to_dict() if snapshot.exists else {}
+    if doc_data.get('status') != processing_status:
+        # reaper บันทึกเจ้าของเดิมไว้ใน last_lease_owner แยกการถูกคืนงานออกจากการส่งต่องานตามปกติ
+        return False if doc_data.get('last_lease_owner') == worker_id else None
+    if doc_data.get('worker_id') != worker_id:
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    transaction.update(doc_ref, {
+        'lease_expires_at': now + datetime.timedelta(seconds=LEASE_SECONDS),
+        'heartbeat_at': firestore.SERVER_TIMESTAMP,
+    })
+    return True
+
+
+@firestore.transactional
+def _fenced_write_in_transaction(transaction, doc_ref, processing_status, worker_id, apply):
+    """
+    เขียนผ่าน apply(transaction) เฉพาะเมื่องานยังอยู่ใน processing และเป็นของ Worker นี้
+    ถ้า reaper คืนงานไปแล้ว (และอาจมี replica อื่นจองไป) จะโยน LeaseLostError โดยไม่เขียนอะไรเลย
+    """
+    snapshot = doc_ref.get(transaction=transaction)
+    doc_data = snapshot.to_dict() if snapshot.exists else {}
+    if doc_data.get('status') != processing_status or doc_data.get('worker_id') != worker_id:
+        raise LeaseLostError(f"Project {doc_ref.id} is no longer held by {worker_id}.")
+    apply(transaction)
+
+
+class LeaseHeartbeat:
+    """
+    ต่ออายุ lease ของงานเป็นระยะใน thread แยก ระหว่างที่ Worker ยังทำงานนั้นอยู่
+    ถ้าพบว่าเสีย lease จะตั้ง lost ไว้ให้ process_fn หยุด (ดู check_lease) และ fence ใช้เขียนผลแบบมีเงื่อนไข
+    """
+
+    def __init__(self, db, doc_id, processing_status, worker_id, interval=HEARTBEAT_SECONDS):
+        self.db = db
+        self.doc_id = doc_id
+        self.processing_status = processing_status
+        self.worker_id = worker_id
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"heartbeat-{doc_id}")
+
+    def __enter__(self):
+        _current.lease = self
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        _current.lease = None
+        self._stop.set()
+        self._thread.join()
+
+    def fence(self, apply):
+        """เขียนผลของงานผ่าน apply(transaction) เฉพาะเมื่อยังถือ lease อยู่ ไม่เช่นนั้นโยน LeaseLostError"""
+        doc_ref = self.db.collection('projects').document(self.doc_id)
+        try:
+            _fenced_write_in_transaction(self.db.transaction(), doc_ref, self.processing_status, self.worker_id, apply)
+        except LeaseLostError:
+            self.lost.set()
+            raise
+
+    def _run(self):
+        doc_ref = self.db.collection('projects').document(self.doc_id)
+        while not self._stop.wait(self.interval):
+            try:
+                extended = _extend_lease_in_transaction(self.db.transaction(), doc_ref, self.processing_status, self.worker_id)
+                if extended is None:
+                    return
+                if not extended:
+                    print(f"  - ⚠️ Lost lease on project {self.doc_id}; it may have been reclaimed by another worker.")
+                    self.lost.set()
+                    return
+            except Exception as e:
+                print(f"  - ⚠️ Heartbeat failed for project {self.doc_id}: {e}")
+
+
+class UpstreamStalledError(TimeoutError):
+    """แผนกก่อนหน้าส่งต่องานแบบ streaming แล้วเงียบหายไปนานเกิน timeout (เช่น Worker ตายหลังส่งต่องาน)"""
+
+
+def return_to_upstream(doc_ref, stage, doc_data, reason, extra_update=None):
+    """
+    คืนงานให้แผนกก่อนหน้าทำใหม่เมื่อ stream ของแผนกนั้นหยุดกลางทาง (ล้าง flag *_streaming ด้วยการเขียนแบบ fenced)
+    ถ้าแผนกก่อนหน้าลองครบ MAX_ATTEMPTS แล้วจะ mark failed ของแผนกนี้แทน ไม่วนซ้ำไม่รู้จบ คืนค่าสถานะใหม่
+    """
+    upstream, streaming_flag = UPSTREAM[stage]
+    upstream_pending, upstream_processing, _ = STAGES[upstream]
+    attempts = (doc_data.get('attempts') or {}).get(upstream_processing, 0)
+    update = {**(extra_update or {}), streaming_flag: False, 'error_message': reason}
+    update['status'] = STAGES[stage][2] if attempts >= MAX_ATTEMPTS else upstream_pending
+    fenced_update(doc_ref, update)
+    return update['status']
+
+
+def current_lease():
+    """lease ของงานที่ thread นี้ทำอยู่ หรือ None ถ้า process_fn ถูกเรียกตรงๆ ไม่ผ่าน run_worker"""
+    return getattr(_current, 'lease', None)
+
+
+def check_lease():
+    """เรียกเป็นระยะระหว่างงานยาวๆ: โยน LeaseLostError ถ้า heartbeat พบว่างานถูกคืนไปแล้ว"""
+    lease = current_lease()
+    if lease is not None and lease.lost.is_set():
+        raise LeaseLostError(f"Lost lease on project {lease.doc_id}.")
+
+
+def job_fence():
+    """fence ของงานปัจจุบันสำหรับส่งให้ scene_store (None = เขียนตรงๆ)"""
+    lease = current_lease()
+    return lease.fence if lease is not None else None
+
+
+def fenced_update(doc_ref, update):
+    """
+    อัปเดตเอกสารโปรเจกต์เฉพาะเมื่อ Worker นี้ยังถือ lease ของงานอยู่ (ใช้กับการเขียนสถานะสุดท้าย)
+    ใช้ได้เฉพาะก่อนส่งต่องานให้แผนกถัดไป เพราะหลังจากนั้นสถานะไม่ใช่ processing ของแผนกนี้แล้ว
+    """
+    lease = current_lease()
+    if lease is None:
+        doc_ref.update(update)
+        return
+    lease.fence(lambda transaction: transaction.update(doc_ref, update))
+
+
+@firestore.transactional
+def _reap_in_transaction(transaction, doc_ref, pending_status, processing_status, failed_status, now):
+    """คืนงานที่ lease หมดอายุกลับไป pending หรือ mark failed ถ้าลองครบจำนวนครั้งแล้ว"""
+    snapshot = doc_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.get('status') != processing_status:
+        return None
+    doc_data = snapshot.to_dict()
+    lease_expires_at = doc_data.get('lease_expires_at')
+    if lease_expires_at and lease_expires_at > now:
+        return None
+
+    attempts = doc_data.get('attempts', {}).get(processing_status, 0)
+    update = {
+        'worker_id': firestore.DELETE_FIELD,
+        'lease_expires_at': firestore.DELETE_FIELD,
+        'last_lease_owner': doc_data.get('worker_id'),
+        'reclaimed_at': firestore.SERVER_TIMESTAMP,
+    }
+    if attempts >= MAX_ATTEMPTS:
+        update['status'] = failed_status
+        update['error_message'] = f"Worker lease expired {attempts} times in '{processing_status}'."
+    else:
+        update['status'] = pending_status
+    transaction.update(doc_ref, update)
+    return update['status']
+
+
+def reap_expired_leases(db, pending_status, processing_status, failed_status):
+    """
+    หางานที่ค้างอยู่ใน processing แต่ lease หมดอายุแล้ว (Worker ตายหรือถูก deploy ทับ)
+    คืนค่าจำนวนงานที่ถูกคืนหรือ mark failed
+    """
+    projects_ref = db.collection('projects')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    reaped = 0
+    # กรอง lease ใน Python เพื่อไม่ต้องสร้าง composite index (งานที่ processing อยู่มีไม่มาก)
+    for doc in projects_ref.where('status', '==', processing_status).stream():
+        lease_expires_at = doc.to_dict().get('lease_expires_at')
+        if lease_expires_at and lease_expires_at > now:
+            continue
+        new_status = _reap_in_transaction(
+            db.transaction(), projects_ref.document(doc.id),
+            pending_status, processing_status, failed_status, now
+        )
+        if new_status:
+            reaped += 1
+            print(f"\n♻️  Reclaimed project {doc.id} from '{processing_status}' -> '{new_status}'.")
+    return reaped
+
+
+def _reaper_loop(db, pending_status, processing_status, failed_status):
+    while True:
+        try:
+            reap_expired_leases(db, pending_status, processing_status, failed_status)
+        except Exception as e:
+            print(f"\n🚨 Lease reaper error for '{processing_status}': {e}")
+        time.sleep(REAPER_INTERVAL_SECONDS)
+
+
+# --- 4. การปลุก Worker เมื่อมีงานใหม่ ---
+
+class PendingJobSignal:
+    """
+    ฟังสถานะ pending ผ่าน on_snapshot และปลุก Worker ทันทีที่มีงานเข้ามา
+    ถ้า listener หลุดหรือใช้ไม่ได้ Worker จะกลับไปใช้การ poll ตามรอบ backoff แทน
+    """
+
+    def __init__(self, db, pending_status, use_listener=True):
+        self._event = threading.Event()
+        self._watch = None
+        if use_listener:
+            query = db.collection('projects').where('status', '==', pending_status).limit(CLAIM_CANDIDATES)
+            self._watch = query.on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # สนใจเฉพาะเอกสารที่เพิ่งเข้ามาอยู่ในสถานะ pending
+        if any(change.type.name == 'ADDED' for change in changes):
+            self._event.set()
+
+    def wait(self, timeout):
+        """รอจนกว่าจะมีงานใหม่หรือครบ timeout คืนค่า True ถ้าถูกปลุกโดย listener"""
+        woken = self._event.wait(timeout)
+        self._event.clear()
+        return woken
+
+    def close(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+
+
+# --- 5. Loop การทำงานที่ถือได้หลายงานพร้อมกัน ---
+
+def queue_wait_seconds(stage, doc_data, now=None):
+    """
+    เวลาที่งานรออยู่ในสถานะ pending ก่อนถูกจอง (วินาที) หรือ None ถ้าไม่มีเวลาเข้าคิวบันทึกไว้
+    ถ้างานถูก reaper คืนกลับมา จะนับจากเวลาที่ถูกคืน (reclaimed_at) แทน
+    """
+    queued_times = [doc_data.get(QUEUED_AT_FIELDS[stage]), doc_data.get('reclaimed_at')]
+    queued_times = [t for t in queued_times if isinstance(t, datetime.datetime)]
+    if not queued_times:
+        return None
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (now - max(queued_times)).total_seconds())
+
+
+def job_outcome(db, stage, doc_id):
+    """
+    ผลของงานสำหรับ metric: process_fn จับ error เองแล้วเขียนสถานะ *_failed โดยไม่โยน exception
+    จึงต้องอ่านสถานะกลับมาดู 'failed' ถ้าแผนกนี้ mark failed ไม่เช่นนั้น 'done' (ส่งต่องานแล้ว)
+    """
+    failed_status = STAGES[stage][2]
+    try:
+        snapshot = db.collection('projects').document(doc_id).get(field_paths=['status'])
+    except Exception as e:
+        print(f"  - ⚠️ Could not read the final status of project {doc_id}: {e}")
+        return 'unknown'
+    if snapshot.exists and snapshot.to_dict().get('status') == failed_status:
+        return 'failed'
+    return 'done'
+
+
+def _run_job(stage, slots, heartbeat, process_fn, doc_id, doc_data):
+    started = time.perf_counter()
+    outcome = 'error'
+    JOBS_IN_FLIGHT.inc(stage=stage)
+    try:
+        with heartbeat:
+            process_fn(doc_id, doc_data)
+        outcome = job_outcome(heartbeat.db, stage, doc_id)
+    except LeaseLostError as e:
+        outcome = 'lease_lost'
+        print(f"  - ⚠️ Stopped project {doc_id} without writing results: {e}")
+    except Exception as e:
+        print(f"  - ❌ Unhandled error while processing project {doc_id}: {e}")
+    finally:
+        JOBS_IN_FLIGHT.dec(stage=stage)
+        JOB_SECONDS.observe(time.perf_counter() - started, stage=stage)
+        JOBS_TOTAL.inc(stage=stage, outcome=outcome)
+        slots.release()
+
+
+def run_worker(db, stage, process_fn, worker_id,
+               max_in_flight=MAX_IN_FLIGHT, found_message="✨ Found a new job!",
+               dispatch_mode=DISPATCH_MODE):
+    """
+    วนจองงานของแผนก stage ('script', 'assets', 'compile') และส่งให้ process_fn ทำงาน
+    แต่ละ replica ถืองานได้สูงสุด max_in_flight งานพร้อมกัน พร้อมต่ออายุ lease ระหว่างทำงาน
+    และคืนงานที่ค้างของแผนกนี้เป็นระยะ พร้อมเปิด /metrics ของแผนกนี้ (ดู metrics.py)
+    """
+    pending_status, processing_status, failed_status = STAGES[stage]
+    start_metrics_server(stage)
+    start_queue_depth_monitor(db, stage, STAGES[stage])
+    threading.Thread(
+        target=_reaper_loop, args=(db, pending_status, processing_status, failed_status),
+        daemon=True, name=f"reaper-{stage}"
+    ).start()
+
+    slots = threading.BoundedSemaphore(max_in_flight)
+    try:
+        signal = PendingJobSignal(db, pending_status, use_listener=(dispatch_mode == "listen"))
+    except Exception as e:
+        print(f"  - ⚠️ Snapshot listener unavailable, falling back to polling: {e}")
+        signal = PendingJobSignal(db, pending_status, use_listener=False)
+    poll_interval = POLL_MIN_SECONDS
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            # รอจนกว่าจะมีช่องว่างก่อนจองงานใหม่
+            slots.acquire()
+            try:
+                job = claim_job(db, pending_status, processing_status, worker_id)
+            except Exception as e:
+                slots.release()
+                print(f"\n\n🚨 An critical error occurred while claiming jobs: {e}\n\n")
+                time.sleep(ERROR_SLEEP_SECONDS)
+                continue
+
+            if job is None:
+                slots.release()
+                # ถ้าไม่เจองาน, ให้รอจนกว่า listener จะปลุก หรือครบรอบ poll (เพิ่มขึ้นแบบ backoff)
+                print(".", end="", flush=True)
+                if signal.wait(poll_interval):
+                    poll_interval = POLL_MIN_SECONDS
+                else:
+                    poll_interval = min(poll_interval * 2, POLL_MAX_SECONDS)
+                continue
+
+            poll_interval = POLL_MIN_SECONDS
+            doc_id, doc_data = job
+            print(f"\n{found_message} Project ID: {doc_id} (worker: {worker_id})")
+            waited = queue_wait_seconds(stage, doc_data)
+            if waited is not None:
+                QUEUE_WAIT_SECONDS.observe(waited, stage=stage)
+            heartbeat = LeaseHeartbeat(db, doc_id, processing_status, worker_id)
+            executor.submit(_run_job, stage, slots, heartbeat, process_fn, doc_id, doc_data)
@@ -0,0 +1,195 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- 1. การตั้งค่า ---
+# แต่ละ Worker เปิด endpoint /metrics (รูปแบบ Prometheus) ที่ port ของแผนกตัวเอง
+# ตั้ง METRICS_PORT เพื่อใช้ port อื่น หรือ METRICS_ENABLED=0 เพื่อปิด
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_PORTS = {'script': 9101, 'assets': 9102, 'compile': 9103}
+QUEUE_DEPTH_POLL_SECONDS = float(os.environ.get("METRICS_QUEUE_POLL_SECONDS", "15"))
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+# --- 2. ชนิดของ metric (thread-safe ไม่ต้องพึ่ง prometheus_client) ---
+
+def _label_text(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_label_text(self.label_names, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{_label_text(self.label_names, key, {'le': le})} {cumulative}")
+        lines.append(f"{self.name}_sum{_label_text(self.label_names, key)} {total}")
+        lines.append(f"{self.name}_count{_label_text(self.label_names, key)} {cumulative}")
+        return lines
+
+
+# --- 3. Metric ที่ทุก Worker ใช้ร่วมกัน ---
+
+CALL_SECONDS = Histogram("pipeline_call_seconds", "Duration of external calls (script API, Imagen, TTS, GCS, encode).", ("call",))
+CALL_ERRORS = Counter("pipeline_call_errors_total", "External calls that raised an error.", ("call",))
+QUEUE_WAIT_SECONDS = Histogram("pipeline_queue_wait_seconds", "Time a project waited in the pending status before a worker claimed it.", ("stage",))
+JOB_SECONDS = Histogram("pipeline_job_seconds", "Time a worker spent processing one project.", ("stage",))
+JOBS_TOTAL = Counter("pipeline_jobs_total", "Projects processed by this worker (outcome: done, failed, error, lease_lost).", ("stage", "outcome"))
+JOBS_IN_FLIGHT = Gauge("pipeline_jobs_in_flight", "Projects this worker is processing right now.", ("stage",))
+QUEUE_DEPTH = Gauge("pipeline_queue_depth", "Projects per status of this worker's stage (pipeline-wide, from Firestore).", ("stage", "status"))
+STARTUP_SECONDS = Gauge("pipeline_startup_seconds", "Seconds from process start until the stage was ready to claim jobs.", ("stage",))
+
+REGISTRY = [CALL_SECONDS, CALL_ERRORS, QUEUE_WAIT_SECONDS, JOB_SECONDS, JOBS_TOTAL, JOBS_IN_FLIGHT, QUEUE_DEPTH, STARTUP_SECONDS]
+_server_lock = threading.Lock()
+_server_port = None
+
+
+@contextmanager
+def span(call):
+    """จับเวลาการเรียก backend ภายนอก 1 ครั้ง (เช่น span('imagen')) และนับ error แยกตามชนิด"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        CALL_ERRORS.inc(call=call)
+        raise
+    finally:
+        CALL_SECONDS.observe(time.perf_counter() - started, call=call)
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- 4. HTTP endpoint และตัวอ่านความยาวคิว ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # ไม่พิมพ์ทุกครั้งที่ Prometheus มาเก็บข้อมูล
+
+
+def start_metrics_server(stage):
+    """
+    เปิด /metrics ใน thread พื้นหลัง คืนค่า port ที่เปิด (None ถ้าปิดไว้หรือเปิดไม่ได้)
+    เปิดครั้งเดียวต่อ process ถ้ารันหลายแผนกใน process เดียวกัน ทุกแผนกใช้ endpoint ของแผนกแรก
+    """
+    global _server_port
+    if not METRICS_ENABLED:
+        return None
+    with _server_lock:
+        if _server_port is not None:
+            return _server_port
+        port = int(os.environ.get("METRICS_PORT", METRICS_PORTS.get(stage, 9100)))
+        try:
+            server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+        except OSError as e:
+            print(f"  - ⚠️ Metrics endpoint unavailable on port {port}: {e}")
+            return None
+        threading.Thread(target=server.serve_forever, daemon=True, name=f"metrics-{stage}").start()
+        print(f"📈 Metrics for '{stage}' at http://localhost:{port}/metrics")
+        _server_port = port
+        return port
+
+
+def _queue_depth_loop(db, stage, statuses):
+    projects_ref = db.collection('projects')
+    while True:
+        for status in statuses:
+            try:
+                result = projects_ref.where('status', '==', status).count(alias="total").get()
+                QUEUE_DEPTH.set(result[0][0].value, stage=stage, status=status)
+            except Exception as e:
+                print(f"  - ⚠️ Could not count '{status}' projects: {e}")
+        time.sleep(QUEUE_DEPTH_POLL_SECONDS)
+
+
+def start_queue_depth_monitor(db, stage, statuses):
+    """นับจำนวนงานของแต่ละสถานะด้วย count() ตามรอบ (อ่าน 1 ครั้งต่อสถานะ ไม่ได้อ่านทุกเอกสาร)"""
+    if METRICS_ENABLED:
+        threading.Thread(target=_queue_depth_loop, args=(db, stage, statuses), daemon=True, name=f"queue-depth-{stage}").start()
@@ -0,0 +1,53 @@
+import os
+import threading
+
+# --- 1. การตั้งค่า ---
+# เปิดโหมด streaming ทั้ง pipeline: บทถูกเขียนทีละฉาก, Asset เริ่มทำฉากแรกก่อนบทจะจบ
+# และ Compiler เริ่ม encode ฉากที่ asset พร้อมแล้วก่อนที่ Asset Worker จะทำครบทุกฉาก
+PIPELINE_STREAMING = os.environ.get("PIPELINE_STREAMING", "0") == "1"
+STREAM_IDLE_TIMEOUT_SECONDS = float(os.environ.get("STREAM_IDLE_TIMEOUT_SECONDS", "600"))  # ถ้าต้นทางเงียบนานกว่านี้ถือว่าค้าง
+
+
+def missing_assets(scene):
+    """คืนรายการ asset ที่ฉากนี้ยังไม่มี ('image', 'audio') ฉากที่ทำเสร็จแล้วจะได้ list ว่าง"""
+    missing = []
+    if scene.get("image_prompt") and not scene.get("image_url"):
+        missing.append('image')
+    if scene.get("narration") and not scene.get("audio_url"):
+        missing.append('audio')
+    return missing
+
+
+class DocumentWatcher:
+    """
+    ติดตามเอกสารโปรเจกต์ผ่าน on_snapshot ให้แผนกปลายทางเห็นฉากใหม่ทันทีที่แผนกต้นทางเขียนลงมา
+    """
+
+    def __init__(self, doc_ref):
+        self._condition = threading.Condition()
+        self._data = None
+        self._version = 0
+        self._seen_version = 0
+        self._watch = doc_ref.on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._condition:
+            self._data = docs[0].to_dict() if docs and docs[0].exists else {}
+            self._version += 1
+            self._condition.notify_all()
+
+    def latest(self, timeout=STREAM_IDLE_TIMEOUT_SECONDS):
+        """คืนข้อมูลล่าสุดของเอกสาร (รอ snapshot แรกถ้ายังไม่มา)"""
+        with self._condition:
+            if self._data is None and not self._condition.wait_for(lambda: self._data is not None, timeout):
+                raise TimeoutError("No snapshot received for the project document.")
+            self._seen_version = self._version
+            return self._data
+
+    def wait_for_change(self, timeout=STREAM_IDLE_TIMEOUT_SECONDS):
+        """รอจนกว่าเอกสารจะเปลี่ยนจากครั้งล่าสุดที่อ่าน คืนค่า False ถ้าครบ timeout โดยไม่มีอะไรเปลี่ยน"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._version > self._seen_version, timeout)
+
+    def close(self):
+        self._watch.unsubscribe()
@@ -0,0 +1,182 @@
+import os
+import time
+import atexit
+import random
+import datetime
+import threading
+from contextlib import contextmanager
+
+# --- 1. การตั้งค่า ---
+QUOTA_SHARE_REFRESH_SECONDS = 30  # ถี่แค่ไหนที่แต่ละ replica ประกาศตัวและคำนวณส่วนแบ่ง quota ใหม่
+QUOTA_SHARE_STALE_SECONDS = 90  # replica ที่ไม่ประกาศตัวนานกว่านี้ถือว่าไม่อยู่แล้ว
+QUOTA_SHARE_GC_LIMIT = 50  # ลบเอกสารของ replica ที่หายไปแล้วได้สูงสุดกี่ตัวต่อรอบ
+THROTTLE_MAX_ATTEMPTS = int(os.environ.get("THROTTLE_MAX_ATTEMPTS", "6"))
+
+
+def is_throttle_error(exception):
+    """ตรวจว่า error มาจากการโดนจำกัด quota (HTTP 429 / gRPC RESOURCE_EXHAUSTED) หรือไม่"""
+    if getattr(exception, "status_code", None) == 429:
+        return True
+    if type(exception).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    message = str(exception)
+    return message.startswith("429") or "RESOURCE_EXHAUSTED" in message or "Quota exceeded" in message
+
+
+# --- 2. Token Bucket: จำกัดจำนวน request ต่อนาที ---
+
+class TokenBucket:
+    """token bucket แบบ thread-safe เติม token ตาม rate_per_minute และสะสมได้ไม่เกิน burst"""
+
+    def __init__(self, rate_per_minute, burst=None):
+        self._lock = threading.Lock()
+        self.rate_per_minute = float(rate_per_minute)
+        self.burst = float(burst or max(1.0, rate_per_minute / 6))
+        self._burst_per_rate = self.burst / max(self.rate_per_minute, 1e-6)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+
+    def set_rate(self, rate_per_minute):
+        """
+        เปลี่ยน rate และปรับ burst ตามสัดส่วนเดิม ไม่เช่นนั้นทุก replica จะยิงเต็ม burst ของ quota ทั้งหมดพร้อมกันได้
+        """
+        with self._lock:
+            self._refill()
+            self.rate_per_minute = float(rate_per_minute)
+            self.burst = max(1.0, self.rate_per_minute * self._burst_per_rate)
+            self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate_per_minute / 60)
+        self._updated_at = now
+
+    def acquire(self):
+        """รอจนกว่าจะมี token ว่าง 1 ตัว"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * 60 / max(self.rate_per_minute, 1e-6)
+            time.sleep(wait)
+
+
+# --- 3. AIMD: ปรับจำนวน request พร้อมกันตามการตอบสนองของ backend ---
+
+class AdaptiveConcurrency:
+    """
+    เพิ่มเพดานทีละนิดเมื่อสำเร็จ (additive increase) และลดครึ่งหนึ่งเมื่อโดน throttle (multiplicative decrease)
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self._condition = threading.Condition()
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= max(self.min_limit, int(self.limit)):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+# --- 4. ส่วนแบ่ง quota ระหว่าง replica ผ่าน Firestore ---
+
+class QuotaShare:
+    """
+    แต่ละ replica ประกาศตัวไว้ที่ rate_limits/{backend}/replicas/{worker_id}
+    แล้วแบ่ง quota ทั้งหมดเท่าๆ กันตามจำนวน replica ที่ยังทำงานอยู่
+    (ไม่ใช้ transaction ต่อ request เพราะ Firestore เขียนเอกสารเดียวได้ประมาณ 1 ครั้งต่อวินาที)
+    replica ลบเอกสารของตัวเองตอนปิด process และทุก replica ช่วยลบเอกสารของ replica ที่หายไปโดยไม่ได้ลบ (เช่นถูก kill)
+    """
+
+    def __init__(self, db, backend, worker_id, quota_per_minute, bucket):
+        self.replicas_ref = db.collection('rate_limits').document(backend).collection('replicas')
+        self.worker_id = worker_id
+        self.quota_per_minute = quota_per_minute
+        self.bucket = bucket
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, daemon=True, name=f"quota-share-{backend}").start()
+        atexit.register(self.close)
+
+    def refresh(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.replicas_ref.document(self.worker_id).set({'seen_at': now})
+        cutoff = now - datetime.timedelta(seconds=QUOTA_SHARE_STALE_SECONDS)
+        active = sum(1 for _ in self.replicas_ref.where('seen_at', '>', cutoff).stream())
+        self.bucket.set_rate(self.quota_per_minute / max(1, active))
+        for snapshot in self.replicas_ref.where('seen_at', '<=', cutoff).limit(QUOTA_SHARE_GC_LIMIT).stream():
+            snapshot.reference.delete()
+
+    def close(self):
+        """หยุดประกาศตัวและลบเอกสารของ replica นี้ ให้ replica อื่นได้ส่วนแบ่งคืนทันทีไม่ต้องรอจนหมดอายุ"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        try:
+            self.replicas_ref.document(self.worker_id).delete()
+        except Exception as e:
+            print(f"  - ⚠️ Could not remove quota share of {self.worker_id}: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"  - ⚠️ Could not refresh quota share: {e}")
+            self._stop.wait(QUOTA_SHARE_REFRESH_SECONDS)
+
+
+# --- 5. Limiter ต่อ backend ---
+
+class BackendLimiter:
+    """
+    รวม token bucket (quota ต่อนาที) กับ AIMD (จำนวนพร้อมกัน) ของ backend หนึ่งตัว
+    ถ้าให้ db และ worker_id มาด้วย quota จะถูกแบ่งกับ replica อื่นผ่าน Firestore
+    """
+
+    def __init__(self, name, quota_per_minute, max_concurrency, db=None, worker_id=None):
+        self.name = name
+        self.bucket = TokenBucket(quota_per_minute)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.quota_share = QuotaShare(db, name, worker_id, quota_per_minute, self.bucket) if db else None
+
+    @contextmanager
+    def slot(self):
+        """จองช่องและ token ก่อนเรียก backend แจ้งผล throttle กลับไปที่ AIMD อัตโนมัติ"""
+        self.concurrency.acquire()
+        throttled = False
+        try:
+            self.bucket.acquire()
+            yield
+        except Exception as e:
+            throttled = is_throttle_error(e)
+            raise
+        finally:
+            self.concurrency.release(throttled=throttled)
+
+    def call(self, fn, max_attempts=THROTTLE_MAX_ATTEMPTS):
+        """เรียก fn() ภายใต้ limiter ถ้าโดน throttle จะรอแบบ backoff แล้วลองใหม่แทนที่จะล้มทันที"""
+        for attempt in range(1, max_attempts + 1):
+            try:
+                with self.slot():
+                    return fn()
+            except Exception as e:
+                if not is_throttle_error(e) or attempt == max_attempts:
+                    raise
+                wait = min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"    - ⏳ {self.name} quota hit, retrying in {wait:.1f}s (limit now {self.concurrency.limit:.1f}).")
+                time.sleep(wait)
@@ -0,0 +1,32 @@
+import time
+from job_queue import STAGES, REAPER_INTERVAL_SECONDS, reap_expired_leases
+from runtime import firestore_client
+
+# --- 1. การตั้งค่า ---
+print("🚀 Starting Lease Reaper...")
+
+# การเชื่อมต่อ GCP ตั้งผ่าน Environment Variable เหมือน Worker ตัวอื่นๆ (ดู runtime.py)
+
+try:
+    db = firestore_client.get()
+    print("✅ Successfully connected to Firestore.")
+except Exception as e:
+    print(f"❌ Reaper failed to initialize: {e}")
+    exit()
+
+
+# --- 2. Main Loop: คืนงานที่ lease หมดอายุของทุกแผนก ---
+# ใช้ในกรณีที่บางแผนกไม่มี Worker รันอยู่ (ปกติ Worker แต่ละตัวจะคืนงานของแผนกตัวเองอยู่แล้ว)
+def main_loop():
+    print(f"\n👂 Reaper is checking expired leases every {REAPER_INTERVAL_SECONDS:.0f}s...")
+    while True:
+        for stage, (pending_status, processing_status, failed_status) in STAGES.items():
+            try:
+                reap_expired_leases(db, pending_status, processing_status, failed_status)
+            except Exception as e:
+                print(f"\n🚨 Reaper error for stage '{stage}': {e}")
+        print(".", end="", flush=True)
+        time.sleep(REAPER_INTERVAL_SECONDS)
+
+if __name__ == "__main__":
+    main_loop()
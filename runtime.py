@@ -0,0 +1,98 @@
+import os
+import time
+import threading
+from backends import make_bucket, make_firestore
+
+# --- 1. การตั้งค่าที่ทุก Worker ใช้ร่วมกัน (อ่านจาก Environment Variable) ---
+# ค่าเริ่มต้น "" = ใช้ Application Default Credentials (เช่น service account ของ Cloud Run)
+# ตั้ง GCP_KEY_FILE_PATH เป็น path ของไฟล์ key เมื่อรันบนเครื่องที่ไม่มี ADC
+GCP_KEY_FILE_PATH = os.environ.get("GCP_KEY_FILE_PATH", "")
+GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "youtubeubload")
+GCP_LOCATION = os.environ.get("GCP_LOCATION", "asia-southeast1")
+BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME", "ai-story-factory-assets-nattapobiz")
+# WORKER_PRELOAD=1: โหลด client ที่หนักใน thread พื้นหลังทันทีที่พร้อมรับงาน (งานแรกไม่ต้องรอ) แต่ไม่ทำให้เริ่มช้าลง
+WORKER_PRELOAD = os.environ.get("WORKER_PRELOAD", "0") == "1"
+
+
+def _process_started_at():
+    """เวลาที่ process เริ่มจริง (รวมเวลา import ก่อนถึงโมดูลนี้) อ่านจาก /proc บน Linux"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+
+PROCESS_STARTED_AT = _process_started_at()
+LOAD_SECONDS = {}  # ชื่อ client -> เวลาที่ใช้สร้าง (วินาที)
+
+
+# --- 2. Client ที่สร้างเมื่อถูกใช้ครั้งแรก ---
+
+class Lazy:
+    """
+    สร้าง object ด้วย factory ครั้งแรกที่ถูกใช้ (thread-safe) แล้วใช้ตัวเดิมตลอดอายุ process
+    เรียก attribute ผ่าน Lazy ได้เหมือน object จริง (เช่น image_model.generate_images(...))
+    ถ้าต้องส่ง object จริงเข้า library อื่นให้ใช้ .get()
+    """
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded = False
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    started = time.perf_counter()
+                    self._value = self._factory()
+                    self._loaded = True
+                    LOAD_SECONDS[self.name] = time.perf_counter() - started
+                    print(f"  - ⏱️ {self.name} loaded in {LOAD_SECONDS[self.name]:.2f}s (first use).")
+        return self._value
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.get(), attr)
+
+
+def preload(*lazies):
+    """โหลด client ล่วงหน้าใน thread พื้นหลังเมื่อเปิด WORKER_PRELOAD (error จะเกิดซ้ำตอนงานแรกใช้จริง)"""
+    def run():
+        for lazy in lazies:
+            try:
+                lazy.get()
+            except Exception as e:
+                print(f"  - ⚠️ Could not preload {lazy.name}: {e}")
+
+    if WORKER_PRELOAD and lazies:
+        threading.Thread(target=run, daemon=True, name="preload").start()
+
+
+# Firestore และ Bucket ใช้ร่วมกันทุกแผนกที่รันใน process เดียวกัน (ดู worker.py)
+firestore_client = Lazy("Firestore", lambda: make_firestore(GCP_PROJECT_ID, GCP_KEY_FILE_PATH))
+storage_bucket = Lazy("Cloud Storage", lambda: make_bucket(GCP_PROJECT_ID, BUCKET_NAME, GCP_KEY_FILE_PATH))
+
+
+# --- 3. รายงานเวลาเริ่มต้น ---
+
+def report_startup(stage):
+    """พิมพ์เวลาตั้งแต่ process เริ่มจนพร้อมจองงาน และบันทึกลง metric pipeline_startup_seconds"""
+    from metrics import STARTUP_SECONDS
+
+    elapsed = time.time() - PROCESS_STARTED_AT
+    STARTUP_SECONDS.set(round(elapsed, 3), stage=stage)
+    loaded = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in LOAD_SECONDS.items())
+    print(f"⏱️ '{stage}' worker ready in {elapsed:.2f}s since process start" + (f" (loaded: {loaded})" if loaded else "") + ".")
+    return elapsed
@@ -0,0 +1,240 @@
+import os
+import sys
+from google.cloud import firestore
+from pipeline_stream import missing_assets
+
+# --- 1. การตั้งค่า ---
+# รูปแบบการเก็บฉากของโปรเจกต์ใหม่:
+#   'embedded'      = เก็บเป็น array 'scenes' ในเอกสารโปรเจกต์ (แบบเดิม)
+#   'subcollection' = เก็บทีละฉากที่ projects/{id}/scenes/scene_0001 และเก็บแค่สรุปไว้ที่เอกสารโปรเจกต์
+# แต่ละโปรเจกต์จำรูปแบบของตัวเองไว้ใน field 'scene_storage' จึงอ่านโปรเจกต์เก่าได้เสมอ
+SCENE_STORAGE = os.environ.get("SCENE_STORAGE", "embedded")
+SCENES_COLLECTION = "scenes"
+BATCH_LIMIT = 450  # Firestore รับได้ไม่เกิน 500 การเขียนต่อ batch เผื่อที่ให้เอกสารโปรเจกต์
+# สถานะที่มี Worker ถืองานอยู่ ห้าม migrate ระหว่างนี้
+BUSY_STATUSES = ('script_processing', 'assets_processing', 'compiling')
+
+
+def uses_subcollection(doc_data):
+    return (doc_data or {}).get('scene_storage') == 'subcollection'
+
+
+def scene_doc_id(index):
+    return f"scene_{index + 1:04d}"
+
+
+def scenes_collection(doc_ref):
+    return doc_ref.collection(SCENES_COLLECTION)
+
+
+def summarize(scenes):
+    """สรุปความคืบหน้าที่เก็บไว้ที่เอกสารโปรเจกต์ (หน้า Dashboard อ่านแค่นี้ ไม่ต้องโหลดฉาก)"""
+    return {
+        'scene_count': len(scenes),
+        'scenes_ready': sum(1 for scene in scenes if not scene.get('error') and not missing_assets(scene)),
+        'scenes_failed': sum(1 for scene in scenes if scene.get('error')),
+    }
+
+
+# --- 2. อ่านฉาก (รองรับทั้งสองรูปแบบ) ---
+
+def read_scenes(doc_ref, doc_data, start=0):
+    """
+    คืน list ของฉากเรียงตามลำดับ ตั้งแต่ฉากที่ start (นับจาก 0)
+    โปรเจกต์แบบเดิมอ่านจาก array 'scenes' โปรเจกต์แบบ subcollection อ่านเฉพาะเอกสารฉากที่ต้องใช้
+    """
+    if not uses_subcollection(doc_data):
+        return list(doc_data.get('scenes', []))[start:]
+    query = scenes_collection(doc_ref).order_by('scene_index')
+    if start:
+        query = query.where('scene_index', '>=', start)
+    return [snapshot.to_dict() for snapshot in query.stream()]
+
+
+# --- 3. เขียนฉาก ---
+# fence (ถ้ามี) คือ callable จาก job_queue.job_fence(): รับ apply(writer) แล้วเขียนใน transaction
+# เฉพาะเมื่อ Worker ยังถือ lease ของงานอยู่ ใช้กับการเขียนที่เปลี่ยนสถานะโปรเจกต์
+
+def _commit(db, apply, fence=None):
+    """เขียนชุดเดียวผ่าน batch ปกติ หรือผ่าน fence (transaction มี set/update/delete เหมือน batch)"""
+    if fence:
+        fence(apply)
+        return
+    batch = db.batch()
+    apply(batch)
+    batch.commit()
+
+
+def _commit_in_batches(db, writes, parent_ref, parent_update, fence=None):
+    """
+    เขียน writes [(ref, data, merge)] แบ่งเป็นหลาย batch แล้วอัปเดตเอกสารโปรเจกต์ใน batch สุดท้าย
+    (เอกสารโปรเจกต์เปลี่ยนหลังจากฉากทั้งหมดถูกเขียนแล้ว ผู้อ่านจึงไม่เห็นข้อมูลครึ่งๆ กลางๆ)
+    ถ้ามี fence จะใช้กับ batch สุดท้ายที่มีการอัปเดตเอกสารโปรเจกต์
+    """
+    def apply_chunk(chunk, is_last):
+        def apply(writer):
+            for ref, data, merge in chunk:
+                if data is None:
+                    writer.delete(ref)
+                elif merge:
+                    writer.update(ref, data)
+                else:
+                    writer.set(ref, data)
+            if is_last and parent_update:
+                writer.update(parent_ref, parent_update)
+        return apply
+
+    for start in range(0, len(writes), BATCH_LIMIT):
+        is_last = start + BATCH_LIMIT >= len(writes)
+        _commit(db, apply_chunk(writes[start:start + BATCH_LIMIT], is_last), fence if is_last and parent_update else None)
+    if not writes and parent_update:
+        _commit(db, apply_chunk([], True), fence)
+
+
+def write_scenes(db, doc_ref, scenes, parent_update, storage=SCENE_STORAGE, fence=None):
+    """
+    บันทึกฉากทั้งหมดของโปรเจกต์ (แทนที่ของเดิม) พร้อมกับ parent_update ของเอกสารโปรเจกต์
+    ใช้รูปแบบตาม storage และบันทึกรูปแบบนั้นลงเอกสารเพื่อให้แผนกถัดไปอ่านถูก
+    """
+    parent_update = dict(parent_update)
+    if storage != 'subcollection':
+        parent_update.update({'scenes': scenes, 'scene_storage': 'embedded', **summarize(scenes)})
+        _commit(db, lambda writer: writer.update(doc_ref, parent_update), fence)
+        return
+
+    writes = []
+    for i, scene in enumerate(scenes):
+        writes.append((scenes_collection(doc_ref).document(scene_doc_id(i)), {**scene, 'scene_index': i}, False))
+    # ลบฉากเก่าที่เกินจำนวนใหม่ (เช่น สร้างบทใหม่แล้วได้ฉากน้อยลง)
+    stale = scenes_collection(doc_ref).where('scene_index', '>=', len(scenes))
+    for snapshot in stale.stream():
+        writes.append((snapshot.reference, None, False))
+    parent_update.update({
+        'scenes': firestore.DELETE_FIELD,
+        'scene_storage': 'subcollection',
+        **summarize(scenes),
+    })
+    _commit_in_batches(db, writes, doc_ref, parent_update, fence)
+
+
+def append_scene(db, doc_ref, index, scene, parent_update=None, storage=SCENE_STORAGE, fence=None):
+    """
+    เพิ่มฉากที่ index ต่อท้าย (ใช้ตอนบทถูก stream มาทีละฉาก)
+    ฉากแรก (index 0) จะเริ่มโปรเจกต์ด้วยรูปแบบตาม storage ฉากถัดไปใช้รูปแบบเดียวกัน
+    """
+    # scene_index ทำให้ทุกฉากไม่ซ้ำกัน (ArrayUnion จะไม่เพิ่มค่าที่ซ้ำกัน) และใช้เรียงลำดับใน subcollection
+    scene = {**scene, 'scene_index': index}
+    update = dict(parent_update or {})
+    if storage != 'subcollection':
+        update['scenes'] = [scene] if index == 0 else firestore.ArrayUnion([scene])
+        if index == 0:
+            update['scene_storage'] = 'embedded'
+        update['scene_count'] = index + 1
+        _commit(db, lambda writer: writer.update(doc_ref, update), fence)
+        return
+
+    update['scene_count'] = index + 1 # ให้ผู้ที่ติดตามเอกสารโปรเจกต์รู้ว่ามีฉากใหม่
+    stale_refs = []
+    if index == 0:
+        update.update({'scenes': firestore.DELETE_FIELD, 'scene_storage': 'subcollection'})
+        # ลบฉากจากรอบก่อน (ถ้าเคยสร้างบทนี้แล้วล้มกลางทาง)
+        stale_refs = [snapshot.reference for snapshot in
+                      scenes_collection(doc_ref).where('scene_index', '>=', 1).limit(BATCH_LIMIT).stream()]
+
+    def apply(writer):
+        for ref in stale_refs:
+            writer.delete(ref)
+        writer.set(scenes_collection(doc_ref).document(scene_doc_id(index)), scene)
+        writer.update(doc_ref, update)
+    _commit(db, apply, fence)
+
+
+def update_scene(db, doc_ref, index, fields):
+    """
+    อัปเดตเฉพาะ field ของฉากเดียวในโปรเจกต์แบบ subcollection (ไม่ชนกับฉากอื่นที่เขียนพร้อมกัน)
+    และเพิ่มตัวนับความคืบหน้าที่เอกสารโปรเจกต์ไปพร้อมกัน
+    """
+    scene_fields = {key: firestore.DELETE_FIELD if value is None else value for key, value in fields.items()}
+    counter = 'scenes_failed' if fields.get('error') else 'scenes_ready'
+    batch = db.batch()
+    batch.update(scenes_collection(doc_ref).document(scene_doc_id(index)), scene_fields)
+    batch.update(doc_ref, {counter: firestore.Increment(1)})
+    batch.commit()
+
+
+def clear_scene_fields(db, doc_ref, indexes, fields):
+    """ลบ field (เช่น error จากรอบก่อน) ของหลายฉากด้วย batch เดียว"""
+    writes = [
+        (scenes_collection(doc_ref).document(scene_doc_id(i)), {field: firestore.DELETE_FIELD for field in fields}, True)
+        for i in indexes
+    ]
+    _commit_in_batches(db, writes, doc_ref, None)
+
+
+# --- 4. Migration ของโปรเจกต์เก่า ---
+
+class ProjectChangedError(Exception):
+    """เอกสารโปรเจกต์ถูกเขียนหลังจากที่อ่านมา (เช่น Worker จองงานไประหว่าง migrate)"""
+
+
+def _unchanged_fence(db, doc_ref, update_time):
+    """fence ที่เขียนเฉพาะเมื่อเอกสารโปรเจกต์ยังไม่ถูกแก้ตั้งแต่ update_time (ไม่เช่นนั้นโยน ProjectChangedError)"""
+    @firestore.transactional
+    def write(transaction, apply):
+        snapshot = doc_ref.get(transaction=transaction)
+        if not snapshot.exists or snapshot.update_time != update_time:
+            raise ProjectChangedError(f"Project {doc_ref.id} changed during migration.")
+        apply(transaction)
+
+    return lambda apply: write(db.transaction(), apply)
+
+
+def migrate_project(db, snapshot):
+    """
+    ย้าย array 'scenes' ของโปรเจกต์แบบเดิมไปเป็น subcollection
+    คืนค่า False ถ้าข้ามไป (ย้ายแล้ว, มี Worker ถืองานอยู่ หรือเอกสารเปลี่ยนหลังจากที่อ่านมา)
+    """
+    doc_data = snapshot.to_dict() or {}
+    if uses_subcollection(doc_data) or doc_data.get('status') in BUSY_STATUSES:
+        return False
+    scenes = [dict(scene) for scene in doc_data.get('scenes', [])]
+    # รวม checkpoint ของ Asset Worker ที่ค้างอยู่ (ถ้ามี) เข้าไปในฉากก่อนย้าย
+    for i, scene in enumerate(scenes):
+        scene.update(doc_data.get('scene_assets', {}).get(f'scene_{i + 1}', {}))
+    # เอกสารโปรเจกต์จะเปลี่ยนรูปแบบเฉพาะเมื่อไม่มีใครเขียนทับระหว่างนี้ (Worker ที่จองงานพร้อมกันจะเขียนแบบเดิมต่อได้)
+    # ฉากที่เขียนลง subcollection ไปก่อนแล้วจะถูกข้ามเพราะ scene_storage ยังเป็น 'embedded' และถูกเขียนทับในรอบถัดไป
+    try:
+        write_scenes(db, snapshot.reference, scenes, {'scene_assets': firestore.DELETE_FIELD}, storage='subcollection',
+                     fence=_unchanged_fence(db, snapshot.reference, snapshot.update_time))
+    except ProjectChangedError as e:
+        print(f"  - ⚠️ {e} Skipped; run the migration again later.")
+        return False
+    return True
+
+
+def migrate_all(db, dry_run=False):
+    migrated = skipped = 0
+    for snapshot in db.collection('projects').stream():
+        doc_data = snapshot.to_dict() or {}
+        if uses_subcollection(doc_data) or doc_data.get('status') in BUSY_STATUSES:
+            skipped += 1
+            continue
+        print(f"  - Migrating project {snapshot.id} ({len(doc_data.get('scenes', []))} scenes)...")
+        if dry_run or migrate_project(db, snapshot):
+            migrated += 1
+        else:
+            skipped += 1
+    return migrated, skipped
+
+
+if __name__ == "__main__":
+    from runtime import firestore_client
+
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("Usage: python scene_store.py migrate [--dry-run]")
+        sys.exit(1)
+
+    dry_run = "--dry-run" in sys.argv[2:]
+    db = firestore_client.get()  # ตั้งค่าการเชื่อมต่อผ่าน Environment Variable (ดู runtime.py)
+    migrated, skipped = migrate_all(db, dry_run=dry_run)
+    print(f"✅ {'Would migrate' if dry_run else 'Migrated'} {migrated} projects ({skipped} skipped).")
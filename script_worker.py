@@ -1,41 +1,58 @@
 import os
-import time
-import requests
+import json
 from google.cloud import firestore
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import retry, retry_if_exception, stop_after_attempt
+from job_queue import LeaseLostError, check_lease, fenced_update, job_fence, make_worker_id, run_worker
+from runtime import firestore_client, report_startup
+from http_client import CircuitBreaker, is_retryable, make_session, post_json, wait_retry_after_or_backoff
+from rate_limiter import BackendLimiter
+from pipeline_stream import PIPELINE_STREAMING
+from scene_store import append_scene, write_scenes
+from metrics import span
 
 # --- 1. การตั้งค่า (Configuration) ---
 print("🚀 Starting Script Writer Worker (v2.0 with Retry Logic)...")
 
-# ตั้งค่าการเชื่อมต่อ Google Cloud (อ่านไฟล์ key โดยตรง)
-# ตรวจสอบให้แน่ใจว่า Path และชื่อไฟล์ถูกต้อง
-GCP_KEY_FILE_PATH = "E:\\streamlit-story-app\\youtubeubload.json"
-GCP_PROJECT_ID = "youtubeubload"
-
-# ตรวจสอบให้แน่ใจว่า URL ของ Replit API ถูกต้อง
-REPLIT_API_URL = "https://83ad9944-9259-4aa1-a670-43bf9d023e8e-00-2bt3s9wflkig.worf.replit.dev/generate"
-
-try:
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GCP_KEY_FILE_PATH
-    if not os.path.exists(GCP_KEY_FILE_PATH):
-        raise FileNotFoundError(f"Key file not found at: {GCP_KEY_FILE_PATH}")
-    
-    # เชื่อมต่อกับ Firestore
-    db = firestore.Client(project=GCP_PROJECT_ID)
+# การเชื่อมต่อ Google Cloud (GCP_KEY_FILE_PATH, GCP_PROJECT_ID) ตั้งผ่าน Environment Variable ดู runtime.py
+
+# ตรวจสอบให้แน่ใจว่า URL ของ Replit API ถูกต้อง (ตั้ง SCRIPT_API_URL เพื่อชี้ไปที่ stub server ตอนทดสอบได้)
+REPLIT_API_URL = os.environ.get(
+    "SCRIPT_API_URL",
+    "https://83ad9944-9259-4aa1-a670-43bf9d023e8e-00-2bt3s9wflkig.worf.replit.dev/generate"
+)
+
+# --- การเรียก API: จำนวน request พร้อมกัน, retry และ circuit breaker ---
+SCRIPT_CONCURRENCY = int(os.environ.get("SCRIPT_CONCURRENCY", "4")) # จำนวนบทที่เขียนพร้อมกันได้
+SCRIPT_API_TIMEOUT = (10, 90) # (connect, read) วินาที
+SCRIPT_API_MAX_ATTEMPTS = int(os.environ.get("SCRIPT_API_MAX_ATTEMPTS", "5"))
+SCRIPT_API_QUOTA_PER_MINUTE = int(os.environ.get("SCRIPT_API_QUOTA_PER_MINUTE", "30"))
+
+# ใช้ session เดียวทั้ง process เพื่อให้ connection ถูกใช้ซ้ำ (keep-alive)
+api_session = make_session(SCRIPT_CONCURRENCY)
+api_breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+
+WORKER_ID = make_worker_id("script")
+db = None
+script_limiter = None
+
+
+def init():
+    """เชื่อมต่อ Firestore (หรือ Emulator ถ้าตั้ง FIRESTORE_EMULATOR_HOST ไว้) ตอนเริ่ม main_loop ไม่ใช่ตอน import"""
+    global db, script_limiter
+    db = firestore_client.get()
+    script_limiter = BackendLimiter("script_api", SCRIPT_API_QUOTA_PER_MINUTE, SCRIPT_CONCURRENCY, db=db, worker_id=WORKER_ID)
     print("✅ Successfully connected to Firestore.")
-except Exception as e:
-    print(f"❌ Worker failed to initialize: {e}")
-    exit() # ออกจากโปรแกรมถ้าตั้งค่าไม่สำเร็จ
 
 
 # --- 2. ฟังก์ชันการทำงานหลักของ Worker ---
 
 # Decorator @retry จะทำงานกับฟังก์ชันนี้โดยเฉพาะ
-# ถ้าฟังก์ชันนี้เกิด Exception (เช่น HTTP 503), tenacity จะสั่งให้รันฟังก์ชันนี้ใหม่
+# ลองใหม่เฉพาะ error ที่ชั่วคราว (เชื่อมต่อไม่ได้, timeout, 429, 5xx, circuit เปิด) ส่วน 4xx อื่นๆ จะไม่ลองซ้ำ
 @retry(
-    stop=stop_after_attempt(3), # พยายามใหม่สูงสุด 3 ครั้ง
-    wait=wait_fixed(15), # แต่ละครั้งให้รอ 15 วินาที (เพื่อให้ Replit มีเวลาตื่น)
-    reraise=True # ถ้าลองครบ 3 ครั้งแล้วยังพลาด ให้โยน Error สุดท้ายออกมา
+    stop=stop_after_attempt(SCRIPT_API_MAX_ATTEMPTS),
+    wait=wait_retry_after_or_backoff(multiplier=2, max_wait=60), # ใช้ Retry-After ถ้ามี ไม่เช่นนั้น backoff + jitter
+    retry=retry_if_exception(is_retryable),
+    reraise=True # ถ้าลองครบแล้วยังพลาด ให้โยน Error สุดท้ายออกมา
 )
 def call_replit_api(topic, style):
     """
@@ -43,12 +60,78 @@ def call_replit_api(topic, style):
     """
     print("    - Attempting to call Replit API...")
     payload = {"topic": topic, "style": style}
-    response = requests.post(REPLIT_API_URL, json=payload, timeout=90) # เพิ่ม timeout เป็น 90 วิ
-    response.raise_for_status() # ถ้าเจอ Error (เช่น 4xx, 5xx), tenacity จะดักจับและสั่งให้ลองใหม่
+    # limiter จำกัด quota ต่อนาที และลดจำนวน request พร้อมกันเมื่อเจอ 429 (retry ทำโดย tenacity)
+    with script_limiter.slot(), span('script_api'):
+        response = post_json(api_session, api_breaker, REPLIT_API_URL, payload, timeout=SCRIPT_API_TIMEOUT)
     print("    - Call to Replit API successful.")
     return response.json()
 
 
+@retry(
+    stop=stop_after_attempt(SCRIPT_API_MAX_ATTEMPTS),
+    wait=wait_retry_after_or_backoff(multiplier=2, max_wait=60),
+    retry=retry_if_exception(is_retryable),
+    reraise=True
+)
+def open_replit_stream(topic, style):
+    """
+    เปิด stream ของบทจาก Replit API (NDJSON หรือ SSE) retry เฉพาะตอนเปิด connection
+    เมื่อเริ่มได้รับฉากแล้วจะไม่ลองใหม่ เพราะฉากที่ได้ถูกเขียนลง Firestore ไปแล้ว
+    """
+    print("    - Attempting to open Replit API stream...")
+    payload = {"topic": topic, "style": style, "stream": True}
+    with script_limiter.slot(), span('script_api_stream_open'):
+        return post_json(api_session, api_breaker, REPLIT_API_URL, payload, timeout=SCRIPT_API_TIMEOUT, stream=True)
+
+
+def iter_stream_scenes(response):
+    """อ่านฉากทีละบรรทัดจาก response แบบ NDJSON ({"scene": {...}}) หรือ SSE (data: {...}) จนเจอ {"done": true}"""
+    if response.encoding is None:
+        response.encoding = "utf-8" # NDJSON ไม่มี charset ใน header ถ้าไม่กำหนด iter_lines จะคืน bytes
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or line.startswith(":"):
+            continue
+        if line.startswith("data:"):
+            line = line[len("data:"):].strip()
+        message = json.loads(line)
+        if message.get("done"):
+            return
+        if message.get("error"):
+            raise ValueError(f"Replit API stream error: {message['error']}")
+        if message.get("scene"):
+            yield message["scene"]
+
+
+def process_script_stream(doc_id, topic, style):
+    """
+    เขียนฉากลง Firestore ทีละฉากตามที่ได้รับ และส่งงานให้แผนก Asset ตั้งแต่ฉากแรก
+    (script_streaming = True บอกแผนก Asset ว่ายังมีฉากตามมาอีก)
+    """
+    doc_ref = db.collection('projects').document(doc_id)
+    response = open_replit_stream(topic, style)
+    scene_count = 0
+    with response:
+        for scene in iter_stream_scenes(response):
+            check_lease()
+            handoff = {
+                'status': 'assets_pending', # <-- ส่งต่องานให้แผนกถัดไปทันทีที่ได้ฉากแรก
+                'script_streaming': True,
+            } if scene_count == 0 else None
+            # การส่งต่องานต้องทำเฉพาะเมื่อยังถือ lease อยู่ หลังจากนั้นงานเป็นของแผนกถัดไปแล้ว
+            append_scene(db, doc_ref, scene_count, scene, handoff, fence=job_fence() if handoff else None)
+            scene_count += 1
+            print(f"    - Scene {scene_count} received and written.")
+
+    if not scene_count:
+        raise ValueError("Replit API stream did not contain any scenes.")
+    doc_ref.update({
+        'script_streaming': False,
+        'script_completed_at': firestore.SERVER_TIMESTAMP,
+        'error_message': firestore.DELETE_FIELD
+    })
+    return scene_count
+
+
 def process_script_request(doc_id, doc_data):
     """
     รับข้อมูลโปรเจกต์, เรียก Replit API, และอัปเดต Firestore
@@ -59,10 +142,15 @@ def process_script_request(doc_id, doc_data):
 
     if not topic:
         print(f"  - ❌ Error: Topic is missing in project {doc_id}. Marking as failed.")
-        db.collection('projects').document(doc_id).update({'status': 'script_failed', 'error_message': 'Topic is missing'})
+        fenced_update(db.collection('projects').document(doc_id), {'status': 'script_failed', 'error_message': 'Topic is missing'})
         return
 
     try:
+        if PIPELINE_STREAMING:
+            scene_count = process_script_stream(doc_id, topic, style)
+            print(f"  - ✅ Project {doc_id} script streamed successfully ({scene_count} scenes).")
+            return
+
         # เรียกฟังก์ชันใหม่ที่มี @retry ครอบอยู่
         story_data = call_replit_api(topic, style)
         
@@ -72,55 +160,44 @@ def process_script_request(doc_id, doc_data):
 
         # อัปเดต Document ใน Firestore
         print(f"  - Received {len(scenes)} scenes. Updating Firestore for project {doc_id}...")
-        db.collection('projects').document(doc_id).update({
-            'scenes': scenes,
+        write_scenes(db, db.collection('projects').document(doc_id), scenes, {
             'status': 'assets_pending', # <-- เปลี่ยนสถานะเพื่อส่งต่องานให้แผนกถัดไป
             'script_completed_at': firestore.SERVER_TIMESTAMP,
             'error_message': firestore.DELETE_FIELD # ลบฟิลด์ error ถ้ามี
-        })
+        }, fence=job_fence())
         print(f"  - ✅ Project {doc_id} script generation completed successfully.")
 
+    except LeaseLostError:
+        raise # งานถูกคืนไปแล้ว ห้ามเขียน script_failed ทับผลของ Worker ที่ได้งานไป
     except Exception as e:
         error_message = f"Failed after multiple retries: {e}"
         print(f"  - ❌ An error occurred for project {doc_id}: {error_message}")
-        db.collection('projects').document(doc_id).update({
+        failure_update = {
             'status': 'script_failed',
             'error_message': error_message
-        })
+        }
+        doc_ref = db.collection('projects').document(doc_id)
+        if PIPELINE_STREAMING:
+            # แผนกถัดไปอาจเริ่มงานแล้ว การเปลี่ยนเป็น script_failed จะทำให้แผนกนั้นหยุดด้วย
+            # (สถานะอาจไม่ใช่ script_processing แล้วจึงใช้ fence ไม่ได้ ตรวจแค่ว่า heartbeat ยังไม่พบว่าเสีย lease)
+            failure_update['script_streaming'] = False
+            check_lease()
+            doc_ref.update(failure_update)
+        else:
+            fenced_update(doc_ref, failure_update)
 
 
 # --- 3. Main Loop: วงจรการทำงานที่ไม่สิ้นสุด ---
 def main_loop():
+    try:
+        init()
+    except Exception as e:
+        print(f"❌ Worker failed to initialize: {e}")
+        exit() # ออกจากโปรแกรมถ้าตั้งค่าไม่สำเร็จ
+    report_startup('script')
     print("\n👂 Worker is listening for new projects with status 'script_pending'...")
-    while True:
-        try:
-            # Query หาโปรเจกต์ที่ยังรอทำบท
-            projects_ref = db.collection('projects')
-            # หมายเหตุ: UserWarning ที่เกิดขึ้นตรงนี้เป็นเรื่องปกติของ Library และไม่มีผลกับการทำงาน
-            query = projects_ref.where('status', '==', 'script_pending').limit(1) 
-            docs = query.stream()
-
-            found_job = False
-            for doc in docs:
-                found_job = True
-                doc_id = doc.id
-                print(f"\n✨ Found a new job! Project ID: {doc_id}")
-                
-                # ล็อคงานโดยการเปลี่ยนสถานะทันที
-                projects_ref.document(doc_id).update({'status': 'script_processing'})
-                
-                # เริ่มทำงาน
-                process_script_request(doc_id, doc.to_dict())
-            
-            if not found_job:
-                # ถ้าไม่เจองาน, ให้รอสักครู่ก่อนถามใหม่
-                # พิมพ์ . เพื่อให้รู้ว่ายังทำงานอยู่
-                print(".", end="", flush=True) 
-                time.sleep(10) # รอ 10 วินาที
-
-        except Exception as e:
-            print(f"\n\n🚨 An critical error occurred in the main loop: {e}\n\n")
-            time.sleep(30) # ถ้าเกิด Error ใหญ่ ให้รอ 30 วินาทีก่อนลองใหม่
+    # จองงานแบบ atomic ผ่าน job_queue เพื่อให้รันหลาย replica พร้อมกันได้
+    run_worker(db, 'script', process_script_request, WORKER_ID, max_in_flight=SCRIPT_CONCURRENCY)
 
 if __name__ == "__main__":
     main_loop()
\ No newline at end of file
@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stub server แทน Replit API สำหรับทดสอบ Script Worker ในเครื่อง
+# จำลอง latency และ 503 (พร้อม Retry-After) ได้ผ่าน Environment Variable
+# วิธีใช้:
+#   STUB_LATENCY_SECONDS=2 STUB_ERROR_RATE=0.3 python stub_script_server.py
+#   SCRIPT_API_URL=http://localhost:8765/generate python script_worker.py
+# ถ้า payload มี "stream": true จะตอบเป็น NDJSON ทีละฉาก (ใช้กับ PIPELINE_STREAMING=1)
+
+PORT = int(os.environ.get("STUB_PORT", "8765"))
+LATENCY_SECONDS = float(os.environ.get("STUB_LATENCY_SECONDS", "1.0"))
+ERROR_RATE = float(os.environ.get("STUB_ERROR_RATE", "0.0"))  # สัดส่วน request ที่จะตอบ 503
+RETRY_AFTER_SECONDS = os.environ.get("STUB_RETRY_AFTER", "2")  # ค่า Retry-After ที่ส่งกลับไปกับ 503 (ว่าง = ไม่ส่ง)
+NUM_SCENES = int(os.environ.get("STUB_SCENES", "6"))
+SCENE_INTERVAL_SECONDS = float(os.environ.get("STUB_SCENE_INTERVAL_SECONDS", "1.0"))  # เวลาระหว่างฉากในโหมด stream
+
+
+def build_story(topic, style):
+    """สร้างบทจำลองที่มีโครงสร้างเหมือน Replit API"""
+    return {
+        "scenes": [
+            {
+                "narration": f"Scene {i + 1} of a story about {topic}, told as {style}.",
+                "image_prompt": f"{style} illustration of {topic}, scene {i + 1}",
+            }
+            for i in range(NUM_SCENES)
+        ]
+    }
+
+
+class StubScriptHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # รองรับ keep-alive เหมือน backend จริง
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(LATENCY_SECONDS)
+
+        if random.random() < ERROR_RATE:
+            headers = {"Retry-After": RETRY_AFTER_SECONDS} if RETRY_AFTER_SECONDS else {}
+            self._send_json(503, {"error": "Service warming up"}, headers)
+            return
+        story = build_story(payload.get("topic", "a story"), payload.get("style", "a tale"))
+        if payload.get("stream"):
+            self._stream_scenes(story["scenes"])
+            return
+        self._send_json(200, story)
+
+    def _stream_scenes(self, scenes):
+        """ส่งฉากทีละบรรทัด (NDJSON) แล้วปิดด้วย {"done": true}"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for scene in scenes:
+            self.wfile.write((json.dumps({"scene": scene}) + "\n").encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(SCENE_INTERVAL_SECONDS)
+        self.wfile.write(b'{"done": true}\n')
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("0.0.0.0", PORT), StubScriptHandler)
+    print(f"🧪 Stub script API listening on http://localhost:{PORT}/generate "
+          f"(latency {LATENCY_SECONDS}s, 503 rate {ERROR_RATE:.0%})")
+    server.serve_forever()
@@ -0,0 +1,81 @@
+import io
+import os
+import wave
+import subprocess
+from xml.sax.saxutils import escape
+from video_render import ffmpeg_binary
+
+# --- 1. การตั้งค่า ---
+# Text-to-Speech รับ input ได้ไม่เกิน 5000 bytes ต่อ request เผื่อที่ให้ tag ของ SSML
+TTS_BATCH_MAX_BYTES = int(os.environ.get("TTS_BATCH_MAX_BYTES", "4500"))
+TTS_BATCH_MP3_BITRATE = os.environ.get("TTS_BATCH_MP3_BITRATE", "128k")
+END_MARK = "end"
+
+
+def scene_mark(scene_num):
+    return f"scene_{scene_num}"
+
+
+# --- 2. รวมหลายฉากเป็น SSML เดียว ---
+
+def build_ssml(items):
+    """
+    items = [(scene_num, narration)] ใส่ <mark> หน้าบทบรรยายของแต่ละฉาก และปิดท้ายด้วย mark 'end'
+    เพื่อให้ API คืนเวลาของแต่ละ mark กลับมาใช้ตัดเสียง
+    """
+    parts = [f'<mark name="{scene_mark(scene_num)}"/>{escape(narration)}' for scene_num, narration in items]
+    return "<speak>" + " ".join(parts) + f'<mark name="{END_MARK}"/></speak>'
+
+
+def plan_batches(items, max_bytes=TTS_BATCH_MAX_BYTES):
+    """แบ่งฉากที่ติดกันเป็นกลุ่มที่ SSML ไม่เกิน max_bytes (ฉากที่ยาวเกินเองจะอยู่กลุ่มเดี่ยว)"""
+    batches = []
+    current = []
+    for item in items:
+        if current and len(build_ssml(current + [item]).encode("utf-8")) > max_bytes:
+            batches.append(current)
+            current = []
+        current.append(item)
+    if current:
+        batches.append(current)
+    return batches
+
+
+# --- 3. ตัดเสียงกลับเป็นรายฉาก ---
+
+def split_wav(wav_bytes, cut_seconds):
+    """
+    ตัดไฟล์ WAV (LINEAR16) ตามเวลาใน cut_seconds (จุดเริ่มของแต่ละฉาก ตามด้วยจุดจบ; None = จบไฟล์)
+    ตัดที่ระดับ sample จึงไม่มีเสียงหายหรือซ้ำระหว่างฉาก คืน list ของ WAV bytes
+    """
+    with wave.open(io.BytesIO(wav_bytes)) as source:
+        params = source.getparams()
+        frames = source.readframes(source.getnframes())
+    frame_size = params.sampwidth * params.nchannels
+    total_frames = len(frames) // frame_size
+    offsets = [
+        total_frames if seconds is None else min(total_frames, round(seconds * params.framerate))
+        for seconds in cut_seconds
+    ]
+
+    clips = []
+    for start, end in zip(offsets, offsets[1:]):
+        output = io.BytesIO()
+        with wave.open(output, "wb") as clip:
+            clip.setnchannels(params.nchannels)
+            clip.setsampwidth(params.sampwidth)
+            clip.setframerate(params.framerate)
+            clip.writeframes(frames[start * frame_size:end * frame_size])
+        clips.append(output.getvalue())
+    return clips
+
+
+def wav_to_mp3(wav_bytes, bitrate=TTS_BATCH_MP3_BITRATE):
+    """แปลงเสียงเป็น MP3 ผ่าน ffmpeg ในหน่วยความจำ (Video Worker ยังได้ไฟล์ .mp3 เหมือนเดิม)"""
+    command = [
+        ffmpeg_binary(), "-loglevel", "error",
+        "-f", "wav", "-i", "pipe:0",
+        "-c:a", "libmp3lame", "-b:a", bitrate,
+        "-f", "mp3", "pipe:1",
+    ]
+    return subprocess.run(command, input=wav_bytes, check=True, capture_output=True).stdout
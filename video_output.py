@@ -0,0 +1,159 @@
+import os
+import re
+import math
+import datetime
+import threading
+import subprocess
+from video_render import STREAM_CHUNK_BYTES, ffmpeg_binary
+from metrics import span
+
+# --- 1. การตั้งค่า ---
+# VIDEO_STREAM_UPLOAD: ส่งวิดีโอเต็มเข้า GCS (resumable upload) ระหว่างที่ ffmpeg ยังต่อไฟล์อยู่ ไม่ต้องรอเขียนลงดิสก์ก่อน
+#   (การอัปโหลดซ้อนกับขั้นต่อไฟล์ตอนท้ายเท่านั้น ไม่ได้ซ้อนกับการ encode แต่ละฉาก ซึ่งต้องเสร็จทุกฉากก่อนจึงเริ่มต่อได้)
+# VIDEO_HLS_OUTPUT: อัปโหลด HLS ทีละฉากทันทีที่ฉากนั้น encode เสร็จ ให้เริ่มดูได้ก่อน render ทั้งเรื่องจบ
+VIDEO_STREAM_UPLOAD = os.environ.get("VIDEO_STREAM_UPLOAD", "0") == "1"
+VIDEO_HLS_OUTPUT = os.environ.get("VIDEO_HLS_OUTPUT", "0") == "1"
+# playlist แบบ EVENT ไม่ควรเปลี่ยน TARGETDURATION จึงตั้งค่าเผื่อความยาวฉากไว้ก่อน
+HLS_TARGET_DURATION = int(os.environ.get("HLS_TARGET_DURATION", "30"))
+# Bucket เป็น private จึงใส่ Signed URL ของทุกไฟล์ไว้ใน playlist (0 = ใช้ public URL สำหรับ bucket สาธารณะหรือ emulator)
+HLS_URL_EXPIRATION_HOURS = float(os.environ.get("HLS_URL_EXPIRATION_HOURS", "12"))
+
+
+def open_upload_stream(blob, content_type="video/mp4"):
+    """เปิด resumable upload ของ blob เป็น file object สำหรับเขียน (ส่งขึ้น GCS ทีละ chunk)"""
+    return blob.open("wb", content_type=content_type, chunk_size=STREAM_CHUNK_BYTES)
+
+
+def abort_upload_stream(upload_stream):
+    """
+    ทิ้ง upload ที่ยังไม่จบโดยไม่ยืนยันไฟล์ (ห้ามเรียก close เพราะ close คือการยืนยันไฟล์ที่ยังไม่ครบขึ้น GCS)
+    ถ้า resumable session เริ่มแล้วจะส่ง DELETE ไปที่ session URI เพื่อยกเลิก ไม่ปล่อยค้างไว้จนหมดอายุ
+    """
+    abort = getattr(upload_stream, "abort", None)
+    if abort:
+        abort()
+        return
+    # BlobWriter ของ google-cloud-storage ไม่มี abort จึงยกเลิก session ผ่าน transport ที่มันสร้างไว้
+    upload_and_transport = getattr(upload_stream, "_upload_and_transport", None)
+    if not upload_and_transport:
+        return  # ยังไม่เคยส่ง chunk แรก จึงยังไม่มีอะไรบน GCS
+    upload, transport = upload_and_transport
+    if getattr(upload, "resumable_url", None):
+        try:
+            transport.delete(upload.resumable_url)  # GCS ตอบ 499 เมื่อยกเลิกสำเร็จ
+        except Exception as e:
+            print(f"    - ⚠️ Could not cancel the resumable upload: {e}")
+
+
+def media_duration(path):
+    """อ่านความยาว (วินาที) จาก header ของไฟล์ด้วย ffmpeg -i"""
+    result = subprocess.run([ffmpeg_binary(), "-hide_banner", "-i", path], capture_output=True, text=True)
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", result.stderr)
+    if not match:
+        raise ValueError(f"Could not read the duration of {path}.")
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+# --- 2. HLS ที่อัปโหลดทีละฉาก ---
+
+class HlsPublisher:
+    """
+    แปลง segment ของแต่ละฉากเป็น MPEG-TS แล้วอัปโหลดทันทีที่ฉากนั้นเสร็จ (ลำดับไหนก่อนก็ได้)
+    playlist จะเพิ่มฉากตามลำดับเท่านั้น ฉากที่เสร็จก่อนฉากก่อนหน้าจะรอจนกว่าฉากก่อนหน้าจะมาถึง
+    ทุกฉากเริ่ม timestamp ที่ 0 จึงคั่นด้วย EXT-X-DISCONTINUITY
+    ถ้า url_expiration_hours > 0 ทั้ง playlist และ segment จะอ้างด้วย Signed URL (player อ่าน bucket private ได้)
+    """
+
+    def __init__(self, bucket, prefix, work_dir, url_expiration_hours=HLS_URL_EXPIRATION_HOURS):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.work_dir = work_dir
+        self.url_expiration_hours = url_expiration_hours
+        self._lock = threading.Lock()
+        self._ready = {}  # index -> (URL ของไฟล์ .ts, ความยาว) หรือ None ถ้าฉากนั้นล้มเหลว
+        self._entries = []
+        self._next_index = 0
+        self.playlist_blob = bucket.blob(f"{prefix}/index.m3u8")
+
+    @property
+    def playlist_url(self):
+        return self._blob_url(self.playlist_blob)
+
+    def _blob_url(self, blob):
+        """
+        URL ที่ player ใช้โหลดไฟล์ได้จริง: Signed URL ผูกกับชื่อ blob ไม่ใช่เนื้อหา
+        จึงใช้ URL เดิมของ playlist ได้ตลอดแม้ playlist จะถูกอัปโหลดทับระหว่าง render
+        """
+        if self.url_expiration_hours <= 0:
+            return blob.public_url
+        return blob.generate_signed_url(
+            version="v4", expiration=datetime.timedelta(hours=self.url_expiration_hours), method="GET"
+        )
+
+    def add(self, index, segment_path):
+        """เรียกจาก thread ที่ encode เสร็จ: อัปโหลดฉากนี้แล้วต่อ playlist ให้ยาวที่สุดเท่าที่ลำดับครบ"""
+        entry = None
+        if segment_path:
+            try:
+                entry = self._publish_segment(index, segment_path)
+            except Exception as e:
+                details = getattr(e, 'stderr', b'') or b''
+                print(f"    - ⚠️ Could not publish HLS segment {index + 1}: {e} {details.decode('utf-8', 'ignore').strip()}")
+
+        with self._lock:
+            self._ready[index] = entry
+            advanced = False
+            while self._next_index in self._ready:
+                ready_entry = self._ready.pop(self._next_index)
+                if ready_entry:
+                    self._entries.append(ready_entry)
+                    advanced = True
+                self._next_index += 1
+            if advanced:
+                self._upload_playlist(finished=False)
+
+    def finish(self):
+        """ปิด playlist (EXT-X-ENDLIST) คืนค่าจำนวนฉากที่อยู่ใน playlist"""
+        with self._lock:
+            if self._entries:
+                self._upload_playlist(finished=True)
+            return len(self._entries)
+
+    def _publish_segment(self, index, segment_path):
+        name = f"scene_{index + 1:04d}.ts"
+        ts_path = os.path.join(self.work_dir, f"{os.path.basename(self.prefix)}_{name}")
+        command = [
+            ffmpeg_binary(), "-y", "-loglevel", "error",
+            "-i", segment_path, "-c", "copy", "-f", "mpegts", ts_path,
+        ]
+        subprocess.run(command, check=True, capture_output=True)
+        blob = self.bucket.blob(f"{self.prefix}/{name}")
+        try:
+            duration = media_duration(segment_path)
+            with span('gcs_upload'):
+                blob.upload_from_filename(ts_path, content_type="video/mp2t")
+        finally:
+            os.remove(ts_path)
+        # ชื่อไฟล์แบบ relative ใช้ไม่ได้กับ playlist ที่เปิดผ่าน Signed URL (query string ไม่ถูกส่งต่อ) จึงใส่ URL เต็ม
+        return self._blob_url(blob), duration
+
+    def _upload_playlist(self, finished):
+        target_duration = max([HLS_TARGET_DURATION] + [math.ceil(duration) for _, duration in self._entries])
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-PLAYLIST-TYPE:EVENT",
+            f"#EXT-X-TARGETDURATION:{target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+        ]
+        for i, (url, duration) in enumerate(self._entries):
+            if i:
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines.append(f"#EXTINF:{duration:.3f},")
+            lines.append(url)
+        if finished:
+            lines.append("#EXT-X-ENDLIST")
+        # player จะโหลด playlist ซ้ำเรื่อยๆ ระหว่าง render จึงห้าม cache
+        self.playlist_blob.cache_control = "no-cache, max-age=0"
+        self.playlist_blob.upload_from_string("\n".join(lines) + "\n", content_type="application/vnd.apple.mpegurl")
@@ -0,0 +1,312 @@
+import os
+import hashlib
+import shutil
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from metrics import span
+
+# --- 1. การตั้งค่า ---
+# เลือก engine ได้ด้วย RENDER_ENGINE: 'moviepy' (แบบเดิม) หรือ 'ffmpeg'
+RENDER_ENGINE = os.environ.get("RENDER_ENGINE", "moviepy")
+RENDER_WIDTH = int(os.environ.get("RENDER_WIDTH", "1920"))
+RENDER_HEIGHT = int(os.environ.get("RENDER_HEIGHT", "1080"))
+MOVIEPY_FPS = 24
+# MoviePy แบบ streaming: render ทีละฉากเป็น segment แล้วปิด clip ทันที หน่วยความจำไม่โตตามจำนวนฉาก
+MOVIEPY_STREAMING = os.environ.get("MOVIEPY_STREAMING", "1") == "1"
+# ภาพนิ่งไม่ต้องใช้ fps สูง ลดจำนวนเฟรมที่ต้อง encode ลงมาก
+FFMPEG_FPS = int(os.environ.get("FFMPEG_FPS", "2"))
+FFMPEG_PRESET = os.environ.get("FFMPEG_PRESET", "veryfast")
+FFMPEG_PARALLEL_SEGMENTS = int(os.environ.get("FFMPEG_PARALLEL_SEGMENTS", str(os.cpu_count() or 1)))
+STREAM_CHUNK_BYTES = 8 * 1024 * 1024  # ขนาด chunk ที่ส่งต่อจาก ffmpeg ไปยังปลายทาง (ตรงกับ chunk ของ resumable upload)
+
+
+def ffmpeg_binary():
+    """ใช้ ffmpeg ที่มากับ imageio-ffmpeg (ตัวเดียวกับที่ MoviePy ใช้) ถ้าไม่มีให้ใช้จาก PATH"""
+    if os.environ.get("FFMPEG_BINARY"):
+        return os.environ["FFMPEG_BINARY"]
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return "ffmpeg"
+
+
+def resolve_asset(asset):
+    """
+    asset อาจเป็น dict {'image', 'audio'} หรือ Future ที่จะได้ dict เมื่อดาวน์โหลดเสร็จ
+    รอเฉพาะฉากที่ต้องใช้ เพื่อให้การ encode เริ่มได้ทันทีที่ไฟล์คู่นั้นมาถึง
+    """
+    return asset.result() if isinstance(asset, Future) else asset
+
+
+def engine_fps(engine=RENDER_ENGINE):
+    return MOVIEPY_FPS if engine == "moviepy" else FFMPEG_FPS
+
+
+def supports_segments(engine=RENDER_ENGINE):
+    """engine นี้ render ทีละฉากเป็น segment หรือไม่ (MoviePy แบบ render รวดเดียวไม่มี segment ให้ checkpoint)"""
+    return engine == "ffmpeg" or (engine == "moviepy" and MOVIEPY_STREAMING)
+
+
+def segment_fingerprint(image_blob_name, audio_blob_name, engine=RENDER_ENGINE):
+    """
+    ลายนิ้วมือของ segment: ถ้า asset หรือค่าการ render เปลี่ยน segment เดิมจะใช้ต่อไม่ได้
+    (ต้องตรงกันทุก segment จึงจะต่อแบบ stream copy ได้ engine ต่างกันให้ fps และ encoder ต่างกัน จึงนับรวมด้วย)
+    """
+    settings = f"{image_blob_name}|{audio_blob_name}|{engine}|{RENDER_WIDTH}x{RENDER_HEIGHT}@{engine_fps(engine)}"
+    return hashlib.sha1(settings.encode("utf-8")).hexdigest()
+
+
+# --- 2. Engine แบบเดิม: MoviePy ---
+
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def render_moviepy_segment(asset, segment_path):
+    """
+    render ฉากเดียวด้วย MoviePy เป็น segment ขนาด RENDER_WIDTH x RENDER_HEIGHT
+    แล้วปิด reader ทุกตัวทันที (subprocess ของเสียงและภาพที่ decode แล้วไม่ค้างอยู่ในหน่วยความจำ)
+    """
+    import numpy
+    from PIL import Image, ImageOps
+    from moviepy.editor import ImageClip, AudioFileClip
+
+    with Image.open(asset['image']) as image:
+        frame = image.convert("RGB")
+    if frame.size != (RENDER_WIDTH, RENDER_HEIGHT):
+        # ภาพที่ยังไม่ได้ปรับขนาด: ย่อด้วย PIL แล้วเติมขอบดำ (แบบเดียวกับ normalize_image) ทุก segment จึงต่อกันแบบ stream copy ได้
+        # ไม่ใช้ clip.resize เพราะ MoviePy 1.0.3 ที่ไม่มี opencv เรียก PIL.Image.ANTIALIAS ซึ่ง Pillow 10+ ไม่มีแล้ว
+        frame = ImageOps.pad(frame, (RENDER_WIDTH, RENDER_HEIGHT), method=Image.LANCZOS, color=(0, 0, 0))
+
+    clips = []
+    try:
+        audio_clip = AudioFileClip(asset['audio'])
+        clips.append(audio_clip)
+        image_clip = ImageClip(numpy.asarray(frame)).set_duration(audio_clip.duration)
+        clips.append(image_clip)
+        video_clip = image_clip.set_audio(audio_clip)
+        clips.append(video_clip)
+        with span('encode'):
+            video_clip.write_videofile(
+                segment_path, fps=MOVIEPY_FPS, codec="libx264", audio_codec="aac", audio_fps=44100, logger=None
+            )
+    finally:
+        for clip in reversed(clips):
+            clip.close()
+    return segment_path
+
+
+def render_with_moviepy(local_asset_paths, output_path, streaming=MOVIEPY_STREAMING, on_segment=None,
+                        on_segment_ready=None, output_file=None):
+    """
+    ประกอบวิดีโอด้วย MoviePy คืนค่าจำนวนฉากที่ใส่ลงในวิดีโอได้
+    on_segment, on_segment_ready, asset ที่มี 'segment' และ output_file ใช้ได้เฉพาะโหมด streaming (ดู render_with_ffmpeg)
+    """
+    if streaming:
+        # เปิด clip ทีละฉาก encode เป็น segment แล้วปิดทันที จากนั้นต่อ segment ด้วย stream copy
+        segment_paths = []
+        rendered = []
+        try:
+            for i, asset in enumerate(local_asset_paths):
+                segment_paths.append(f"{output_path}.part{i + 1:04d}.mp4")
+                ready_path = None
+                try:
+                    asset = resolve_asset(asset)
+                    if asset.get('segment'):
+                        ready_path = asset['segment'] # render ไว้แล้วจากรอบก่อน
+                    else:
+                        ready_path = render_moviepy_segment(asset, segment_paths[i])
+                        if on_segment:
+                            try:
+                                on_segment(asset, ready_path)
+                            except Exception as e:
+                                print(f"    - ⚠️ Could not checkpoint rendered segment: {e}")
+                    rendered.append(ready_path)
+                except Exception as e:
+                    print(f"    - ❌ Error creating sub-clip: {e}")
+                    remove_files([segment_paths[i]]) # ไฟล์ที่ encode ค้างไว้ครึ่งทาง
+                if on_segment_ready:
+                    on_segment_ready(i, ready_path)
+            if rendered:
+                concat_segments(rendered, output_path, output_file)
+            return len(rendered)
+        finally:
+            remove_files(segment_paths)
+
+    from moviepy.editor import ImageClip, AudioFileClip, concatenate_videoclips
+
+    final_clips_list = []
+    opened_clips = []  # ทุก clip ที่เปิดแล้ว รวมถึงฉากที่สร้างไม่สำเร็จ ต้องปิดใน finally
+    final_video = None
+    try:
+        for asset in local_asset_paths:
+            try:
+                asset = resolve_asset(asset)
+                audio_clip = AudioFileClip(asset['audio'])
+                opened_clips.append(audio_clip)
+                image_clip = ImageClip(asset['image']).set_duration(audio_clip.duration)
+                opened_clips.append(image_clip)
+                video_sub_clip = image_clip.set_audio(audio_clip)
+                video_sub_clip.fps = MOVIEPY_FPS
+                final_clips_list.append(video_sub_clip)
+            except Exception as e:
+                print(f"    - ❌ Error creating sub-clip: {e}")
+
+        if final_clips_list:
+            # ภาพที่ Asset Worker ปรับขนาดไว้แล้วมีขนาดเท่ากันหมด ต่อแบบ chain ได้โดยไม่ต้อง composite ทุกเฟรม
+            method = "chain" if len({tuple(clip.size) for clip in final_clips_list}) == 1 else "compose"
+            final_video = concatenate_videoclips(final_clips_list, method=method)
+            with span('encode'):
+                final_video.write_videofile(output_path, codec="libx264", audio_codec="aac")
+        return len(final_clips_list)
+    finally:
+        if final_video is not None:
+            final_video.close()
+        for clip in final_clips_list + opened_clips:
+            clip.close()
+
+
+# --- 3. Engine ใหม่: ffmpeg แบบ encode ทีละฉากขนานกันแล้วต่อไฟล์ด้วย stream copy ---
+
+def render_scene_segment(image_path, audio_path, output_path, fps=FFMPEG_FPS):
+    """
+    encode ภาพนิ่ง 1 ภาพ + เสียง 1 ไฟล์ เป็น segment MP4 (H.264/AAC)
+    ทุก segment ใช้ความละเอียด, pixel format และ audio format เดียวกัน เพื่อให้ต่อกันแบบ -c copy ได้
+    """
+    scale_filter = (
+        f"scale={RENDER_WIDTH}:{RENDER_HEIGHT}:force_original_aspect_ratio=decrease,"
+        f"pad={RENDER_WIDTH}:{RENDER_HEIGHT}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+    )
+    command = [
+        ffmpeg_binary(), "-y", "-loglevel", "error",
+        "-loop", "1", "-framerate", str(fps), "-i", image_path,
+        "-i", audio_path,
+        "-vf", scale_filter,
+        "-c:v", "libx264", "-tune", "stillimage", "-preset", FFMPEG_PRESET,
+        "-pix_fmt", "yuv420p", "-r", str(fps),
+        "-c:a", "aac", "-b:a", "192k", "-ar", "44100", "-ac", "2",
+        "-shortest", "-threads", "1",
+        output_path,
+    ]
+    with span('encode'):
+        subprocess.run(command, check=True, capture_output=True)
+    return output_path
+
+
+def concat_segments(segment_paths, output_path, output_file=None):
+    """
+    ต่อ segment ทั้งหมดเป็นไฟล์เดียวด้วย concat demuxer (ไม่ encode ใหม่)
+    ถ้าให้ output_file (file object ที่เขียนได้ เช่น resumable upload ของ GCS) จะส่งผลออกทาง pipe
+    เป็น fragmented MP4 ระหว่างที่ ffmpeg ยังต่อไฟล์อยู่ โดยไม่เขียนวิดีโอเต็มลงดิสก์
+    """
+    list_path = f"{output_path}.segments.txt"
+    with open(list_path, "w", encoding="utf-8") as f:
+        for segment_path in segment_paths:
+            escaped_path = os.path.abspath(segment_path).replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+    try:
+        command = [
+            ffmpeg_binary(), "-y", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-c", "copy",
+        ]
+        if output_file is None:
+            with span('concat'):
+                subprocess.run(command + ["-movflags", "+faststart", output_path], check=True, capture_output=True)
+            return output_path
+
+        # faststart ต้อง seek กลับไปเขียน moov ใหม่ ซึ่งทำไม่ได้กับ pipe จึงใช้ fragmented MP4 แทน
+        command += ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1"]
+        # เวลานี้รวมการส่งขึ้น GCS ด้วย เพราะ ffmpeg เขียนได้เร็วเท่าที่ upload รับไหว
+        with span('concat_stream'):
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                shutil.copyfileobj(process.stdout, output_file, STREAM_CHUNK_BYTES)
+            except BaseException:
+                # ปลายทางเขียนไม่ได้ (เช่น upload ถูกยกเลิก) ต้องปิด ffmpeg ไม่เช่นนั้น process และ pipe จะค้าง
+                process.kill()
+                process.communicate()
+                raise
+            _, stderr = process.communicate()
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+    finally:
+        os.remove(list_path)
+    return output_path
+
+
+def render_with_ffmpeg(local_asset_paths, output_path, max_workers=FFMPEG_PARALLEL_SEGMENTS, on_segment=None,
+                       on_segment_ready=None, output_file=None):
+    """
+    encode ทุกฉากขนานกันตามจำนวน core แล้วต่อกัน คืนค่าจำนวนฉากที่ใส่ลงในวิดีโอได้
+    asset ที่มี key 'segment' คือฉากที่ render ไว้แล้วจากรอบก่อน จะนำมาต่อเลยโดยไม่ encode ใหม่
+    on_segment(asset, segment_path) จะถูกเรียกทุกครั้งที่ encode ฉากเสร็จ (ใช้ทำ checkpoint)
+    on_segment_ready(index, segment_path) จะถูกเรียกเมื่อ segment ของฉากใดพร้อม (None = ฉากนั้นล้มเหลว)
+    local_asset_paths เป็น iterable ได้ (เช่น generator ที่ส่งฉากมาเรื่อยๆ ในโหมด streaming)
+    """
+    segment_paths = []
+
+    def encode(index, asset, segment_path):
+        segment_path = encode_segment(asset, segment_path)
+        if on_segment_ready:
+            on_segment_ready(index, segment_path)
+        return segment_path
+
+    def encode_segment(asset, segment_path):
+        try:
+            asset = resolve_asset(asset)
+            if asset.get('segment'):
+                return asset['segment']
+            segment_path = render_scene_segment(asset['image'], asset['audio'], segment_path)
+        except Exception as e:
+            details = getattr(e, 'stderr', b'') or b''
+            print(f"    - ❌ Error creating sub-clip: {e} {details.decode('utf-8', 'ignore').strip()}")
+            return None
+        if on_segment:
+            try:
+                on_segment(asset, segment_path)
+            except Exception as e:
+                print(f"    - ⚠️ Could not checkpoint rendered segment: {e}")
+        return segment_path
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            encode_futures = []
+            for i, asset in enumerate(local_asset_paths):
+                segment_paths.append(f"{output_path}.part{i + 1:04d}.mp4")
+                encode_futures.append(executor.submit(encode, i, asset, segment_paths[i]))
+            rendered = [path for path in (future.result() for future in encode_futures) if path]
+        if rendered:
+            concat_segments(rendered, output_path, output_file)
+        return len(rendered)
+    finally:
+        remove_files(segment_paths)
+
+
+def render_video(local_asset_paths, output_path, engine=RENDER_ENGINE, on_segment=None, on_segment_ready=None,
+                 output_file=None):
+    """
+    ประกอบวิดีโอด้วย engine ที่เลือก คืนค่าจำนวนฉากที่ใส่ลงในวิดีโอได้
+    ถ้าให้ output_file ผลลัพธ์จะถูกเขียนลง file object นั้นแทนไฟล์ที่ output_path
+    """
+    if engine == "ffmpeg":
+        return render_with_ffmpeg(
+            local_asset_paths, output_path, on_segment=on_segment,
+            on_segment_ready=on_segment_ready, output_file=output_file
+        )
+    if engine == "moviepy":
+        if MOVIEPY_STREAMING or output_file is None:
+            return render_with_moviepy(
+                local_asset_paths, output_path, on_segment=on_segment,
+                on_segment_ready=on_segment_ready, output_file=output_file
+            )
+        # MoviePy แบบเดิมเขียนได้แค่ไฟล์ จึงคัดลอกไฟล์ที่ได้ไปยัง output_file ทีหลัง
+        clip_count = render_with_moviepy(local_asset_paths, output_path)
+        if clip_count:
+            with open(output_path, "rb") as f:
+                shutil.copyfileobj(f, output_file, STREAM_CHUNK_BYTES)
+        return clip_count
+    raise ValueError(f"Unknown render engine: {engine}")
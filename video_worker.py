@@ -1,152 +1,315 @@
 import os
-import time
-import requests
-from google.cloud import firestore, storage
-from moviepy.editor import ImageClip, AudioFileClip, concatenate_videoclips
+import queue
+import threading
+from google.cloud import firestore
 import datetime
+from urllib.parse import urlparse, unquote
+from concurrent.futures import ThreadPoolExecutor
+from job_queue import (
+    LeaseLostError, UpstreamStalledError, check_lease, fenced_update, make_worker_id, return_to_upstream, run_worker,
+)
+from backends import PIPELINE_BACKEND
+from runtime import firestore_client, preload, report_startup, storage_bucket
+from video_render import RENDER_ENGINE, render_video, segment_fingerprint, supports_segments
+from pipeline_stream import PIPELINE_STREAMING, DocumentWatcher, missing_assets
+from scene_store import read_scenes, uses_subcollection
+from video_output import VIDEO_HLS_OUTPUT, VIDEO_STREAM_UPLOAD, HlsPublisher, abort_upload_stream, open_upload_stream
+from metrics import span
 
 # --- 1. การตั้งค่า ---
 print("🚀 Starting Video Compiler Worker...")
 
-# --- แก้ไขตรงนี้ให้ตรงกับ Worker ตัวอื่นๆ ---
-GCP_KEY_FILE_PATH = "E:\\streamlit-story-app\\youtubeubload.json"
-GCP_PROJECT_ID = "youtubeubload"
-BUCKET_NAME = "ai-story-factory-assets-nattapobiz"
-# ----------------------------------------------
+# การเชื่อมต่อ GCP และชื่อ Bucket ตั้งผ่าน Environment Variable ดู runtime.py
+
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "8"))  # จำนวนฉากที่ดาวน์โหลดพร้อมกัน
 
 TEMP_FOLDER = "temp_files"
 if not os.path.exists(TEMP_FOLDER):
     os.makedirs(TEMP_FOLDER)
 
-try:
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GCP_KEY_FILE_PATH
-    db = firestore.Client(project=GCP_PROJECT_ID)
-    storage_client = storage.Client(project=GCP_PROJECT_ID)
-    bucket = storage_client.bucket(BUCKET_NAME)
-    print("✅ Successfully connected to GCP services (Firestore, Storage).")
-except Exception as e:
-    print(f"❌ Worker failed to initialize: {e}")
-    exit()
+WORKER_ID = make_worker_id("compile")
+db = None
+# Storage สร้างตอนงานแรกต้องใช้ (ไม่ต้องรอตอนเริ่ม process)
+bucket = storage_bucket
+
+
+def init():
+    global db
+    db = firestore_client.get()
+    print(f"✅ Successfully connected to backend services ({PIPELINE_BACKEND}: Firestore; Storage loads on first job).")
 
 # --- 2. ฟังก์ชันการทำงานของ Worker ---
 
 def download_from_gcs(source_blob_name, destination_file_name):
     """ดาวน์โหลดไฟล์จาก Google Cloud Storage"""
     blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_file_name)
+    with span('gcs_download'):
+        blob.download_to_filename(destination_file_name)
     print(f"    - Downloaded: {source_blob_name}")
 
+def blob_name_from_url(public_url):
+    """แกะชื่อ blob จาก public URL (สำหรับโปรเจกต์เก่าที่ยังไม่มี image_blob/audio_blob)"""
+    return unquote(urlparse(public_url).path.split("/", 2)[2])
+
+def download_scene_assets(image_blob_name, audio_blob_name, asset):
+    """ดาวน์โหลดภาพและเสียงของฉากเดียว คืนค่า dict ของ path ในเครื่อง"""
+    download_from_gcs(image_blob_name, asset['image'])
+    download_from_gcs(audio_blob_name, asset['audio'])
+    return asset
+
+def download_segment(segment_blob_name, image_blob_name, audio_blob_name, asset):
+    """ดาวน์โหลด segment ที่ render ไว้แล้วจากรอบก่อน ถ้าไม่มีแล้วให้กลับไปดาวน์โหลดภาพและเสียงแทน"""
+    try:
+        download_from_gcs(segment_blob_name, asset['segment'])
+        return asset
+    except Exception as e:
+        print(f"    - ⚠️ Checkpointed segment unavailable ({e}), re-rendering scene {asset['scene_num']}.")
+        asset.pop('segment')
+        return download_scene_assets(image_blob_name, audio_blob_name, asset)
+
 def upload_to_gcs(file_path, destination_blob_name):
     """อัปโหลดไฟล์ไปยัง Google Cloud Storage"""
     blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(file_path)
+    with span('gcs_upload'):
+        blob.upload_from_filename(file_path)
     print(f"    - Uploaded: {destination_blob_name}")
     return blob.public_url
 
+def checkpoint_segment(doc_id, asset, segment_path):
+    """อัปโหลด segment ที่ encode เสร็จแล้วและบันทึกไว้ใน Firestore เพื่อให้รอบถัดไปใช้ต่อได้"""
+    scene_num = asset['scene_num']
+    segment_blob_name = f"{doc_id}/segments/scene_{scene_num}.mp4"
+    upload_to_gcs(segment_path, segment_blob_name)
+    db.collection('projects').document(doc_id).update({
+        f'rendered_segments.scene_{scene_num}': {'blob': segment_blob_name, 'fingerprint': asset['fingerprint']}
+    })
+
+def iter_ready_scenes(doc_id, doc_data):
+    """
+    คืน (scene_num, scene) ตามลำดับฉาก
+    ถ้า Asset Worker ยังทำงานอยู่ (assets_streaming) จะรอ checkpoint ของฉากถัดไปก่อนส่งต่อ
+    """
+    doc_ref = db.collection('projects').document(doc_id)
+    if not (PIPELINE_STREAMING and doc_data.get('assets_streaming')):
+        for i, scene in enumerate(read_scenes(doc_ref, doc_data)):
+            yield i + 1, scene
+        return
+
+    watcher = DocumentWatcher(doc_ref)
+    try:
+        next_index = 0
+        data = doc_data
+        while True:
+            checkpoints = data.get('scene_assets', {})
+            streaming = data.get('assets_streaming')
+            subcollection = uses_subcollection(data)
+            for scene in read_scenes(doc_ref, data, start=next_index):
+                checkpoint = checkpoints.get(f'scene_{next_index + 1}')
+                # แบบ subcollection ผลของฉากอยู่ในเอกสารฉากเลย (error จากรอบก่อนถูกลบไปตอนส่งต่องานแล้ว)
+                finished = checkpoint is not None or not missing_assets(scene) or (subcollection and scene.get('error'))
+                if streaming and not finished:
+                    break # ฉากนี้ยังทำไม่เสร็จ รอ snapshot ถัดไป
+                next_index += 1
+                yield next_index, {**scene, **(checkpoint or {})}
+            if not streaming:
+                return
+            if not watcher.wait_for_change():
+                raise UpstreamStalledError("Asset stream stalled: no scene finished in time.")
+            data = watcher.latest()
+    finally:
+        watcher.close()
+
+def read_ahead(iterable, depth):
+    """
+    ดึงค่าจาก iterable ล่วงหน้าใน thread แยกไม่เกิน depth ตัว (เช่นส่งงานดาวน์โหลดฉากถัดๆ ไปขณะที่ encoder ยังทำฉากปัจจุบัน)
+    ผู้ใช้ได้ค่าทันทีที่พร้อมโดยไม่ต้องรอให้ครบ depth และ error จาก iterable จะถูกโยนต่อฝั่งผู้ใช้
+    """
+    items = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+    finished = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((finished, None))
+        except Exception as e:
+            put((finished, e))
+        finally:
+            close = getattr(iterable, "close", None)
+            if close:
+                close()
+
+    threading.Thread(target=produce, daemon=True, name="read-ahead").start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                return
+            yield item
+    finally:
+        stop.set()
+
 def process_compile_request(doc_id, doc_data):
-    scenes = doc_data.get('scenes', [])
+    rendered_segments = doc_data.get('rendered_segments', {})
     local_asset_paths = []
     
-    # --- ขั้นตอนดาวน์โหลด ---
+    # --- ขั้นตอนดาวน์โหลด (ขนานกันทีละฉาก แล้วส่งให้ encoder ทันทีที่ฉากนั้นพร้อม) ---
     print(f"  - Downloading assets for project {doc_id}...")
-    for i, scene in enumerate(scenes):
-        scene_num = i + 1
-        image_url = scene.get('image_url')
-        audio_url = scene.get('audio_url')
-        
-        if image_url and audio_url:
-            local_image_path = os.path.join(TEMP_FOLDER, f"{doc_id}_scene_{scene_num}.png")
-            local_audio_path = os.path.join(TEMP_FOLDER, f"{doc_id}_scene_{scene_num}.mp3")
-            
-            # ดึงชื่อไฟล์จาก URL (เช่น 'doc_id/scene_1.png')
-            image_blob_name = "/".join(image_url.split("/")[4:])
-            audio_blob_name = "/".join(audio_url.split("/")[4:])
-            
-            download_from_gcs(image_blob_name, local_image_path)
-            download_from_gcs(audio_blob_name, local_audio_path)
-            
-            local_asset_paths.append({'image': local_image_path, 'audio': local_audio_path})
-
-    # --- ขั้นตอนตัดต่อ ---
-    print(f"  - Assembling video for project {doc_id}...")
-    final_clips_list = []
-    for asset in local_asset_paths:
-        try:
-            audio_clip = AudioFileClip(asset['audio'])
-            image_clip = ImageClip(asset['image']).set_duration(audio_clip.duration)
-            video_sub_clip = image_clip.set_audio(audio_clip)
-            video_sub_clip.fps = 24
-            final_clips_list.append(video_sub_clip)
-        except Exception as e:
-            print(f"    - ❌ Error creating sub-clip: {e}")
+    download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix="download")
 
-    # --- ขั้นตอน Render และอัปโหลด ---
-    if final_clips_list:
-        try:
-            final_video_local_path = os.path.join(TEMP_FOLDER, f"{doc_id}_final_video.mp4")
-            destination_blob_name = f"{doc_id}/final_video.mp4" # <--- ชื่อไฟล์บน GCS
+    def iter_asset_futures():
+        for scene_num, scene in iter_ready_scenes(doc_id, doc_data):
+            image_url = scene.get('image_url')
+            audio_url = scene.get('audio_url')
+            if not (image_url and audio_url):
+                continue
+
+            image_blob_name = scene.get('image_blob') or blob_name_from_url(image_url)
+            audio_blob_name = scene.get('audio_blob') or blob_name_from_url(audio_url)
+            # ใช้นามสกุลเดียวกับไฟล์บน GCS (ภาพที่ปรับแล้วเป็น .jpg/.webp) ffmpeg เลือก decoder จากนามสกุล
+            image_extension = os.path.splitext(image_blob_name)[1] or ".png"
+            asset = {
+                'image': os.path.join(TEMP_FOLDER, f"{doc_id}_scene_{scene_num}{image_extension}"),
+                'audio': os.path.join(TEMP_FOLDER, f"{doc_id}_scene_{scene_num}.mp3"),
+            }
+            asset['scene_num'] = scene_num
+            asset['fingerprint'] = segment_fingerprint(image_blob_name, audio_blob_name)
+
+            # ถ้าฉากนี้เคย render ไว้แล้วด้วย asset และค่าเดิม ให้ดาวน์โหลด segment มาต่อเลย
+            checkpoint = rendered_segments.get(f'scene_{scene_num}')
+            local_asset_paths.append(asset)
+            if supports_segments() and checkpoint and checkpoint.get('fingerprint') == asset['fingerprint']:
+                asset['segment'] = os.path.join(TEMP_FOLDER, f"{doc_id}_segment_{scene_num}.mp4")
+                yield download_executor.submit(download_segment, checkpoint['blob'], image_blob_name, audio_blob_name, asset)
+            else:
+                yield download_executor.submit(download_scene_assets, image_blob_name, audio_blob_name, asset)
+
+    def checked(asset_futures):
+        for future in asset_futures:
+            check_lease() # หยุดส่งฉากใหม่ให้ encoder ถ้างานถูกคืนไปให้ Worker อื่นแล้ว
+            yield future
+
+    # --- ขั้นตอนตัดต่อ, Render (เลือก engine ได้ด้วย RENDER_ENGINE) และอัปโหลด ---
+    print(f"  - Assembling video for project {doc_id} (engine: {RENDER_ENGINE})...")
+    final_video_local_path = os.path.join(TEMP_FOLDER, f"{doc_id}_final_video.mp4")
+    destination_blob_name = f"{doc_id}/final_video.mp4" # <--- ชื่อไฟล์บน GCS
+
+    completed = False
+    lease_lost = None
+    upload_stream = None
+    try:
+        blob = bucket.blob(destination_blob_name)
+        hls = None
+        if VIDEO_HLS_OUTPUT:
+            # เผยแพร่ playlist ไว้ก่อน ผู้ใช้เริ่มดูฉากแรกๆ ได้ระหว่างที่ฉากที่เหลือยัง render อยู่
+            hls = HlsPublisher(bucket, f"{doc_id}/hls", TEMP_FOLDER)
+            db.collection('projects').document(doc_id).update({'hls_playlist_url': hls.playlist_url})
+        # ไม่ปิด upload_stream ถ้า render ล้มเหลว (การปิดจะยืนยันไฟล์ที่ยังไม่ครบขึ้น GCS) แต่ยกเลิกแทน
+        # (ถ้าเสีย lease ระหว่างนี้ Worker ที่ได้งานไปจะเขียน final_video.mp4 เองเมื่อ render เสร็จ)
+        upload_stream = open_upload_stream(blob) if VIDEO_STREAM_UPLOAD else None
+        if PIPELINE_STREAMING and doc_data.get('assets_streaming'):
+            # ฉากยังทยอยมา: ส่งดาวน์โหลดล่วงหน้าไม่เกิน DOWNLOAD_CONCURRENCY ฉาก โดย encoder ไม่ต้องรอฉากที่ยังไม่เสร็จ
+            asset_futures = read_ahead(iter_asset_futures(), DOWNLOAD_CONCURRENCY)
+        else:
+            # ทุกฉากพร้อมแล้ว: ส่งดาวน์โหลดทั้งหมดทันที (engine อย่าง MoviePy ดึงฉากถัดไปหลัง encode ฉากก่อนเสร็จ)
+            asset_futures = list(iter_asset_futures())
+        clip_count = render_video(
+            checked(asset_futures), final_video_local_path,
+            on_segment=lambda asset, segment_path: checkpoint_segment(doc_id, asset, segment_path),
+            on_segment_ready=hls.add if hls else None,
+            output_file=upload_stream
+        )
+        if not clip_count:
+            raise ValueError("No clips were generated.")
+        if hls:
+            print(f"  - HLS rendition published with {hls.finish()} scenes.")
 
-            final_video = concatenate_videoclips(final_clips_list, method="compose")
-            final_video.write_videofile(final_video_local_path, codec="libx264", audio_codec="aac")
-            
+        if upload_stream:
+            upload_stream.close()
+            upload_stream = None
+            print(f"  - Final video streamed to {destination_blob_name} during assembly.")
+        else:
             print(f"  - Uploading final video to {destination_blob_name}...")
-            blob = bucket.blob(destination_blob_name)
-            blob.upload_from_filename(final_video_local_path)
-            signed_url = blob.generate_signed_url(
-                version="v4",
-                expiration=datetime.timedelta(hours=1), # กำหนดวันหมดอายุ
-                method="GET", # อนุญาตให้ดาวน์โหลด (GET request)
-            )
-            print(f"  - Generated Signed URL (expires in 1 hour).")
-            # ---------------------------
-            db.collection('projects').document(doc_id).update({
-                'status': 'completed',
-                'final_video_url': signed_url, # <--- เก็บ Signed URL แทน Public URL
-                'completed_at': firestore.SERVER_TIMESTAMP
-            })
-            print(f"  - ✅ Project {doc_id} completed!")
-
-        
+            with span('gcs_upload'):
+                blob.upload_from_filename(final_video_local_path)
+        signed_url = blob.generate_signed_url(
+            version="v4",
+            expiration=datetime.timedelta(hours=1), # กำหนดวันหมดอายุ
+            method="GET", # อนุญาตให้ดาวน์โหลด (GET request)
+        )
+        print(f"  - Generated Signed URL (expires in 1 hour).")
+        # ---------------------------
+        fenced_update(db.collection('projects').document(doc_id), {
+            'status': 'completed',
+            'final_video_url': signed_url, # <--- เก็บ Signed URL แทน Public URL
+            'rendered_segments': firestore.DELETE_FIELD,
+            'completed_at': firestore.SERVER_TIMESTAMP
+        })
+        print(f"  - ✅ Project {doc_id} completed!")
+        completed = True
 
-        except Exception as e:
-            print(f"    - ❌ Error during final render/upload: {e}")
-            db.collection('projects').document(doc_id).update({'status': 'compile_failed', 'error_message': str(e)})
-    else:
-        print(f"  - ❌ No clips to assemble. Marking as failed.")
-        db.collection('projects').document(doc_id).update({'status': 'compile_failed', 'error_message': 'No clips were generated.'})
+    except LeaseLostError as e:
+        lease_lost = e
+    except UpstreamStalledError as e:
+        # Asset Worker หายไปหลังส่งต่องาน: คืนให้แผนก Asset ทำฉากที่เหลือต่อ (segment ที่ checkpoint ไว้ยังใช้ได้)
+        try:
+            new_status = return_to_upstream(db.collection('projects').document(doc_id), 'compile', doc_data, str(e))
+            print(f"    - ❌ {e} Moved project {doc_id} to '{new_status}'.")
+        except LeaseLostError as lost:
+            lease_lost = lost
+    except Exception as e:
+        print(f"    - ❌ Error during final render/upload: {e}")
+        try:
+            fenced_update(db.collection('projects').document(doc_id), {'status': 'compile_failed', 'error_message': str(e)})
+        except LeaseLostError as lost:
+            lease_lost = lost
+    if upload_stream:
+        abort_upload_stream(upload_stream)
 
     # --- ขั้นตอนทำความสะอาด ---
     print(f"  - Cleaning up temporary files...")
+    if completed:
+        # segment ที่ checkpoint ไว้ไม่จำเป็นแล้วเมื่อได้วิดีโอเต็ม ลบไม่สำเร็จก็ไม่กระทบโปรเจกต์ที่เสร็จแล้ว
+        try:
+            for segment_blob in bucket.list_blobs(prefix=f"{doc_id}/segments/"):
+                segment_blob.delete()
+        except Exception as e:
+            print(f"    - ⚠️ Could not delete checkpointed segments for {doc_id}: {e}")
+    download_executor.shutdown(wait=True)
     for asset in local_asset_paths:
-        if os.path.exists(asset['image']): os.remove(asset['image'])
-        if os.path.exists(asset['audio']): os.remove(asset['audio'])
-    if 'final_video_local_path' in locals() and os.path.exists(final_video_local_path):
+        for key in ('image', 'audio', 'segment'):
+            if asset.get(key) and os.path.exists(asset[key]): os.remove(asset[key])
+    if os.path.exists(final_video_local_path):
         os.remove(final_video_local_path)
     print(f"  - Cleanup complete.")
+    if lease_lost:
+        raise lease_lost # ให้ run_worker บันทึกว่างานนี้หยุดเพราะเสีย lease
 
 # --- 3. Main Loop ---
 def main_loop():
+    try:
+        init()
+    except Exception as e:
+        print(f"❌ Worker failed to initialize: {e}")
+        exit()
+    report_startup('compile')
+    preload(storage_bucket)
     print("\n👂 Video Compiler is listening for projects with status 'compile_pending'...")
-    while True:
-        try:
-            query = db.collection('projects').where('status', '==', 'compile_pending').limit(1)
-            docs = query.stream()
-            
-            found_job = False
-            for doc in docs:
-                found_job = True
-                doc_id = doc.id
-                print(f"\n✨ Found a compile job! Project ID: {doc_id}")
-                
-                db.collection('projects').document(doc_id).update({'status': 'compiling'})
-                process_compile_request(doc_id, doc.to_dict())
-            
-            if not found_job:
-                print(".", end="", flush=True)
-                time.sleep(10)
-        except Exception as e:
-            print(f"\n\n🚨 An critical error in video worker main loop: {e}\n\n")
-            time.sleep(30)
+    run_worker(db, 'compile', process_compile_request, WORKER_ID,
+               found_message="✨ Found a compile job!")
 
 if __name__ == "__main__":
     main_loop()
\ No newline at end of file
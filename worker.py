@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import importlib
+import threading
+
+# จุดเริ่มต้นเดียวของทุกแผนก: image เดียวรันแผนกไหนก็ได้ เลือกด้วย argument หรือ WORKER_STAGES
+# วิธีใช้:
+#   python worker.py assets                  (แผนกเดียว)
+#   python worker.py script compile          (หลายแผนกใน process เดียว ใช้ Firestore/Storage client ร่วมกัน)
+#   WORKER_STAGES=script,assets python worker.py
+# แต่ละแผนก import เฉพาะโมดูลของตัวเอง และโหลด client ที่หนักเมื่องานแรกต้องใช้ (ดู runtime.py)
+
+STAGE_MODULES = {
+    'script': 'script_worker',
+    'assets': 'asset_worker',
+    'compile': 'video_worker',
+}
+DEFAULT_STAGES = os.environ.get("WORKER_STAGES", ",".join(STAGE_MODULES))
+
+
+def parse_stages(args):
+    stages = [stage.strip() for arg in (args or [DEFAULT_STAGES]) for stage in arg.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGE_MODULES]
+    if unknown or not stages:
+        print(f"Usage: python worker.py [{'|'.join(STAGE_MODULES)} ...] (unknown stage: {', '.join(unknown) or '-'})")
+        sys.exit(1)
+    return list(dict.fromkeys(stages))
+
+
+def main():
+    stages = parse_stages(sys.argv[1:])
+    modules = [importlib.import_module(STAGE_MODULES[stage]) for stage in stages]
+    if len(modules) == 1:
+        modules[0].main_loop()
+        return
+
+    # แต่ละแผนกมี loop ของตัวเอง (main_loop ไม่คืนค่า) จึงรันคนละ thread
+    # ถ้าแผนกใดหยุด (เช่นเชื่อมต่อไม่สำเร็จ) ให้ปิดทั้ง process เพื่อให้ orchestrator เริ่มใหม่
+    threads = {
+        stage: threading.Thread(target=module.main_loop, daemon=True, name=f"stage-{stage}")
+        for stage, module in zip(stages, modules)
+    }
+    for thread in threads.values():
+        thread.start()
+    while all(thread.is_alive() for thread in threads.values()):
+        time.sleep(1)
+    stopped = [stage for stage, thread in threads.items() if not thread.is_alive()]
+    print(f"❌ Stage {', '.join(stopped)} stopped; shutting down the worker process.")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()